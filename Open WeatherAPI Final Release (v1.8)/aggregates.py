@@ -0,0 +1,338 @@
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+# Rollup tables and the width of their buckets in milliseconds, a bucket is identified by its first millisecond (UTC)
+ROLLUP_LEVELS: Dict[str, int] = {
+    'minute': 60 * 1000,
+    'hour': 60 * 60 * 1000,
+    'day': 24 * 60 * 60 * 1000,
+}
+
+# Largest timestamp in milliseconds, used as open end of a range. Defined here rather than in readings.py,
+# which imports this module, and imported from readings by the other modules
+MAX_TIMESTAMP: int = 253402300799999
+
+# Columns for which sums, minimums and maximums are kept
+AGGREGATE_COLUMNS: Tuple[str, ...] = ('humidity', 'temperature', 'light_level')
+
+# Tables holding aggregates, each with a count of non-NULL values per column next to the count of readings
+AGGREGATE_TABLES: Tuple[str, ...] = ('sensor_aggregates',) + tuple(f'sensor_rollup_{level}' for level in ROLLUP_LEVELS)
+
+# Columns of a rollup row, in the order the insert triggers fill them
+ROLLUP_COLUMNS: Tuple[str, ...] = ('device_id', 'bucket', 'count') + tuple(
+    f'sum_{column}' for column in AGGREGATE_COLUMNS
+) + tuple(
+    f'{extreme}_{column}' for column in AGGREGATE_COLUMNS for extreme in ('min', 'max')
+) + tuple(f'count_{column}' for column in AGGREGATE_COLUMNS)
+
+# Columns of an aggregate of the edge pre-processing as stored, in the order insert_edge_aggregates takes them
+EDGE_AGGREGATE_COLUMNS: Tuple[str, ...] = ('device_id', 'start_ms', 'end_ms', 'count') + tuple(
+    f'{statistic}_{column}' for column in AGGREGATE_COLUMNS for statistic in ('min', 'avg', 'max')
+)
+
+def rollup_updates() -> str:
+    """
+    Returns the SET list that merges a new rollup row (excluded) into an existing bucket.
+    SQLite's two-argument MIN and MAX return NULL when either side is NULL, the COALESCEs skip that side.
+    """
+    return 'count = count + excluded.count, ' + ', '.join(
+        f'sum_{column} = sum_{column} + excluded.sum_{column}, '
+        f'min_{column} = MIN(COALESCE(min_{column}, excluded.min_{column}), COALESCE(excluded.min_{column}, min_{column})), '
+        f'max_{column} = MAX(COALESCE(max_{column}, excluded.max_{column}), COALESCE(excluded.max_{column}, max_{column})), '
+        f'count_{column} = count_{column} + excluded.count_{column}'
+        for column in AGGREGATE_COLUMNS
+    )
+
+def retire_table_aggregates(cursor: sqlite3.Cursor) -> None:
+    """
+    Moves aggregates of older versions, which were kept per sensor table or used text buckets, out of the way.
+    The global aggregates are dropped (they are rebuilt from the readings), the rollups are renamed
+    to legacy_rollup_<level> (per table) or legacy_device_rollup_<level> (per device, text buckets)
+    so migrate.py can keep the history they hold.
+    """
+    cursor.execute('PRAGMA table_info(sensor_aggregates)')
+    table_keyed: bool = 'table_name' in [row[1] for row in cursor.fetchall()]
+    cursor.execute('PRAGMA table_info(sensor_rollup_minute)')
+    text_buckets: bool = ('bucket', 'TEXT') in [(row[1], row[2]) for row in cursor.fetchall()]
+    if not table_keyed and not text_buckets:
+        return
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE '%\\_aggregate\\_%' ESCAPE '\\'")
+    for (trigger,) in cursor.fetchall():
+        cursor.execute(f'DROP TRIGGER {trigger}')
+    cursor.execute('DROP VIEW IF EXISTS average_data')
+    cursor.execute('DROP TABLE sensor_aggregates')
+    prefix: str = 'legacy_rollup' if table_keyed else 'legacy_device_rollup'
+    for level in ROLLUP_LEVELS:
+        cursor.execute(f'ALTER TABLE sensor_rollup_{level} RENAME TO {prefix}_{level}')
+
+def add_value_counts(cursor: sqlite3.Cursor) -> None:
+    """
+    Adds the count of non-NULL values per column to the aggregate tables of the previous version, whose
+    columns never held NULLs, and recreates the triggers of the partitions so they keep the counts.
+    """
+    cursor.execute('PRAGMA table_info(sensor_aggregates)')
+    existing: List[str] = [row[1] for row in cursor.fetchall()]
+    if not existing or f'count_{AGGREGATE_COLUMNS[0]}' in existing:
+        return
+    for table in AGGREGATE_TABLES:
+        for column in AGGREGATE_COLUMNS:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN count_{column} INTEGER NOT NULL DEFAULT 0')
+        cursor.execute(f'UPDATE {table} SET {", ".join(f"count_{column} = count" for column in AGGREGATE_COLUMNS)}')
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE '%\\_aggregate\\_insert' ESCAPE '\\'")
+    partitions: List[str] = [trigger[:-len('_aggregate_insert')] for (trigger,) in cursor.fetchall()]
+    for partition in partitions:
+        cursor.execute(f'DROP TRIGGER IF EXISTS {partition}_aggregate_insert')
+        cursor.execute(f'DROP TRIGGER IF EXISTS {partition}_aggregate_delete')
+        create_aggregate_triggers(cursor, partition)
+
+def create_aggregate_tables(cursor: sqlite3.Cursor) -> None:
+    """
+    Creates the per-device aggregate table and the per-minute/hour/day rollup tables.
+    Replaces the old average_data table and its full-table trigger with a view on the aggregates.
+
+    The sums skip NULL values (a failed sensor read), so every average is divided by the count of
+    the values of its own column instead of the count of readings.
+    """
+    retire_table_aggregates(cursor)
+    value_counts: str = ''.join(f',\n        count_{column} INTEGER NOT NULL DEFAULT 0' for column in AGGREGATE_COLUMNS)
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS sensor_aggregates (
+        device_id TEXT PRIMARY KEY,
+        count INTEGER NOT NULL,
+        sum_humidity REAL NOT NULL,
+        sum_temperature REAL NOT NULL,
+        sum_light_level REAL NOT NULL{value_counts}
+        )
+    ''')
+
+    for level in ROLLUP_LEVELS:
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS sensor_rollup_{level} (
+            device_id TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            sum_humidity REAL NOT NULL,
+            sum_temperature REAL NOT NULL,
+            sum_light_level REAL NOT NULL,
+            min_humidity REAL,
+            max_humidity REAL,
+            min_temperature REAL,
+            max_temperature REAL,
+            min_light_level REAL,
+            max_light_level REAL{value_counts},
+            PRIMARY KEY (device_id, bucket)
+            ) WITHOUT ROWID
+        ''')
+    add_value_counts(cursor)
+
+    # The old trigger recalculated AVG() over the whole table on every insert
+    cursor.execute('DROP TRIGGER IF EXISTS update_average_data')
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = 'average_data'")
+    row: Optional[Tuple[str]] = cursor.fetchone()
+    if row is not None and row[0] == 'table':
+        cursor.execute('DROP TABLE average_data')
+    # Recreated every time, the view of the previous version divided by the count of readings
+    cursor.execute('DROP VIEW IF EXISTS average_data')
+    cursor.execute('''
+        CREATE VIEW average_data AS
+        SELECT device_id,
+               ROUND(sum_humidity / NULLIF(count_humidity, 0), 2) AS average_humidity,
+               ROUND(sum_temperature / NULLIF(count_temperature, 0), 2) AS average_temperature,
+               ROUND(sum_light_level / NULLIF(count_light_level, 0), 2) AS average_light_level
+        FROM sensor_aggregates
+        WHERE count > 0
+    ''')
+
+def create_aggregate_triggers(cursor: sqlite3.Cursor, table_name: str) -> None:
+    """
+    Creates the triggers that keep the per-device aggregates up to date for one partition of the readings.
+
+    Every insert updates one row of sensor_aggregates and one row per rollup table,
+    so the cost of an insert does not depend on the size of the table. Deletes are
+    subtracted from the global aggregates only: the rollups keep the history of
+    readings that have been removed by the cleanup. NULL values are left out of the
+    sums, the minimums and maximums and the value counts.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    table_name (str): The partition table.
+    """
+    global_sums: str = ', '.join(
+        f'sum_{column} = sum_{column} + excluded.sum_{column}, count_{column} = count_{column} + excluded.count_{column}'
+        for column in AGGREGATE_COLUMNS
+    )
+    new_sums: str = ', '.join(f'COALESCE(NEW.{column}, 0)' for column in AGGREGATE_COLUMNS)
+    new_extremes: str = ', '.join(f'NEW.{column}, NEW.{column}' for column in AGGREGATE_COLUMNS)
+    new_counts: str = ', '.join(f'NEW.{column} IS NOT NULL' for column in AGGREGATE_COLUMNS)
+    global_columns: str = ', '.join(
+        ('device_id', 'count') + tuple(f'sum_{column}' for column in AGGREGATE_COLUMNS)
+        + tuple(f'count_{column}' for column in AGGREGATE_COLUMNS)
+    )
+    rollup_inserts: str = ''.join(f'''
+            INSERT INTO sensor_rollup_{level} ({', '.join(ROLLUP_COLUMNS)})
+            VALUES (NEW.device_id, NEW.timestamp / {width} * {width}, 1, {new_sums}, {new_extremes}, {new_counts})
+            ON CONFLICT (device_id, bucket) DO UPDATE SET {rollup_updates()};'''
+        for level, width in ROLLUP_LEVELS.items()
+    )
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table_name}_aggregate_insert
+        AFTER INSERT ON {table_name}
+        BEGIN
+            INSERT INTO sensor_aggregates ({global_columns}) VALUES (NEW.device_id, 1, {new_sums}, {new_counts})
+            ON CONFLICT (device_id) DO UPDATE SET count = count + 1, {global_sums};{rollup_inserts}
+        END;
+    ''')
+
+    old_sums: str = ', '.join(
+        f'sum_{column} = sum_{column} - COALESCE(OLD.{column}, 0), count_{column} = count_{column} - (OLD.{column} IS NOT NULL)'
+        for column in AGGREGATE_COLUMNS
+    )
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {table_name}_aggregate_delete
+        AFTER DELETE ON {table_name}
+        BEGIN
+            UPDATE sensor_aggregates SET count = count - 1, {old_sums}
+            WHERE device_id = OLD.device_id;
+        END;
+    ''')
+
+def create_edge_aggregates(cursor: sqlite3.Cursor) -> None:
+    """
+    Creates the table of the aggregates the clients send instead of their readings, and the trigger that
+    adds every new aggregate to the rollups.
+
+    An aggregate only has the number, minimum, average and maximum of its readings, so it is kept as it is
+    rather than turned into invented readings: it never shows up in the readings, the exports of readings
+    or the analytics, only in the rollups. It is added to the bucket of its first reading on every level,
+    so an aggregate interval that isn't a multiple of a bucket width blurs across neighbouring buckets.
+    The global aggregates of the readings, which the retention policies count, are left alone.
+    """
+    statistics: str = ''.join(
+        f',\n        {statistic}_{column} REAL' for column in AGGREGATE_COLUMNS for statistic in ('min', 'avg', 'max')
+    )
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS edge_aggregates (
+        device_id TEXT NOT NULL,
+        start_ms INTEGER NOT NULL,
+        end_ms INTEGER NOT NULL,
+        count INTEGER NOT NULL{statistics},
+        PRIMARY KEY (device_id, start_ms)
+        ) WITHOUT ROWID
+    ''')
+
+    sums: str = ', '.join(f'COALESCE(NEW.avg_{column} * NEW.count, 0)' for column in AGGREGATE_COLUMNS)
+    extremes: str = ', '.join(f'NEW.min_{column}, NEW.max_{column}' for column in AGGREGATE_COLUMNS)
+    counts: str = ', '.join(f'CASE WHEN NEW.avg_{column} IS NULL THEN 0 ELSE NEW.count END' for column in AGGREGATE_COLUMNS)
+    rollup_inserts: str = ''.join(f'''
+            INSERT INTO sensor_rollup_{level} ({', '.join(ROLLUP_COLUMNS)})
+            VALUES (NEW.device_id, NEW.start_ms / {width} * {width}, NEW.count, {sums}, {extremes}, {counts})
+            ON CONFLICT (device_id, bucket) DO UPDATE SET {rollup_updates()};'''
+        for level, width in ROLLUP_LEVELS.items()
+    )
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS edge_aggregates_rollup
+        AFTER INSERT ON edge_aggregates
+        BEGIN{rollup_inserts}
+        END;
+    ''')
+
+def insert_edge_aggregates(cursor: sqlite3.Cursor, aggregates: List[Tuple]) -> int:
+    """
+    Stores aggregates of the edge pre-processing, one value per column of EDGE_AGGREGATE_COLUMNS
+    (timestamps in milliseconds since the epoch). An aggregate that is already stored is skipped.
+
+    Returns:
+        int: The number of stored aggregates.
+    """
+    cursor.executemany(f'''
+        INSERT INTO edge_aggregates ({', '.join(EDGE_AGGREGATE_COLUMNS)})
+        VALUES ({', '.join('?' for _ in EDGE_AGGREGATE_COLUMNS)})
+        ON CONFLICT (device_id, start_ms) DO NOTHING
+    ''', aggregates)
+    return cursor.rowcount
+
+def subtract_aggregates(cursor: sqlite3.Cursor, table_name: str) -> None:
+    """
+    Subtracts all readings of a partition from the per-device aggregates, before the partition is dropped.
+    Dropping a table doesn't fire its delete trigger.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    table_name (str): The partition table.
+    """
+    sums: str = ', '.join(
+        f'TOTAL({column}) AS removed_{column}, COUNT({column}) AS removed_count_{column}' for column in AGGREGATE_COLUMNS
+    )
+    updates: str = ', '.join(
+        f'sum_{column} = sum_{column} - dropped.removed_{column}, count_{column} = count_{column} - dropped.removed_count_{column}'
+        for column in AGGREGATE_COLUMNS
+    )
+    cursor.execute(f'''
+        UPDATE sensor_aggregates SET count = count - dropped.removed_count, {updates}
+        FROM (SELECT device_id, COUNT(*) AS removed_count, {sums} FROM {table_name} GROUP BY device_id) AS dropped
+        WHERE sensor_aggregates.device_id = dropped.device_id
+    ''')
+
+def setup_aggregates(cursor: sqlite3.Cursor) -> None:
+    """
+    Creates the aggregate tables and the table of the aggregates of the edge pre-processing.
+    The triggers of the readings are created with every partition of the readings.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    """
+    create_aggregate_tables(cursor)
+    create_edge_aggregates(cursor)
+
+def rollup_level(start: int, end: int) -> str:
+    """
+    Picks the coarsest rollup level whose buckets line up with both ends of the range.
+    The end is inclusive, a range ending on the last second of a bucket lines up as well.
+
+    Parameters:
+    start (int): Start of the range in milliseconds since the epoch.
+    end (int): End of the range in milliseconds since the epoch.
+
+    Returns:
+        str: 'day', 'hour' or 'minute'.
+    """
+    for level in ('day', 'hour'):
+        width: int = ROLLUP_LEVELS[level]
+        if start % width == 0 and (end // 1000 * 1000 + 1000) % width == 0:
+            return level
+    return 'minute'
+
+def read_averages(cursor: sqlite3.Cursor, device_id: str, start: Optional[int] = None,
+                  end: Optional[int] = None) -> Tuple[Optional[float], Optional[float], Optional[float]]:
+    """
+    Reads the average humidity, temperature and light level of a device from the aggregates.
+    Without a range the global aggregate row is used; otherwise the rollup buckets inside the range are summed.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    device_id (str): The device.
+    start (Optional[int]): Start of the range in milliseconds since the epoch.
+    end (Optional[int]): End of the range in milliseconds since the epoch.
+
+    Returns:
+        Tuple[Optional[float], Optional[float], Optional[float]]: The rounded averages, or None when there are no readings.
+    """
+    averages: str = ', '.join(f'ROUND(SUM(sum_{column}) / NULLIF(SUM(count_{column}), 0), 2)' for column in AGGREGATE_COLUMNS)
+    if start is None and end is None:
+        cursor.execute(f'SELECT {averages} FROM sensor_aggregates WHERE device_id = ? AND count > 0', (device_id,))
+    else:
+        start = start or 0
+        end = end if end is not None else MAX_TIMESTAMP
+        level: str = rollup_level(start, end)
+        width: int = ROLLUP_LEVELS[level]
+        cursor.execute(f'''
+            SELECT {averages}
+            FROM sensor_rollup_{level}
+            WHERE device_id = ? AND bucket BETWEEN ? AND ?
+        ''', (device_id, start // width * width, end // width * width))
+    row: Optional[Tuple] = cursor.fetchone()
+    if row is None:
+        return None, None, None
+    return row[0], row[1], row[2]
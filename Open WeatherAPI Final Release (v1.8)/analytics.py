@@ -0,0 +1,312 @@
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from downsampling import SERIES_COLUMNS, bucket_width
+from readings import list_partitions
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional, only the analytics endpoint needs it
+    np = None
+
+# Rows fetched from SQLite per call while loading a series
+LOAD_CHUNK: int = 50000
+
+# Percentiles reported per bucket
+BUCKET_PERCENTILES: Tuple[int, ...] = (5, 50, 95)
+
+# Coefficients of the Magnus formula for the dew point over water (Sonntag, 1990)
+MAGNUS_B: float = 17.62
+MAGNUS_C: float = 243.12
+
+# Readings a rolling window needs before a reading is compared to it
+MIN_WINDOW_SAMPLES: int = 10
+
+def numpy_available() -> bool:
+    """
+    Returns whether NumPy could be imported.
+    """
+    return np is not None
+
+def load_series(cursor: sqlite3.Cursor, device_id: str, start: int, end: int, max_rows: int) -> Tuple[Any, Dict[str, Any]]:
+    """
+    Reads up to max_rows readings of a device between start and end into NumPy arrays, oldest first.
+    Each partition is read through its (device_id, timestamp) index and converted chunk by chunk,
+    so no Python list of the whole range is built. Missing values (NULL) and infinities become NaN,
+    which the statistics below leave out.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    device_id (str): The device to read.
+    start (int): Start of the range in milliseconds since the epoch.
+    end (int): End of the range in milliseconds since the epoch.
+    max_rows (int): The most readings read, the oldest ones of the range.
+
+    Returns:
+        Tuple[Any, Dict[str, Any]]: The int64 timestamps and a float64 array per column of SERIES_COLUMNS.
+    """
+    chunks: List[Any] = []
+    remaining: int = max_rows
+    for partition in list_partitions(cursor, start, end):
+        if remaining <= 0:
+            break
+        cursor.execute(f'''
+            SELECT timestamp, {', '.join(SERIES_COLUMNS)}
+            FROM {partition}
+            WHERE device_id = ? AND timestamp BETWEEN ? AND ?
+            ORDER BY timestamp
+            LIMIT ?
+        ''', (device_id, start, end, remaining))
+        while True:
+            rows: List[Tuple] = cursor.fetchmany(LOAD_CHUNK)
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=np.float64))
+            remaining -= len(rows)
+    data: Any = np.concatenate(chunks) if chunks else np.empty((0, len(SERIES_COLUMNS) + 1))
+    # Milliseconds since the epoch are exact in a float64
+    timestamps: Any = data[:, 0].astype(np.int64)
+    values: Any = data[:, 1:]
+    values[~np.isfinite(values)] = np.nan
+    return timestamps, {column: values[:, index] for index, column in enumerate(SERIES_COLUMNS)}
+
+def window_sums(values: Any, left: Any, right: Any) -> Tuple[Any, Any, Any]:
+    """
+    Returns the count, mean and standard deviation of values[left:right] for every pair of bounds,
+    from cumulative sums so every window costs the same no matter its length.
+    NaN values are left out: they count as zero in the sums and are not counted, so a missing
+    value doesn't turn every later window into NaN. A window without values has a NaN mean.
+    """
+    present: Any = ~np.isnan(values)
+    offset: float = float(values[present].mean()) if present.any() else 0.0
+    # Centering keeps the sum of squares small, so the variance doesn't lose its precision
+    centered: Any = np.nan_to_num(values - offset)
+    sums: Any = np.concatenate(([0.0], np.cumsum(centered)))
+    squares: Any = np.concatenate(([0.0], np.cumsum(centered * centered)))
+    totals: Any = np.concatenate(([0], np.cumsum(present)))
+    counts: Any = totals[right] - totals[left]
+    safe_counts: Any = np.maximum(counts, 1)
+    means: Any = (sums[right] - sums[left]) / safe_counts
+    variances: Any = np.maximum((squares[right] - squares[left]) / safe_counts - means * means, 0.0)
+    return counts, np.where(counts > 0, means + offset, np.nan), np.sqrt(variances)
+
+def dew_point(temperature: Any, humidity: Any) -> Any:
+    """
+    Returns the dew point in °C of temperatures in °C and relative humidities in %, with the Magnus formula.
+    """
+    relative: Any = np.clip(humidity, 1.0, 100.0) / 100.0
+    gamma: Any = np.log(relative) + MAGNUS_B * temperature / (MAGNUS_C + temperature)
+    return MAGNUS_C * gamma / (MAGNUS_B - gamma)
+
+def heat_index(temperature: Any, humidity: Any) -> Any:
+    """
+    Returns the heat index in °C of temperatures in °C and relative humidities in %, with the regression
+    of the US National Weather Service: Steadman's simple formula below 80 °F, Rothfusz's regression with
+    its low and high humidity adjustments above.
+    """
+    t: Any = temperature * 9 / 5 + 32
+    rh: Any = np.clip(humidity, 0.0, 100.0)
+    simple: Any = 0.5 * (t + 61.0 + (t - 68.0) * 1.2 + rh * 0.094)
+    full: Any = (-42.379 + 2.04901523 * t + 10.14333127 * rh - 0.22475541 * t * rh - 0.00683783 * t * t
+                 - 0.05481717 * rh * rh + 0.00122874 * t * t * rh + 0.00085282 * t * rh * rh
+                 - 0.00000199 * t * t * rh * rh)
+    dry: Any = (rh < 13) & (t >= 80) & (t <= 112)
+    full = np.where(dry, full - (13 - rh) / 4 * np.sqrt(np.clip(17 - np.abs(t - 95), 0, None) / 17), full)
+    humid: Any = (rh > 85) & (t >= 80) & (t <= 87)
+    full = np.where(humid, full + (rh - 85) / 10 * (87 - t) / 5, full)
+    fahrenheit: Any = np.where((simple + t) / 2 >= 80, full, simple)
+    return (fahrenheit - 32) * 5 / 9
+
+def bucket_statistics(values: Any, starts: Any, counts: Any, order: Any) -> Dict[str, Any]:
+    """
+    Returns the mean, minimum, maximum and BUCKET_PERCENTILES of every bucket.
+    NaN values are left out, like numpy.nanmean and friends; a bucket without values gets NaN.
+
+    Parameters:
+    values (Any): The values, grouped by bucket.
+    starts (Any): The index of the first value of every bucket.
+    counts (Any): The number of values of every bucket.
+    order (Any): Indices that sort the values by bucket and then by value, NaN last within a bucket.
+
+    Returns:
+        Dict[str, Any]: 'mean', 'min', 'max' and 'p<percentile>' arrays with one value per bucket.
+    """
+    missing: Any = np.isnan(values)
+    present: Any = counts - np.add.reduceat(missing.astype(np.int64), starts)
+    empty: Any = present == 0
+    statistics: Dict[str, Any] = {
+        'mean': np.add.reduceat(np.nan_to_num(values), starts) / np.maximum(present, 1),
+        'min': np.minimum.reduceat(np.where(missing, np.inf, values), starts),
+        'max': np.maximum.reduceat(np.where(missing, -np.inf, values), starts),
+    }
+    # The sorted values of a bucket are followed by its NaNs, so its first present values are the ranks
+    ordered: Any = values[order]
+    last: Any = starts + np.maximum(present, 1) - 1
+    for percentile in BUCKET_PERCENTILES:
+        # Linear interpolation between the two closest ranks, like numpy.percentile
+        position: Any = starts + np.maximum(present - 1, 0) * (percentile / 100)
+        lower: Any = np.floor(position).astype(np.int64)
+        upper: Any = np.minimum(lower + 1, last)
+        statistics[f'p{percentile}'] = ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+    for name in statistics:
+        statistics[name][empty] = np.nan
+    return statistics
+
+def to_list(values: Any) -> List[Optional[float]]:
+    """
+    Converts an array to a JSON-ready list rounded to 2 decimals, with None for NaN.
+    """
+    return [None if value != value else value for value in np.round(values, 2).tolist()]
+
+def analyze(cursor: sqlite3.Cursor, device_id: str, start: int, end: int, max_buckets: int, window_ms: int,
+            z_threshold: float, max_anomalies: int, max_rows: int) -> Dict[str, Any]:
+    """
+    Computes the analytics of a device over a time range: per bucket the mean, minimum, maximum and
+    percentiles of every column, the rolling mean at the end of the bucket and the rate of change,
+    the dew point and heat index, and the readings that are anomalies compared to the readings of
+    the rolling window before them.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    device_id (str): The device to analyze.
+    start (int): Start of the range in milliseconds since the epoch.
+    end (int): End of the range in milliseconds since the epoch.
+    max_buckets (int): The maximum number of buckets.
+    window_ms (int): The length of the rolling window in milliseconds.
+    z_threshold (float): The absolute z-score from which a reading is an anomaly.
+    max_anomalies (int): The maximum number of anomalies returned, the strongest are kept.
+    max_rows (int): The most readings analyzed. A range with more is cut off after the oldest max_rows
+        readings and marked as truncated.
+
+    Returns:
+        Dict[str, Any]: The analytics as a JSON-ready dict.
+    """
+    # One reading more than analyzed tells whether the range was cut off
+    timestamps, columns = load_series(cursor, device_id, start, end, max_rows + 1)
+    truncated: bool = len(timestamps) > max_rows
+    if truncated:
+        timestamps = timestamps[:max_rows]
+        columns = {column: values[:max_rows] for column, values in columns.items()}
+    payload: Dict[str, Any] = {
+        'device': device_id,
+        'count': int(len(timestamps)),
+        'truncated': truncated,
+        'window_ms': window_ms,
+        'bucket_ms': None,
+        'timestamps': [],
+        'counts': [],
+        'series': {},
+        'anomalies': {'z_threshold': z_threshold, 'total': 0, 'items': []},
+    }
+    if not len(timestamps):
+        return payload
+
+    # Timestamps are sorted, so every bucket is a contiguous slice
+    width: int = bucket_width(int(timestamps[0]), int(timestamps[-1]), max_buckets)
+    bucket_ids: Any = (timestamps - timestamps[0]) // width
+    starts: Any = np.concatenate(([0], np.flatnonzero(np.diff(bucket_ids)) + 1))
+    counts: Any = np.diff(np.append(starts, len(timestamps)))
+    ends: Any = starts + counts - 1
+    bucket_times: Any = timestamps[starts]
+    hours: Any = np.diff(bucket_times) / 3600000
+
+    positions: Any = np.arange(len(timestamps))
+    # First reading inside the window that ends at every reading
+    left: Any = np.searchsorted(timestamps, timestamps - window_ms, side='right')
+
+    columns['dew_point'] = dew_point(columns['temperature'], columns['humidity'])
+    columns['heat_index'] = heat_index(columns['temperature'], columns['humidity'])
+
+    anomaly_times: List[Any] = []
+    anomaly_columns: List[Any] = []
+    anomaly_values: List[Any] = []
+    anomaly_scores: List[Any] = []
+    for column, values in columns.items():
+        order: Any = np.lexsort((values, bucket_ids))
+        statistics: Dict[str, Any] = bucket_statistics(values, starts, counts, order)
+        _, rolling_means, _ = window_sums(values, left, positions + 1)
+        statistics['rolling_mean'] = rolling_means[ends]
+        statistics['rate_per_hour'] = np.concatenate(([np.nan], np.diff(statistics['mean']) / hours))
+        payload['series'][column] = {name: to_list(value) for name, value in statistics.items()}
+
+        if column not in SERIES_COLUMNS:
+            continue
+        # Every reading against the readings of the window before it, so a spike doesn't dampen its own score
+        previous_counts, previous_means, previous_deviations = window_sums(values, left, positions)
+        scored: Any = (previous_counts >= MIN_WINDOW_SAMPLES) & (previous_deviations > 0) & ~np.isnan(values)
+        scores: Any = np.zeros(len(values))
+        np.divide(values - previous_means, previous_deviations, out=scores, where=scored)
+        flagged: Any = np.flatnonzero(np.abs(scores) >= z_threshold)
+        anomaly_times.append(timestamps[flagged])
+        anomaly_columns.append(np.full(len(flagged), column, dtype=object))
+        anomaly_values.append(values[flagged])
+        anomaly_scores.append(scores[flagged])
+
+    payload['bucket_ms'] = width
+    payload['timestamps'] = bucket_times.tolist()
+    payload['counts'] = counts.tolist()
+
+    scores = np.concatenate(anomaly_scores)
+    keep: Any = np.arange(len(scores))
+    if len(scores) > max_anomalies:
+        # Only the strongest anomalies are returned
+        keep = np.argpartition(-np.abs(scores), max_anomalies)[:max_anomalies]
+    keep = keep[np.argsort(np.concatenate(anomaly_times)[keep], kind='stable')]
+    payload['anomalies']['total'] = int(len(scores))
+    payload['anomalies']['items'] = [
+        {'timestamp': int(timestamp), 'column': name, 'value': round(float(value), 2), 'z': round(float(score), 2)}
+        for timestamp, name, value, score in zip(np.concatenate(anomaly_times)[keep], np.concatenate(anomaly_columns)[keep],
+                                                 np.concatenate(anomaly_values)[keep], scores[keep])
+    ]
+    return payload
+
+class CachedAnalysis:
+    """
+    A computed analysis with the data version it was computed from and when (milliseconds since the epoch).
+    """
+
+    def __init__(self, version: str, payload: Dict[str, Any]) -> None:
+        self.version: str = version
+        self.payload: Dict[str, Any] = payload
+        self.computed: int = int(time.time() * 1000)
+
+class AnalyticsCache:
+    """
+    Keeps the most recently used analyses per device, time window and parameters.
+    An entry is used while the data version it was computed from is current and it is younger than ttl seconds.
+    """
+
+    def __init__(self, max_entries: int, ttl: float) -> None:
+        self.max_entries: int = max(max_entries, 0)
+        self.ttl: float = ttl
+        self.entries: 'OrderedDict[Tuple, CachedAnalysis]' = OrderedDict()
+        self.lock: threading.Lock = threading.Lock()
+
+    def get(self, key: Tuple, version: str) -> Optional[CachedAnalysis]:
+        """
+        Returns the cached analysis of a key when it is still valid for the data version.
+        """
+        with self.lock:
+            entry: Optional[CachedAnalysis] = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.version != version or time.time() * 1000 - entry.computed > self.ttl * 1000:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Tuple, version: str, payload: Dict[str, Any]) -> CachedAnalysis:
+        """
+        Stores an analysis, evicting the least recently used ones beyond max_entries.
+        """
+        entry: CachedAnalysis = CachedAnalysis(version, payload)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
@@ -0,0 +1,95 @@
+import os
+import re
+import json
+import hashlib
+from typing import Any, Dict, List, Tuple
+
+# Keys of an OpenAPI path item that are operations, the other keys (summary, parameters) are not
+HTTP_METHODS: Tuple[str, ...] = ('get', 'put', 'post', 'delete', 'options', 'head', 'patch', 'trace')
+
+# Bump when the layout of the cached routes changes, so old cache files are ignored
+CACHE_VERSION: int = 1
+
+class CompiledSpec:
+    """
+    The OpenAPI document as served to clients plus the routes compiled from it.
+    Every route is (Flask rule, operationId, methods).
+    """
+
+    def __init__(self, text: bytes, routes: List[Tuple[str, str, List[str]]]) -> None:
+        self.text: bytes = text
+        self.routes: List[Tuple[str, str, List[str]]] = routes
+        self.etag: str = hashlib.sha256(text).hexdigest()[:32]
+
+def compile_routes(spec: Dict[str, Any]) -> List[Tuple[str, str, List[str]]]:
+    """
+    Turns the paths of an OpenAPI document into Flask routes, one per operationId.
+
+    Parameters:
+    spec (Dict[str, Any]): The parsed OpenAPI document.
+
+    Returns:
+        List[Tuple[str, str, List[str]]]: (rule, operationId, methods) in the order of the document.
+
+    Raises:
+        ValueError: When an operation has no operationId.
+    """
+    routes: Dict[Tuple[str, str], List[str]] = {}
+    for path, item in (spec.get('paths') or {}).items():
+        # OpenAPI path parameters use {name}, Flask uses <name>
+        rule: str = re.sub(r'{(\w+)}', r'<\1>', path)
+        for method, operation in item.items():
+            if method not in HTTP_METHODS:
+                continue
+            operation_id: str = (operation or {}).get('operationId', '')
+            if not operation_id:
+                raise ValueError(f"Missing operationId for {method.upper()} {path}")
+            routes.setdefault((rule, operation_id), []).append(method.upper())
+    return [(rule, operation_id, methods) for (rule, operation_id), methods in routes.items()]
+
+def cache_path(spec_path: str) -> str:
+    """
+    Returns where the compiled routes of a spec file are cached, next to it in __pycache__.
+    """
+    directory, name = os.path.split(spec_path)
+    return os.path.join(directory, '__pycache__', f'{os.path.splitext(name)[0]}.routes.json')
+
+def load_spec(spec_path: str) -> CompiledSpec:
+    """
+    Reads the OpenAPI document and its compiled routes. The YAML is only parsed when the cached
+    routes are missing or were compiled from a file with another modification time or size,
+    so a worker normally starts without loading PyYAML at all.
+
+    Parameters:
+    spec_path (str): Path of the OpenAPI YAML file.
+
+    Returns:
+        CompiledSpec: The document and its routes.
+    """
+    with open(spec_path, 'rb') as file:
+        stat: os.stat_result = os.fstat(file.fileno())
+        text: bytes = file.read()
+    key: Dict[str, int] = {'version': CACHE_VERSION, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+    cached_path: str = cache_path(spec_path)
+    try:
+        with open(cached_path, 'r') as file:
+            cached: Dict[str, Any] = json.load(file)
+        if cached.get('key') == key:
+            return CompiledSpec(text, [(rule, operation_id, methods) for rule, operation_id, methods in cached['routes']])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    import yaml
+    routes: List[Tuple[str, str, List[str]]] = compile_routes(yaml.safe_load(text))
+    try:
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        # Write to a temporary file first, so workers starting at the same time never read half a file
+        temporary_path: str = f'{cached_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump({'key': key, 'routes': routes}, file)
+        os.replace(temporary_path, cached_path)
+    except OSError:
+        # A read-only deployment just parses the YAML on every start
+        pass
+    return CompiledSpec(text, routes)
@@ -1,23 +1,51 @@
 import os
-import yaml
-from flask import Flask, render_template, request, redirect, url_for, session, g, send_file, Response
+import json
+import gzip
+import time
+import queue
+import atexit
+import random
+import cProfile
+import threading
+from flask import Flask, render_template, request, redirect, url_for, session, g, Response, abort
+from flask.logging import default_handler
 import sqlite3
-import uuid
 import logging
-from logging.handlers import RotatingFileHandler
-from typing import Dict, Union, List, Any, Optional
+from logging.handlers import QueueListener
+from typing import Callable, Dict, Union, List, Any, Optional, Tuple
 import configparser
-import base64
-from hashlib import pbkdf2_hmac
-from statistics import mean
+from datetime import datetime
+from downsampling import bucketed_columns, bucketed_series, lttb_columns, lttb_series
+from aggregates import read_averages
+from analytics import AnalyticsCache, CachedAnalysis, analyze, numpy_available
+from assets import IMMUTABLE_CACHE, REVALIDATE_CACHE, VENDOR_FILES, AssetManifest, missing_vendor_files, vendor_file_valid
+from apispec import CompiledSpec, load_spec
+from database import ConnectionPool, DatabaseWriter, create_pool, create_writer, is_busy_error
+from export import (EXPORT_FORMATS, EXPORT_TABLES, FORMAT_TYPES, csv_stream, gzip_stream, parquet_available,
+                    parquet_stream, stream_rows)
+from pubsub import Broker, IngestWatcher, publish_rows
+from cache import SensorCache
+from metrics import CONTENT_TYPE, Counter, Gauge, Histogram, registry
+from passwords import HasherBusy, PasswordHasher, RateLimiter, create_hasher
+from request_logging import RequestSampler, TimedConnection, parse_sample_rates, setup_queue_logging
+from readings import (MAX_TIMESTAMP, READINGS_TABLE, last_reading_id, latest_per_device, legacy_tables,
+                      list_devices, list_partitions, now_ms, setup_readings)
 
-app: Flask = Flask(__name__)
+# Static files are served by serve_static from the asset manifest instead of Flask's static route
+app: Flask = Flask(__name__, static_folder=None)
 
 # Load configuration from config.ini
 config = configparser.ConfigParser()
 config.read('config.ini')
 
-DATABASE: str = config['DATABASE']['path']
+# Requests read through pooled read-only connections, the few writes (users) go through the one write connection
+read_pool: ConnectionPool = create_pool(config, read_only=True, factory=TimedConnection)
+database_writer: DatabaseWriter = create_writer(config)
+atexit.register(read_pool.close)
+atexit.register(database_writer.close)
+
+# OpenAPI specification the routes are generated from, also served at /apiSpec
+SPEC_PATH: str = 'specifications/apiSpec.yaml'
 
 log_directory: str = config['LOGGING']['directory']
 if not os.path.exists(log_directory):
@@ -27,239 +55,776 @@ log_file: str = os.path.join(log_directory, config['LOGGING']['file'])
 maxBytes: int = config.getint('LOGGING', 'maxBytes')
 backupCount: int = config.getint('LOGGING', 'backupCount')
 
-log_handler: RotatingFileHandler = RotatingFileHandler(log_file, maxBytes=maxBytes, backupCount=backupCount)
-log_handler.setLevel(logging.INFO)
-formatter: logging.Formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-log_handler.setFormatter(formatter)
-
-app.logger.addHandler(log_handler)
+# Records go through a queue, a listener thread writes and rotates the file off the request path.
+# Flask's own stderr handler would write synchronously again, so it is removed
+app.logger.removeHandler(default_handler)
+log_listener: QueueListener = setup_queue_logging(app.logger, log_file, maxBytes, backupCount)
+atexit.register(log_listener.stop)
 app.logger.setLevel(logging.INFO)
 
+# One record per request, high-volume endpoints are sampled
+request_sampler: RequestSampler = RequestSampler(
+    parse_sample_rates(config.get('LOGGING', 'sample', fallback='')),
+    config.getfloat('LOGGING', 'slow_ms', fallback=500),
+)
+
+# Prometheus metrics served at /metrics, and an optional cProfile dump of a sample of the requests
+metrics_enabled: bool = config.getboolean('METRICS', 'enabled', fallback=False)
+profile_enabled: bool = config.getboolean('METRICS', 'profile', fallback=False)
+profile_sample: float = config.getfloat('METRICS', 'profile_sample', fallback=0.01)
+profile_directory: str = config.get('METRICS', 'profile_dir', fallback=os.path.join(log_directory, 'profiles'))
+if profile_enabled and not os.path.exists(profile_directory):
+    os.makedirs(profile_directory)
+
+request_seconds: Histogram = registry.histogram('http_request_duration_seconds', 'Time to handle a request, by route.', ('endpoint', 'method'))
+request_count: Counter = registry.counter('http_requests_total', 'Handled requests, by route and status code.', ('endpoint', 'status'))
+request_db_seconds: Histogram = registry.histogram('http_request_db_seconds', 'Time spent in SQLite calls per request, by route.', ('endpoint',))
+request_db_queries: Counter = registry.counter('http_db_queries_total', 'SQL statements run, by route.', ('endpoint',))
+# SQLite doesn't report the rows a statement scanned, the rows it returned are counted instead
+request_db_rows: Counter = registry.counter('http_db_rows_fetched_total', 'Rows fetched from SQLite, by route.', ('endpoint',))
+graph_phase_seconds: Histogram = registry.histogram('sensor_graph_phase_seconds', 'Time of the sensor graph page per phase (sql, python, render).', ('phase',))
+cache_requests: Counter = registry.counter('cache_requests_total', 'Sensor graph windows served from the in-memory ring (hit) or the database (miss).', ('result',))
+reading_age_seconds: Gauge = registry.gauge('sensor_reading_age_seconds', 'Seconds since the latest reading of a device.', ('device',))
+
 # Set Flask application's secret key
 app.secret_key = config['FLASK']['secret_key']
 
-# Constants for PBKDF2
-salt_length = config.getint('PBKDF2', 'salt_length')
-hash_name = config['PBKDF2']['hash_name']
-iterations = config.getint('PBKDF2', 'iterations')
-dk_length = config.getint('PBKDF2', 'dk_length')
+# PBKDF2 runs on a bounded pool of workers, failed logins are limited per username and per IP address
+password_hasher: PasswordHasher = create_hasher(config)
+login_limiter: RateLimiter = RateLimiter(config.getint('LOGIN', 'max_attempts'), config.getfloat('LOGIN', 'window'))
+
+# Limits for the sensor graph
+graph_max_points: int = config.getint('GRAPH', 'max_points')
+graph_method: str = config['GRAPH']['method']
+graph_device: str = config['GRAPH']['device']
+graph_window: int = int(config.getfloat('GRAPH', 'default_window', fallback=86400) * 1000)
+graph_lttb_input: int = config.getint('GRAPH', 'lttb_max_input', fallback=5000)
+
+# Limits for the JSON API
+api_page_size: int = config.getint('API', 'page_size')
+api_max_page_size: int = config.getint('API', 'max_page_size')
+api_gzip_min_size: int = config.getint('API', 'gzip_min_size')
+
+# Rows per fetch of /export and rows per Parquet row group
+export_chunk_size: int = config.getint('EXPORT', 'chunk_size')
+export_row_group_size: int = config.getint('EXPORT', 'row_group_size')
+
+# Defaults and limits of the analytics API, whose results are cached per time window
+analytics_buckets: int = config.getint('ANALYTICS', 'buckets')
+analytics_max_buckets: int = config.getint('ANALYTICS', 'max_buckets')
+analytics_window: float = config.getfloat('ANALYTICS', 'window')
+analytics_z_threshold: float = config.getfloat('ANALYTICS', 'z_threshold')
+analytics_max_anomalies: int = config.getint('ANALYTICS', 'max_anomalies')
+analytics_settle_after: float = config.getfloat('ANALYTICS', 'settle_after')
+analytics_default_window: int = int(config.getfloat('ANALYTICS', 'default_window', fallback=86400) * 1000)
+analytics_max_rows: int = config.getint('ANALYTICS', 'max_rows', fallback=1000000)
+analytics_cache: AnalyticsCache = AnalyticsCache(config.getint('ANALYTICS', 'cache_entries'), config.getfloat('ANALYTICS', 'cache_ttl'))
+
+# Static files held in memory, precompressed and linked by content-hashed URLs
+static_assets: AssetManifest = AssetManifest(
+    os.path.join(app.root_path, 'static'),
+    config.getint('ASSETS', 'min_size'),
+    config.getboolean('ASSETS', 'reload'),
+)
+# Vendored scripts that are missing are loaded from their CDN, which needs internet access
+for missing_vendor in missing_vendor_files(static_assets):
+    app.logger.warning(f'{missing_vendor} is missing or does not match its pinned sha256, the pages load it from '
+                       f'{VENDOR_FILES[missing_vendor].url}. Run python assets.py --fetch')
+
+# Columns of a reading as cached and streamed, and as returned by the series API (per device, so without device_id)
+SERIES_FIELDS: Tuple[str, ...] = ('id', 'device_id', 'timestamp', 'humidity', 'temperature', 'light_level')
+API_FIELDS: Tuple[str, ...] = ('id', 'timestamp', 'humidity', 'temperature', 'light_level')
+
+# Live readings pushed to browsers over Server-Sent Events
+stream_enabled: bool = config.getboolean('STREAM', 'enabled')
+stream_address: Optional[Tuple[str, int]] = (config['STREAM']['notify_host'], config.getint('STREAM', 'notify_port')) if stream_enabled else None
+stream_poll_interval: float = config.getfloat('STREAM', 'poll_interval')
+stream_keepalive: float = config.getfloat('STREAM', 'keepalive')
+stream_broker: Broker = Broker(config.getint('STREAM', 'queue_size'))
+
+# Latest readings and recent windows served from memory, kept current by the ingest watcher
+recent_cache: SensorCache = SensorCache(READINGS_TABLE, SERIES_FIELDS, config.getint('CACHE', 'capacity'))
+ingest_watcher: Optional[IngestWatcher] = None
+ingest_watcher_lock: threading.Lock = threading.Lock()
 
 def hash_password(password: str) -> str:
-    # Generate a random salt
-    salt = os.urandom(salt_length)
-    # Generate the hash using PBKDF2
-    hashed_password = pbkdf2_hmac(hash_name, password.encode(), salt, iterations, dklen=dk_length)
-    # Combine the salt and the hash for storage
-    stored_password = base64.b64encode(salt + hashed_password).decode('utf-8')
-    return stored_password
+    # Hash on the worker pool, the stored value carries its own hash name and iterations
+    return password_hasher.hash(password)
 
 def verify_password(stored_password: str, provided_password: str) -> bool:
-    # Decode the stored password
-    stored_password_bytes = base64.b64decode(stored_password)
-    # Extract the salt from the stored password
-    salt = stored_password_bytes[:salt_length]
-    # Extract the stored hash from the stored password
-    stored_hash = stored_password_bytes[salt_length:]
-    # Hash the provided password using the same salt
-    provided_hash = pbkdf2_hmac(hash_name, provided_password.encode(), salt, iterations, dklen=dk_length)
-    # Compare the stored hash with the provided hash
-    return stored_hash == provided_hash
+    # Hash on the worker pool with the parameters of the stored password and compare in constant time
+    return password_hasher.verify(stored_password, provided_password)
+
+def rate_limited(template: str, *keys: str) -> Optional[Response]:
+    """
+    Answers 429 with the form and an error when one of the keys has too many failed attempts.
+
+    Parameters:
+    template (str): The form to render.
+    keys (str): The rate limit keys of the request, like 'user:<name>' and 'ip:<address>'.
+
+    Returns:
+        Optional[Response]: The 429 response, or None when the request may continue.
+    """
+    retry_after: float = max(login_limiter.retry_after(key) for key in keys)
+    if retry_after <= 0:
+        return None
+    response: Response = app.make_response((render_template(template, error='Too many attempts. Please try again later.'), 429))
+    response.headers['Retry-After'] = str(int(retry_after) + 1)
+    return response
+
+def hasher_busy(template: str) -> Response:
+    """
+    Answers 503 with the form and an error when every hashing worker is busy.
+    """
+    response: Response = app.make_response((render_template(template, error='The server is busy. Please try again.'), 503))
+    response.headers['Retry-After'] = '1'
+    return response
 
 @app.before_request
-def log_request_info() -> None:
+def start_request_timer() -> None:
     """
-    Logs information about incoming requests.
+    Remembers when the request started, for the request log and the metrics, and starts the profiler
+    for the sampled requests.
     """
-    if request.method in ['GET', 'POST']:
-        app.logger.info('Request: %s %s', request.method, request.url)
+    g.request_started = time.perf_counter()
+    if profile_enabled and random.random() < profile_sample:
+        profiler: cProfile.Profile = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running in this thread
+            return
+        g.profiler = profiler
 
 @app.after_request
-def log_response_info(response: Response) -> Response:
+def record_metrics(response: Response) -> Response:
     """
-    Logs information about outgoing responses.
+    Adds the latency and database use of the request to the metrics and writes its profile when it was sampled.
+    Streamed responses are measured until their first byte.
     """
-    if request.method in ['GET', 'POST']:
-        if response.direct_passthrough:
-            response_info: str = '[direct passthrough]'
-        else:
-            response_info: str = '[data]'
-        app.logger.info('Response: %s %s', response.status, response_info)
+    started: Optional[float] = g.get('request_started')
+    if started is None:
+        return response
+    duration: float = time.perf_counter() - started
+    profiler: Optional[cProfile.Profile] = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(profile_directory, f'{request.endpoint or "unmatched"}-{time.time_ns()}.prof'))
+    if not metrics_enabled:
+        return response
+
+    endpoint: str = request.endpoint or 'unmatched'
+    request_seconds.observe(duration, (endpoint, request.method))
+    request_count.inc(1, (endpoint, str(response.status_code)))
+    db_connection: Optional[TimedConnection] = g.get('db_connection')
+    if db_connection is not None:
+        request_db_seconds.observe(db_connection.query_time, (endpoint,))
+        request_db_queries.inc(db_connection.query_count, (endpoint,))
+        request_db_rows.inc(db_connection.rows_fetched, (endpoint,))
+    return response
+
+@app.after_request
+def log_request(response: Response) -> Response:
+    """
+    Logs one record per request with its latency, database time and response size.
+    """
+    started: Optional[float] = g.get('request_started')
+    if started is None:
+        return response
+    duration_ms: float = (time.perf_counter() - started) * 1000
+    if not request_sampler.keep(request.endpoint, response.status_code, duration_ms):
+        return response
+
+    db_connection: Optional[TimedConnection] = g.get('db_connection')
+    app.logger.info('Request', extra={
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round(duration_ms, 2),
+        'db_ms': round(db_connection.query_time * 1000, 2) if db_connection is not None else 0,
+        'db_queries': db_connection.query_count if db_connection is not None else 0,
+        # Streamed responses have no length
+        'bytes': response.calculate_content_length() if not response.is_streamed else None,
+    })
+    return response
+
+def parse_time_param(name: str, default: int) -> int:
+    """
+    Reads a time range query parameter and converts it to the stored timestamp format.
+    Values without a timezone are read as local time.
+
+    Parameters:
+    name (str): The name of the query parameter.
+    default (int): The value used when the parameter is missing.
+
+    Returns:
+        int: The timestamp in milliseconds since the epoch.
+    """
+    value: Optional[str] = request.args.get(name)
+    if not value:
+        return default
+    try:
+        return int(datetime.fromisoformat(value).timestamp() * 1000)
+    except ValueError:
+        abort(400, description=f"Invalid '{name}' timestamp: {value}")
+
+def parse_max_points() -> int:
+    """
+    Reads the max_points query parameter, capped at the configured maximum.
+
+    Returns:
+        int: The number of points to return per series.
+    """
+    max_points: Optional[int] = request.args.get('max_points', type=int)
+    if max_points is None:
+        return graph_max_points
+    return min(max(max_points, 2), graph_max_points)
+
+def json_response(payload: Dict[str, Any], etag: str) -> Response:
+    """
+    Builds a compact JSON response with an ETag, answering 304 when the client already has this version
+    and compressing the body with gzip when the client accepts it.
+
+    Parameters:
+    payload (Dict[str, Any]): The data to serialize.
+    etag (str): The version of the data, derived from the latest row ids.
+
+    Returns:
+        Response: The response to send.
+    """
+    if request.if_none_match.contains_weak(etag):
+        response: Response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    body: bytes = json.dumps(payload, separators=(',', ':')).encode()
+    response = Response(body, mimetype='application/json')
+    if len(body) >= api_gzip_min_size and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(etag, weak=True)
     return response
 
+@app.url_defaults
+def hashed_static_url(endpoint: str, values: Dict[str, Any]) -> None:
+    """
+    Makes url_for('static', filename=...) link to the content-hashed name of the file.
+    """
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = static_assets.url_name(values['filename'])
+
+@app.template_global()
+def vendor_url(filename: str) -> str:
+    """
+    Returns the URL of a vendored script: the local copy when it has been fetched, its CDN otherwise.
+    """
+    if vendor_file_valid(static_assets, filename):
+        return url_for('static', filename=filename)
+    return VENDOR_FILES[filename].url
+
+def serve_static(filename: str) -> Response:
+    """
+    Serves a file of the static folder from memory, precompressed when the client accepts brotli or gzip.
+    Hashed URLs are cached for a year, plain ones are revalidated with their ETag.
+    """
+    asset, hashed = static_assets.find(filename)
+    if asset is None:
+        abort(404)
+    encoding, body = asset.select([encoding for encoding in ('br', 'gzip') if encoding in request.accept_encodings])
+    response: Response = Response(body, mimetype=asset.content_type)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    if len(asset.encodings) > 1:
+        response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE if hashed else REVALIDATE_CACHE
+    # Every content coding is another representation with its own ETag
+    response.set_etag(f'{asset.digest}-{encoding}')
+    return response.make_conditional(request)
+
+app.add_url_rule('/static/<path:filename>', endpoint='static', view_func=serve_static)
+
+@app.template_filter('ms_datetime')
+def format_ms_timestamp(timestamp: Optional[int]) -> str:
+    """
+    Formats a timestamp in milliseconds since the epoch as local '%Y-%m-%d %H:%M:%S' for the templates.
+    """
+    if timestamp is None:
+        return ''
+    return datetime.fromtimestamp(timestamp / 1000).strftime('%Y-%m-%d %H:%M:%S')
+
+def start_ingest_watcher() -> IngestWatcher:
+    """
+    Loads the cache and starts the thread that feeds new readings to the cache and the /stream subscribers.
+    Runs once, on the first request that needs it.
+
+    Returns:
+        IngestWatcher: The running watcher.
+    """
+    global ingest_watcher
+    with ingest_watcher_lock:
+        if ingest_watcher is None:
+            conn: sqlite3.Connection = read_pool.acquire()
+            try:
+                recent_cache.load(conn)
+            finally:
+                read_pool.release(conn)
+            # The watcher thread keeps a read-only connection of its own
+            ingest_watcher = IngestWatcher(read_pool.connect, (READINGS_TABLE,), SERIES_FIELDS, stream_address,
+                                           stream_poll_interval, {READINGS_TABLE: recent_cache.last_id})
+            ingest_watcher.add_handler(recent_cache.add_rows)
+            ingest_watcher.add_handler(lambda table, rows: publish_rows(stream_broker, SERIES_FIELDS, table, rows))
+            ingest_watcher.start()
+        return ingest_watcher
+
+def get_cache() -> SensorCache:
+    """
+    Returns the cache of recent readings. When this process doesn't receive ingest notifications,
+    the rows after the cached max(id) are read first.
+
+    Returns:
+        SensorCache: The up-to-date cache.
+    """
+    watcher: IngestWatcher = start_ingest_watcher()
+    if not watcher.listening:
+        recent_cache.refresh(get_db_connection())
+    return recent_cache
+
 def get_db_connection() -> sqlite3.Connection:
     """
-    Establishes a database connection if one does not exist.
+    Takes a read-only connection from the pool for the rest of the request if it has none yet.
     
     Returns:
         sqlite3.Connection: The database connection.
     """
     if 'db_connection' not in g:
-        g.db_connection = sqlite3.connect(DATABASE)
-        g.db_connection.row_factory = sqlite3.Row
+        # The connection adds up its query time for the request log
+        conn: TimedConnection = read_pool.acquire()
+        conn.reset_query_time()
+        conn.row_factory = sqlite3.Row
+        g.db_connection = conn
     return g.db_connection
 
-@app.route('/apiSpec')
-def api_spec() -> Response:
+def setup_database() -> None:
     """
-    Serves the OpenAPI YAML documentation.
+    Makes sure the partition registry, the readings view, the device registry and the aggregate tables exist,
+    so the web layer can serve pages before the ingest scripts have been restarted.
     """
-    return send_file('apiSpec.yaml', mimetype='text/yaml')
+    with database_writer.transaction() as conn:
+        cursor: sqlite3.Cursor = conn.cursor()
+        setup_readings(cursor, config)
+        if legacy_tables(cursor):
+            app.logger.warning('Tables of an older version found, run migrate.py to move them into the partitioned readings')
+
+def device_exists(cursor: sqlite3.Cursor, device_id: str) -> bool:
+    """
+    Returns whether a device is in the registry.
+    """
+    cursor.execute('SELECT 1 FROM devices WHERE device_id = ?', (device_id,))
+    return cursor.fetchone() is not None
 
 @app.teardown_appcontext
 def close_db_connection(exception: Optional[Exception] = None) -> None:
     """
-    Closes the database connection at the end of the request.
+    Returns the database connection to the pool at the end of the request.
     """
     db_connection: Optional[sqlite3.Connection] = g.pop('db_connection', None)
     if db_connection is not None:
-        db_connection.close()
-
-def generate_routes_from_spec() -> None:
-    """
-    Generates routes from the OpenAPI specification.
-    """
-    with open('specifications/apiSpec.yaml', 'r') as file:
-        spec: Dict[str, Any] = yaml.safe_load(file)
-        paths: Dict[str, Dict[str, Any]] = spec.get('paths', {})
-        for path, methods in paths.items():
-            for method in methods.keys():
-                # Use fixed endpoint names for specific routes
-                if path == '/login':
-                    endpoint_name: str = 'login'
-                elif path == '/register':
-                    endpoint_name: str = 'register'
-                elif path == '/':
-                    endpoint_name: str = 'index'
-                elif path == '/sensor_graph':
-                    endpoint_name: str = 'sensor_graph'
-                elif path == '/sensor_data':
-                    endpoint_name: str = 'get_sensor_data'
-                else:
-                    # Generate a unique name for other paths
-                    endpoint_name: str = f"{method.lower()}_{path.replace('/', '').replace(' ', '_')}_{uuid.uuid4().hex}"
-
-                if path == '/':
-                    def route_handler_home() -> Any:
-                        """
-                        Renders the home page.
-                        """
-                        return render_template('index.html')
-                    app.add_url_rule(path, view_func=route_handler_home, methods=[method], endpoint=endpoint_name)
-
-                elif path == '/sensor_graph':
-                    def route_handler_sensor_graph() -> Any:
-                        """
-                        Renders the sensor graph page with sensor data.
-                        """
-                        conn: sqlite3.Connection = get_db_connection()
-                        cursor: sqlite3.Cursor = conn.cursor()
-                        cursor.execute("SELECT timestamp, temperature, humidity, light_level FROM sensor_data")
-                        rows: List[sqlite3.Row] = cursor.fetchall()
-                        conn.close()
-                        timestamps: List[str] = [row['timestamp'] for row in rows]
-                        temperatures: List[float] = [row['temperature'] for row in rows]
-                        humidity: List[float] = [row['humidity'] for row in rows]
-                        light_level: List[float] = [row['light_level'] for row in rows]
-
-                        # Calculate average temperature
-                        avg_temperature = mean(temperatures)
-                        avg_humidity = mean(humidity)
-                        avg_light_level = mean(light_level)
-
-                        avg_temperature = round(avg_temperature, 2)
-                        avg_humidity = round(avg_humidity, 2)
-                        avg_light_level = round(avg_light_level, 2)
-
-                        return render_template('sensor_graph.html', 
-                                                timestamps=timestamps, 
-                                                temperatures=temperatures, 
-                                                humidity=humidity, 
-                                                light_level=light_level,
-                                                avg_humidity=avg_humidity,
-                                                avg_light_level=avg_light_level,
-                                                avg_temperature=avg_temperature)  # Pass avg_temperature to the template
-                    app.add_url_rule(path, view_func=route_handler_sensor_graph, methods=[method], endpoint=endpoint_name)
-
-                elif path == '/login':
-                    def route_handler_login() -> Any:
-                        """
-                        Handles user login.
-                        """
-                        error: Optional[str] = None
-                        if request.method == 'POST':
-                            username: str = request.form['username']
-                            password: str = request.form['password']
-                            conn: sqlite3.Connection = get_db_connection()
-                            cursor: sqlite3.Cursor = conn.cursor()
-                            cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-                            user: Optional[sqlite3.Row] = cursor.fetchone()
-                            conn.close()
-                            if user is not None and verify_password(user['password'], password):
-                                session['username'] = username
-                                return redirect(url_for('get_sensor_data'))
-                            else:
-                                error = 'Invalid username or password.'
-                        return render_template('login.html', error=error)
-                    app.add_url_rule(path, view_func=route_handler_login, methods=['GET', 'POST'], endpoint=endpoint_name)
-
-                elif path == '/register':
-                    def route_handler_register() -> Any:
-                        """
-                        Handles user registration.
-                        """
-                        error: Optional[str] = None
-                        if request.method == 'POST':
-                            username: str = request.form['username']
-                            password: str = request.form['password']
-                            hashed_password = hash_password(password)
-                            conn: sqlite3.Connection = get_db_connection()
-                            cursor: sqlite3.Cursor = conn.cursor()
-                            try:
-                                cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
-                                conn.commit()
-                                return redirect(url_for('login'))
-                            except sqlite3.IntegrityError:
-                                error = 'Username already exists. Please choose a different username.'
-                            finally:
-                                conn.close()
-                        return render_template('register.html', error=error)
-                    app.add_url_rule(path, view_func=route_handler_register, methods=['GET', 'POST'], endpoint=endpoint_name)
-
-                elif path == '/sensor_data':
-                    def route_handler_sensor_data() -> Any:
-                        """
-                        Fetches and displays the latest sensor data.
-                        """
-                        sensor_data: Optional[Dict[str, Union[int, str, float]]] = None
-                        second_sensor_data: Optional[Dict[str, Union[int, str, float]]] = None
-                        conn: sqlite3.Connection = get_db_connection()
-                        cursor: sqlite3.Cursor = conn.cursor()
-                        cursor.execute('SELECT id, timestamp, humidity, temperature, light_level FROM sensor_data ORDER BY id DESC LIMIT 1')
-                        row: Optional[sqlite3.Row] = cursor.fetchone()
-                        if row is not None:
-                            sensor_data = {
-                                'id': row['id'],
-                                'timestamp': row['timestamp'],
-                                'humidity': row['humidity'],
-                                'temperature': row['temperature'],
-                                'light_level': row['light_level']
-                            }
-                        cursor.execute('SELECT id, timestamp, humidity, temperature, light_level FROM second_sensor_data ORDER BY id DESC LIMIT 1')
-                        row = cursor.fetchone()
-                        if row is not None:
-                            second_sensor_data = {
-                                'id': row['id'],
-                                'timestamp': row['timestamp'],
-                                'humidity': row['humidity'],
-                                'temperature': row['temperature'],
-                                'light_level': row['light_level']
-                            }
-                        conn.close()
-                        return render_template('sensor_data.html', sensor_data=sensor_data, second_sensor_data=second_sensor_data)
-                    app.add_url_rule(path, view_func=route_handler_sensor_data, methods=[method], endpoint=endpoint_name)
-
-# Call this function to generate routes from the OpenAPI spec
-generate_routes_from_spec()
+        read_pool.release(db_connection)
+
+@app.errorhandler(sqlite3.OperationalError)
+def database_busy(error: sqlite3.OperationalError) -> Any:
+    """
+    Answers 503 when the database stayed locked for longer than the busy timeout, other database errors stay 500.
+    """
+    if not is_busy_error(error):
+        raise error
+    app.logger.warning(f'Database busy: {error}')
+    response: Response = Response('The database is busy. Please try again.', status=503, mimetype='text/plain')
+    response.headers['Retry-After'] = '1'
+    return response
+
+def route_handler_api_spec() -> Response:
+    """
+    Serves the OpenAPI YAML documentation from memory, with an ETag so clients can revalidate it cheaply.
+    """
+    response: Response = Response(api_spec.text, mimetype='text/yaml')
+    response.set_etag(api_spec.etag)
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response.make_conditional(request)
+
+def route_handler_metrics() -> Response:
+    """
+    Serves the metrics of this process in the Prometheus text format.
+    The age of the latest reading per device is taken from the cache at scrape time.
+    """
+    if not metrics_enabled:
+        abort(404)
+    now: float = time.time()
+    for device, reading in get_cache().get_all_latest().items():
+        reading_age_seconds.set(round(now - reading['timestamp'] / 1000, 3), (device,))
+    response: Response = Response(registry.render(), content_type=CONTENT_TYPE)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def route_handler_home() -> Any:
+    """
+    Renders the home page.
+    """
+    return render_template('index.html')
+
+def chart_payload(series: Dict[str, List[Any]]) -> Dict[str, Any]:
+    """
+    Builds the data of the sensor graph charts, embedded once in the page for static/js/charts.js.
+    The timestamps are sent once when every series has the same ones, as bucketed series do.
+    """
+    shared: List[Any] = series['temperature_timestamps']
+    charts: Dict[str, Dict[str, List[Any]]] = {}
+    for column in ('temperature', 'humidity', 'light_level'):
+        charts[column] = {'values': series[column]}
+        if series[f'{column}_timestamps'] != shared:
+            charts[column]['timestamps'] = series[f'{column}_timestamps']
+    return {'timestamps': shared, 'series': charts}
+
+def route_handler_sensor_graph() -> Any:
+    """
+    Renders the sensor graph page with sensor data. Without a from parameter the last
+    default_window seconds before the end of the range are plotted.
+    """
+    end: int = parse_time_param('to', MAX_TIMESTAMP)
+    start: int = parse_time_param('from', min(end, now_ms()) - graph_window)
+    max_points: int = parse_max_points()
+    downsample_method: str = request.args.get('method', graph_method)
+    device: str = request.args.get('device', graph_device)
+    started: float = time.perf_counter()
+
+    # Recent windows are served from the in-memory ring
+    window: Optional[Dict[str, List[Any]]] = get_cache().get_window(device, start, end)
+    cache_requests.inc(1, ('hit' if window is not None else 'miss',))
+
+    if window is not None:
+        columns: Dict[str, List[float]] = {column: window[column] for column in ('temperature', 'humidity', 'light_level')}
+        if downsample_method == 'lttb':
+            series: Dict[str, List[Any]] = lttb_columns(window['timestamps'], columns, max_points)
+        else:
+            series = bucketed_columns(window['timestamps'], columns, max_points)
+        present: Dict[str, List[float]] = {
+            column: [value for value in values if value is not None] for column, values in columns.items()
+        }
+        avg_humidity, avg_temperature, avg_light_level = (
+            round(sum(present[column]) / len(present[column]), 2) if present[column] else None
+            for column in ('humidity', 'temperature', 'light_level')
+        )
+    else:
+        conn: sqlite3.Connection = get_db_connection()
+        cursor: sqlite3.Cursor = conn.cursor()
+        if downsample_method == 'lttb':
+            series = lttb_series(cursor, device, start, end, max_points, graph_lttb_input)
+        else:
+            series = bucketed_series(cursor, device, start, end, max_points)
+
+        # Read the averages from the incrementally maintained aggregates
+        avg_humidity, avg_temperature, avg_light_level = read_averages(cursor, device, start, end)
+
+    # The heading shows the registered name of the device
+    named: Optional[Tuple[Optional[str]]] = get_db_connection().execute(
+        'SELECT name FROM devices WHERE device_id = ?', (device,)
+    ).fetchone()
+
+    # Time in SQLite calls is the sql phase, the rest of the work so far is downsampling in Python
+    db_connection: Optional[TimedConnection] = g.get('db_connection')
+    sql_seconds: float = db_connection.query_time if db_connection is not None else 0.0
+    graph_phase_seconds.observe(sql_seconds, ('sql',))
+    graph_phase_seconds.observe(max(time.perf_counter() - started - sql_seconds, 0.0), ('python',))
+    rendering: float = time.perf_counter()
+    page: str = render_template('sensor_graph.html', 
+                            device=device,
+                            device_name=named[0] if named is not None else None,
+                            chart_data=chart_payload(series),
+                            avg_humidity=avg_humidity,
+                            avg_light_level=avg_light_level,
+                            avg_temperature=avg_temperature)
+    graph_phase_seconds.observe(time.perf_counter() - rendering, ('render',))
+    return page
+
+def route_handler_login() -> Any:
+    """
+    Handles user login.
+    """
+    error: Optional[str] = None
+    if request.method == 'POST':
+        username: str = request.form['username']
+        password: str = request.form['password']
+        keys: Tuple[str, str] = (f'user:{username}', f'ip:{request.remote_addr}')
+        limited: Optional[Response] = rate_limited('login.html', *keys)
+        if limited is not None:
+            return limited
+        conn: sqlite3.Connection = get_db_connection()
+        cursor: sqlite3.Cursor = conn.cursor()
+        cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
+        user: Optional[sqlite3.Row] = cursor.fetchone()
+        try:
+            verified: bool = verify_password(user['password'], password) if user is not None else password_hasher.verify_missing(password)
+        except HasherBusy:
+            return hasher_busy('login.html')
+        if verified:
+            login_limiter.reset(keys[0])
+            # Passwords hashed with older settings are upgraded while the plain password is at hand
+            if password_hasher.needs_rehash(user['password']):
+                try:
+                    rehashed: str = hash_password(password)
+                    with database_writer.transaction() as writer:
+                        writer.execute('UPDATE users SET password = ? WHERE username = ?', (rehashed, username))
+                except HasherBusy:
+                    pass
+            session['username'] = username
+            return redirect(url_for('get_sensor_data'))
+        else:
+            for key in keys:
+                login_limiter.fail(key)
+            error = 'Invalid username or password.'
+    return render_template('login.html', error=error)
+
+def route_handler_register() -> Any:
+    """
+    Handles user registration.
+    """
+    error: Optional[str] = None
+    if request.method == 'POST':
+        username: str = request.form['username']
+        password: str = request.form['password']
+        ip_key: str = f'ip:{request.remote_addr}'
+        limited: Optional[Response] = rate_limited('register.html', ip_key)
+        if limited is not None:
+            return limited
+        conn: sqlite3.Connection = get_db_connection()
+        cursor: sqlite3.Cursor = conn.cursor()
+        # Check the name first, so a taken name doesn't cost a hash
+        cursor.execute('SELECT 1 FROM users WHERE username = ?', (username,))
+        if cursor.fetchone() is not None:
+            login_limiter.fail(ip_key)
+            error = 'Username already exists. Please choose a different username.'
+            return render_template('register.html', error=error)
+        try:
+            hashed_password: str = hash_password(password)
+        except HasherBusy:
+            return hasher_busy('register.html')
+        try:
+            with database_writer.transaction() as writer:
+                writer.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
+            return redirect(url_for('login'))
+        except sqlite3.IntegrityError:
+            error = 'Username already exists. Please choose a different username.'
+    return render_template('register.html', error=error)
+
+def route_handler_sensor_data() -> Any:
+    """
+    Fetches and displays the latest reading of every device.
+    """
+    cache: SensorCache = get_cache()
+    devices: List[Dict[str, Any]] = list_devices(get_db_connection().cursor())
+    latest: Dict[str, Dict[str, Union[int, str, float]]] = cache.get_all_latest()
+    return render_template('sensor_data.html', devices=devices, latest=latest)
+
+def route_handler_api_series(device: str) -> Any:
+    """
+    Returns a page of readings of one device as parallel arrays, paginated by id.
+    """
+    after: int = request.args.get('after', 0, type=int)
+    limit: int = min(max(request.args.get('limit', api_page_size, type=int), 1), api_max_page_size)
+    start: int = parse_time_param('from', 0)
+    end: int = parse_time_param('to', MAX_TIMESTAMP)
+
+    conn: sqlite3.Connection = get_db_connection()
+    cursor: sqlite3.Cursor = conn.cursor()
+    if not device_exists(cursor, device):
+        abort(404, description=f"Unknown device: {device}")
+    etag: str = f"{device}-{last_reading_id(cursor)}-{request.query_string.decode()}"
+    if request.if_none_match.contains_weak(etag):
+        return json_response({}, etag)
+
+    # Only the partitions overlapping the range are read. Each one walks its primary key from
+    # the cursor, the (device_id, timestamp) index would need a sort by id
+    partitions: List[str] = list_partitions(cursor, start, end)
+    rows: List[Tuple] = []
+    if partitions:
+        cursor.execute(' UNION ALL '.join(f'''
+            SELECT * FROM (
+                SELECT {', '.join(API_FIELDS)}
+                FROM {partition} NOT INDEXED
+                WHERE id > ? AND device_id = ? AND timestamp BETWEEN ? AND ?
+                ORDER BY id
+                LIMIT ?
+            )''' for partition in partitions
+        ) + ' ORDER BY id LIMIT ?', (after, device, start, end, limit) * len(partitions) + (limit,))
+        rows = cursor.fetchall()
+    payload: Dict[str, Any] = {'device': device}
+    for index, field in enumerate(API_FIELDS):
+        payload[field] = [row[index] for row in rows]
+    payload['next'] = rows[-1][0] if len(rows) == limit else None
+    return json_response(payload, etag)
+
+def route_handler_api_analytics(device: str) -> Any:
+    """
+    Returns per-bucket statistics, rolling means, rates of change, dew point, heat index and anomalies
+    of one device, computed with NumPy and cached per time window. Without a from parameter the last
+    default_window seconds before the end of the range are analyzed, from a whole minute on so that
+    repeated requests share the cached analysis.
+    """
+    if not numpy_available():
+        abort(501, description="Analytics need NumPy, install it to enable this endpoint")
+    end: int = parse_time_param('to', MAX_TIMESTAMP)
+    start: int = parse_time_param('from', (min(end, now_ms()) - analytics_default_window) // 60000 * 60000)
+    buckets: int = min(max(request.args.get('buckets', analytics_buckets, type=int), 1), analytics_max_buckets)
+    window_ms: int = int(max(request.args.get('window', analytics_window, type=float), 1) * 1000)
+    z_threshold: float = request.args.get('z', analytics_z_threshold, type=float)
+
+    conn: sqlite3.Connection = get_db_connection()
+    cursor: sqlite3.Cursor = conn.cursor()
+    if not device_exists(cursor, device):
+        abort(404, description=f"Unknown device: {device}")
+    # A window that ended a while ago no longer changes, a recent one changes with every reading
+    settled: bool = end < now_ms() - analytics_settle_after * 1000
+    version: str = 'settled' if settled else str(last_reading_id(cursor))
+    key: Tuple = (device, start, end, buckets, window_ms, z_threshold)
+    analysis: Optional[CachedAnalysis] = analytics_cache.get(key, version)
+    if analysis is None:
+        analysis = analytics_cache.put(key, version, analyze(
+            cursor, device, start, end, buckets, window_ms, z_threshold, analytics_max_anomalies, analytics_max_rows
+        ))
+    etag: str = f"analytics-{version}-{analysis.computed}-{device}-{request.query_string.decode()}"
+    return json_response(analysis.payload, etag)
+
+def route_handler_api_latest() -> Any:
+    """
+    Returns the latest reading of every device.
+    """
+    cache: SensorCache = get_cache()
+    etag: str = f'latest-{cache.last_id}'
+    if request.if_none_match.contains_weak(etag):
+        return json_response({}, etag)
+    return json_response(cache.get_all_latest(), etag)
+
+def route_handler_api_devices() -> Any:
+    """
+    Returns the device registry, each device with its latest reading.
+    """
+    conn: sqlite3.Connection = get_db_connection()
+    cursor: sqlite3.Cursor = conn.cursor()
+    etag: str = f'devices-{last_reading_id(cursor)}'
+    if request.if_none_match.contains_weak(etag):
+        return json_response({}, etag)
+
+    devices: List[Dict[str, Any]] = list_devices(cursor)
+    latest: Dict[str, Dict[str, Any]] = {
+        row[1]: dict(zip(SERIES_FIELDS, row)) for row in latest_per_device(cursor, SERIES_FIELDS)
+    }
+    for device in devices:
+        device['latest'] = latest.get(device['device_id'])
+    return json_response({'devices': devices}, etag)
+
+def route_handler_export() -> Any:
+    """
+    Streams the readings or a rollup table of a time range as CSV or Parquet, one chunk of rows at a time.
+    """
+    table: str = request.args.get('table', 'readings')
+    export_format: str = request.args.get('format', 'csv')
+    device: Optional[str] = request.args.get('device') or None
+    if table not in EXPORT_TABLES:
+        abort(400, description=f"Unknown table: {table}")
+    if export_format not in EXPORT_FORMATS:
+        abort(400, description=f"Unknown format: {export_format}")
+    if export_format == 'parquet' and not parquet_available():
+        abort(501, description="Parquet exports need pyarrow, install it to enable them")
+    start: int = parse_time_param('from', 0)
+    end: int = parse_time_param('to', MAX_TIMESTAMP)
+    if device is not None and not device_exists(get_db_connection().cursor(), device):
+        abort(404, description=f"Unknown device: {device}")
+
+    columns: Tuple[str, ...] = EXPORT_TABLES[table]
+    chunks: Any = stream_rows(read_pool, table, device, start, end, export_chunk_size)
+    mimetype, extension = FORMAT_TYPES[export_format]
+    if export_format == 'parquet':
+        body: Any = parquet_stream(columns, chunks, export_row_group_size)
+    else:
+        body = csv_stream(columns, chunks)
+    response: Response = Response(body, mimetype=mimetype)
+    # Parquet is compressed already
+    if export_format == 'csv' and 'gzip' in request.accept_encodings:
+        response.response = gzip_stream(body)
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Device ids are free text, only safe characters go into the file name
+    name: str = ''.join(character if character.isalnum() or character in '-_.' else '_' for character in device or 'all')
+    response.headers['Content-Disposition'] = f'attachment; filename="{table}-{name}.{extension}"'
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def route_handler_stream() -> Any:
+    """
+    Streams new readings to the browser as Server-Sent Events.
+    """
+    subscriber: queue.Queue = stream_broker.subscribe()
+    start_ingest_watcher()
+
+    def events() -> Any:
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    message: str = subscriber.get(timeout=stream_keepalive)
+                    yield f'event: reading\ndata: {message}\n\n'
+                except queue.Empty:
+                    # Comment line that keeps proxies from closing an idle connection
+                    yield ': keepalive\n\n'
+        finally:
+            stream_broker.unsubscribe(subscriber)
+
+    response: Response = Response(events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Handler of every operationId in the OpenAPI spec, the operationId is also the endpoint name for url_for
+ROUTE_HANDLERS: Dict[str, Callable[..., Any]] = {
+    'index': route_handler_home,
+    'api_spec': route_handler_api_spec,
+    'sensor_graph': route_handler_sensor_graph,
+    'login': route_handler_login,
+    'submit_login': route_handler_login,
+    'register': route_handler_register,
+    'submit_register': route_handler_register,
+    'get_sensor_data': route_handler_sensor_data,
+    'api_series': route_handler_api_series,
+    'api_analytics': route_handler_api_analytics,
+    'api_latest': route_handler_api_latest,
+    'api_devices': route_handler_api_devices,
+    'stream': route_handler_stream,
+    'export': route_handler_export,
+    'metrics': route_handler_metrics,
+}
+
+def generate_routes_from_spec(spec: CompiledSpec) -> None:
+    """
+    Registers a route for every operation of the OpenAPI specification, bound to its handler by operationId.
+
+    Raises:
+        ValueError: When the specification has an operationId without a handler.
+    """
+    for rule, operation_id, methods in spec.routes:
+        handler: Optional[Callable[..., Any]] = ROUTE_HANDLERS.get(operation_id)
+        if handler is None:
+            raise ValueError(f"No handler for operationId {operation_id}")
+        app.add_url_rule(rule, view_func=handler, methods=methods, endpoint=operation_id)
+
+# The spec is parsed once and its routes cached, so workers start without parsing YAML
+api_spec: CompiledSpec = load_spec(SPEC_PATH)
+generate_routes_from_spec(api_spec)
+setup_database()
 
 if __name__ == '__main__':
     app.run(debug=True)
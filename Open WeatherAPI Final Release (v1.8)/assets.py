@@ -0,0 +1,262 @@
+import os
+import re
+import sys
+import gzip
+import configparser
+import hashlib
+import mimetypes
+import posixpath
+import urllib.request
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, without it the assets are precompressed with gzip only
+    brotli = None
+
+# Content types worth compressing, images and fonts are compressed already
+COMPRESSIBLE_TYPES: Tuple[str, ...] = (
+    'text/css', 'text/javascript', 'application/javascript', 'application/json', 'image/svg+xml', 'text/plain',
+)
+
+# Hex digits of the content hash put into the URL of an asset
+HASH_LENGTH: int = 12
+
+# Cache-Control of a URL with a content hash, which never changes, and of a plain URL, which is revalidated
+IMMUTABLE_CACHE: str = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE: str = 'no-cache'
+
+class VendorFile(NamedTuple):
+    """
+    A third party script: the pinned URL it is fetched from and the sha256 (hex) its content must have.
+    A file without a digest is never written by fetch_vendor_files, its digest is printed so it can be pinned.
+    """
+    url: str
+    sha256: Optional[str]
+
+# Third party scripts kept in the static folder, so the dashboard also works without internet access.
+# They are fetched with python assets.py --fetch, until then the pages load them from the CDN
+VENDOR_FILES: Dict[str, VendorFile] = {
+    'vendor/chart.umd.js': VendorFile('https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.js', None),
+}
+
+# url() references in stylesheets, rewritten to the hashed URLs of the files they point to
+CSS_URL: re.Pattern = re.compile(r'''url\((['"]?)([^'")]+)\1\)''')
+
+class Asset:
+    """
+    A static file held in memory with its content hash and its gzip and brotli versions,
+    compressed once when the manifest is built instead of on every request.
+    """
+
+    def __init__(self, filename: str, data: bytes, mtime: float, min_size: int) -> None:
+        self.filename: str = filename
+        self.mtime: float = mtime
+        self.content_type: str = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self.digest: str = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        root, extension = posixpath.splitext(filename)
+        self.hashed_name: str = f'{root}.{self.digest}{extension}'
+
+        # Body per content coding, a compressed version is only kept when it is smaller
+        self.encodings: Dict[str, bytes] = {'identity': data}
+        if self.content_type in COMPRESSIBLE_TYPES and len(data) >= min_size:
+            compressed: bytes = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data):
+                self.encodings['gzip'] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    self.encodings['br'] = compressed
+
+    def select(self, accepted: List[str]) -> Tuple[str, bytes]:
+        """
+        Returns the smallest version in one of the accepted content codings, or the uncompressed file.
+
+        Parameters:
+        accepted (List[str]): The content codings the client accepts.
+
+        Returns:
+            Tuple[str, bytes]: The content coding and the body.
+        """
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in self.encodings:
+                return encoding, self.encodings[encoding]
+        return 'identity', self.encodings['identity']
+
+class AssetManifest:
+    """
+    All files of the static folder, served from memory under their plain name and under a name with
+    their content hash. Pages link to the hashed names, which can be cached for a year: a changed file
+    gets another name, so browsers never keep an outdated copy.
+    """
+
+    def __init__(self, directory: str, min_size: int, reload: bool = False) -> None:
+        self.directory: str = directory
+        self.min_size: int = min_size
+        # Whether files are checked for changes on every lookup, for editing styles and scripts while the app runs
+        self.reload: bool = reload
+        self.assets: Dict[str, Asset] = {}
+        self.hashed: Dict[str, Asset] = {}
+        self.build()
+
+    def build(self) -> None:
+        """
+        Reads and compresses every file of the static folder. Stylesheets are read last, so their url()
+        references can be rewritten to the hashed names of the files they point to.
+        """
+        filenames: List[str] = []
+        for root, directories, files in os.walk(self.directory):
+            directories[:] = sorted(directory for directory in directories if not directory.startswith('.'))
+            for name in sorted(files):
+                if not name.startswith('.'):
+                    filenames.append(os.path.relpath(os.path.join(root, name), self.directory).replace(os.sep, '/'))
+        filenames.sort(key=lambda filename: filename.endswith('.css'))
+
+        self.assets = {}
+        self.hashed = {}
+        for filename in filenames:
+            self.load(filename)
+
+    def load(self, filename: str) -> Optional[Asset]:
+        """
+        Reads one file into the manifest, or removes it when it no longer exists.
+        """
+        path: str = os.path.join(self.directory, *filename.split('/'))
+        try:
+            with open(path, 'rb') as file:
+                mtime: float = os.fstat(file.fileno()).st_mtime
+                data: bytes = file.read()
+        except OSError:
+            asset: Optional[Asset] = self.assets.pop(filename, None)
+            if asset is not None:
+                self.hashed.pop(asset.hashed_name, None)
+            return None
+        if filename.endswith('.css'):
+            data = self.rewrite_css(filename, data)
+
+        previous: Optional[Asset] = self.assets.get(filename)
+        if previous is not None:
+            self.hashed.pop(previous.hashed_name, None)
+        asset = Asset(filename, data, mtime, self.min_size)
+        self.assets[filename] = asset
+        self.hashed[asset.hashed_name] = asset
+        return asset
+
+    def rewrite_css(self, filename: str, data: bytes) -> bytes:
+        """
+        Points the relative url() references of a stylesheet to the hashed names of the files.
+        """
+        directory: str = posixpath.dirname(filename)
+
+        def hashed_url(match: re.Match) -> str:
+            reference: str = match.group(2)
+            target: Optional[Asset] = self.assets.get(posixpath.normpath(posixpath.join(directory, reference)))
+            if target is None or '://' in reference or reference.startswith(('/', 'data:')):
+                return match.group(0)
+            return f'url({match.group(1)}{posixpath.relpath(target.hashed_name, directory or ".")}{match.group(1)})'
+
+        return CSS_URL.sub(hashed_url, data.decode()).encode()
+
+    def get(self, filename: str) -> Optional[Asset]:
+        """
+        Returns the asset of a plain file name, rereading the file when reload is on and it changed.
+        """
+        asset: Optional[Asset] = self.assets.get(filename)
+        if self.reload and (asset is None or self.modified(asset)):
+            # A name from the URL must not lead out of the static folder
+            if asset is None and (posixpath.normpath(filename) != filename or filename.startswith(('/', '..'))):
+                return None
+            asset = self.load(filename)
+        return asset
+
+    def modified(self, asset: Asset) -> bool:
+        """
+        Returns whether the file of an asset changed since it was read.
+        """
+        try:
+            return os.stat(os.path.join(self.directory, *asset.filename.split('/'))).st_mtime != asset.mtime
+        except OSError:
+            return True
+
+    def find(self, name: str) -> Tuple[Optional[Asset], bool]:
+        """
+        Looks up a requested file name, which may carry a content hash.
+
+        Parameters:
+        name (str): The file name from the URL.
+
+        Returns:
+            Tuple[Optional[Asset], bool]: The asset, or None, and whether the name was the hashed one.
+        """
+        asset: Optional[Asset] = self.hashed.get(name)
+        if asset is not None:
+            return asset, True
+        return self.get(name), False
+
+    def url_name(self, filename: str) -> str:
+        """
+        Returns the name to link a file by: the hashed name when the file is known, the plain name otherwise.
+        """
+        asset: Optional[Asset] = self.get(filename)
+        return asset.hashed_name if asset is not None else filename
+
+def vendor_file_valid(manifest: AssetManifest, filename: str) -> bool:
+    """
+    Returns whether a vendored script is in the static folder with the pinned digest, when one is pinned.
+    """
+    asset: Optional[Asset] = manifest.get(filename)
+    if asset is None:
+        return False
+    pinned: Optional[str] = VENDOR_FILES[filename].sha256
+    return pinned is None or hashlib.sha256(asset.encodings['identity']).hexdigest() == pinned
+
+def missing_vendor_files(manifest: AssetManifest) -> List[str]:
+    """
+    Returns the scripts of VENDOR_FILES that haven't been fetched into the static folder, or don't match their pin.
+    """
+    return [filename for filename in VENDOR_FILES if not vendor_file_valid(manifest, filename)]
+
+def fetch_vendor_files(directory: str) -> None:
+    """
+    Downloads the third party scripts of VENDOR_FILES into the static folder.
+    A download is only written when its sha256 matches the pinned one.
+    """
+    for filename, vendor in VENDOR_FILES.items():
+        with urllib.request.urlopen(vendor.url, timeout=30) as response:
+            data: bytes = response.read()
+        digest: str = hashlib.sha256(data).hexdigest()
+        if vendor.sha256 is None:
+            print(f"No sha256 pinned for {filename}, not written. Check {vendor.url} and pin its digest {digest}")
+            continue
+        if digest != vendor.sha256:
+            print(f"{vendor.url} has sha256 {digest} instead of the pinned {vendor.sha256}, not written")
+            continue
+        path: str = os.path.join(directory, *filename.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(data)
+        print(f"Fetched {vendor.url} ({len(data)} bytes) to {filename}")
+
+def main() -> None:
+    """
+    Prints the assets of the static folder with their hashed names and compressed sizes.
+    Pass --fetch to download the vendored scripts first.
+    """
+    config: configparser.ConfigParser = configparser.ConfigParser()
+    config.read('config.ini')
+    directory: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    if '--fetch' in sys.argv[1:]:
+        fetch_vendor_files(directory)
+
+    manifest: AssetManifest = AssetManifest(directory, config.getint('ASSETS', 'min_size', fallback=512))
+    for filename, asset in sorted(manifest.assets.items()):
+        sizes: str = ', '.join(f'{encoding} {len(body)}' for encoding, body in asset.encodings.items())
+        print(f"{asset.hashed_name}: {sizes}")
+    for filename in missing_vendor_files(manifest):
+        print(f"{filename} is missing or doesn't match its pin, the pages load it from the CDN. Run python assets.py --fetch")
+    if brotli is None:
+        print("brotli is not installed, assets are only precompressed with gzip")
+
+if __name__ == '__main__':
+    main()
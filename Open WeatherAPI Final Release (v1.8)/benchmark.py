@@ -0,0 +1,542 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import socket
+import sqlite3
+import tempfile
+import argparse
+import platform
+import threading
+import subprocess
+import contextlib
+import configparser
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from protocol import ACK, FLAG_ACK, HEADER, WireReading, decode_header, encode_frame
+from readings import insert_readings, now_ms, partition_granularity, setup_readings
+
+# The scripts read config.ini and the spec from their working directory, the benchmark runs them
+# from a work directory with its own config.ini pointing at the generated databases
+PROJECT_DIR: str = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_WORK_DIR: str = os.path.join(tempfile.gettempdir(), 'openweather-benchmark')
+DEFAULT_RESULTS_DIR: str = os.path.join(PROJECT_DIR, 'benchmarks')
+
+PHASES: Tuple[str, ...] = ('generate', 'serial', 'tcp', 'http', 'cleanup')
+
+# Readings inserted per transaction while generating
+GENERATE_CHUNK: int = 50000
+
+# Percentiles reported for the page latencies
+PERCENTILES: Tuple[int, ...] = (50, 90, 95, 99)
+
+def synthetic_reading(rng: random.Random, timestamp: int, offset: float) -> Tuple[float, float, float]:
+    """
+    Returns a plausible humidity, temperature and light level for a moment: a day/night cycle
+    and a yearly cycle with noise, humidity falling when it gets warmer and no light at night.
+
+    Parameters:
+    rng (random.Random): The seeded random generator.
+    timestamp (int): Milliseconds since the epoch.
+    offset (float): Temperature offset of the device, so the devices don't report identical weather.
+
+    Returns:
+        Tuple[float, float, float]: The humidity, temperature and light level.
+    """
+    day: float = math.sin(2 * math.pi * ((timestamp / 86400000) % 1.0) - math.pi / 2)
+    year: float = math.sin(2 * math.pi * ((timestamp / 31557600000) % 1.0) - math.pi / 2)
+    temperature: float = 11 + offset + 8 * year + 5 * day + rng.gauss(0, 0.4)
+    humidity: float = min(max(70 - 15 * day - 5 * year + rng.gauss(0, 2), 0), 100)
+    light_level: float = max(900 * day + rng.gauss(0, 25), 0)
+    return round(humidity, 1), round(temperature, 1), round(light_level)
+
+def write_config(directory: str, database: str, overrides: Dict[str, Dict[str, str]]) -> str:
+    """
+    Writes config.ini of a work directory: the project configuration with another database and overrides.
+
+    Returns:
+        str: The path of the written file.
+    """
+    config: configparser.ConfigParser = configparser.ConfigParser()
+    config.read(os.path.join(PROJECT_DIR, 'config.ini'))
+    config['DATABASE']['path'] = database
+    # The benchmark processes must not bind the ports of a running installation
+    config['METRICS']['enabled'] = 'false'
+    for section, values in overrides.items():
+        for key, value in values.items():
+            config[section][key] = value
+    os.makedirs(directory, exist_ok=True)
+    path: str = os.path.join(directory, 'config.ini')
+    with open(path, 'w') as file:
+        config.write(file)
+    return path
+
+def generate_database(path: str, config: configparser.ConfigParser, rows: int, interval: float, seed: int) -> Dict[str, Any]:
+    """
+    Fills a new database with rows readings per device, one every interval seconds and ending now.
+    The devices are the ones the sensor_data and second_sensor_data tables of older versions are migrated to.
+
+    Parameters:
+    path (str): The database file, replaced when it exists.
+    config (configparser.ConfigParser): The configuration with the MIGRATION and STORAGE sections.
+    rows (int): The number of readings per device.
+    interval (float): Seconds between two readings of a device.
+    seed (int): Seed of the random generator, the same seed gives the same database.
+
+    Returns:
+        Dict[str, Any]: The generation throughput and the size of the database.
+    """
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    devices: List[str] = [config['MIGRATION']['sensor_data'], config['MIGRATION']['second_sensor_data']]
+    granularity: str = partition_granularity(config)
+    rng: random.Random = random.Random(seed)
+    end: int = now_ms()
+    step: int = int(interval * 1000)
+
+    conn: sqlite3.Connection = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    # Durability doesn't matter for a generated database
+    conn.execute('PRAGMA synchronous = OFF')
+    cursor: sqlite3.Cursor = conn.cursor()
+    setup_readings(cursor, config)
+    conn.commit()
+
+    started: float = time.perf_counter()
+    for number, device in enumerate(devices):
+        start: int = end - rows * step
+        batch: List[Tuple[Any, ...]] = []
+        for index in range(rows):
+            # The sensors don't report at exact intervals
+            timestamp: int = start + index * step + rng.randrange(-step // 10, step // 10 + 1)
+            batch.append((device, timestamp) + synthetic_reading(rng, timestamp, number * 1.5))
+            if len(batch) >= GENERATE_CHUNK:
+                with conn:
+                    insert_readings(cursor, batch, granularity)
+                batch = []
+                print(f"{device}: {index + 1}/{rows} readings", end='\r')
+        if batch:
+            with conn:
+                insert_readings(cursor, batch, granularity)
+        print(f"{device}: {rows}/{rows} readings")
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+    duration: float = time.perf_counter() - started
+    return {
+        'generate_readings_per_s': round(rows * len(devices) / duration, 1),
+        'database_mb': round(os.path.getsize(path) / 1048576, 1),
+    }
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """
+    Returns the mean, the PERCENTILES (nearest rank) and the maximum of latencies in milliseconds.
+    """
+    ordered: List[float] = sorted(samples)
+    result: Dict[str, float] = {'mean_ms': round(sum(ordered) / len(ordered), 3)}
+    for percentile in PERCENTILES:
+        rank: int = max(math.ceil(percentile / 100 * len(ordered)) - 1, 0)
+        result[f'p{percentile}_ms'] = round(ordered[rank], 3)
+    result['max_ms'] = round(ordered[-1], 3)
+    return result
+
+class FakeSerial:
+    """
+    Stand-in for serial.Serial that produces the lines of an Arduino as fast as they are read.
+    After the last reading it raises KeyboardInterrupt, which data.py handles like Ctrl+C: it flushes and stops.
+    """
+
+    def __init__(self, readings: int, seed: int) -> None:
+        self.remaining: int = readings
+        self.rng: random.Random = random.Random(seed)
+        self.first: bool = True
+
+    def __call__(self, port: str, baudrate: int, timeout: Optional[float] = None) -> 'FakeSerial':
+        # data.py opens the port with serial.Serial(port, baudrate, timeout=...)
+        return self
+
+    def readline(self) -> bytes:
+        if self.first:
+            self.first = False
+            return b'Loading measurements...\r\n'
+        if self.remaining <= 0:
+            raise KeyboardInterrupt
+        self.remaining -= 1
+        humidity, temperature, light_level = synthetic_reading(self.rng, now_ms(), 0)
+        return f'{humidity},{temperature},{light_level}\r\n'.encode('latin-1')
+
+def bench_serial(readings: int, seed: int) -> Dict[str, Any]:
+    """
+    Runs data.py against a FakeSerial in the current (work) directory and measures its ingest throughput.
+    """
+    import serial
+    import data
+    fake: FakeSerial = FakeSerial(readings, seed)
+    original: Any = serial.Serial
+    serial.Serial = fake
+    started: float = time.perf_counter()
+    try:
+        # data.py prints every line, which would be measured as well
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            data.main()
+    finally:
+        serial.Serial = original
+    duration: float = time.perf_counter() - started
+    return {'ingest_serial_readings_per_s': round(readings / duration, 1)}
+
+def free_port() -> int:
+    """
+    Returns a TCP port that is free on the loopback interface.
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def receive_exactly(s: socket.socket, size: int) -> bytes:
+    """
+    Receives exactly size bytes from a socket.
+    """
+    data: bytearray = bytearray()
+    while len(data) < size:
+        chunk: bytes = s.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by server")
+        data += chunk
+    return bytes(data)
+
+def binary_client(address: Tuple[str, int], device_id: str, readings: int, frame_size: int, seed: int) -> None:
+    """
+    Sends readings like the Raspberry Pi client: frames of frame_size readings, each waiting for its acknowledgement.
+    Sequence numbers start at 1 in a new epoch, like those of a new outbox. The epoch isn't seeded, so
+    a run on a reused work directory isn't taken for a resend of the previous one.
+    """
+    rng: random.Random = random.Random(seed)
+    epoch: int = random.getrandbits(32)
+    with socket.create_connection(address, timeout=60) as s:
+        for first in range(1, readings + 1, frame_size):
+            frame: List[WireReading] = []
+            for sequence in range(first, min(first + frame_size, readings + 1)):
+                frame.append((sequence, time.time()) + synthetic_reading(rng, now_ms(), 0))
+            s.sendall(encode_frame(device_id, epoch, frame))
+            flags, length = decode_header(receive_exactly(s, HEADER.size))
+            if not flags & FLAG_ACK or length != ACK.size:
+                raise ConnectionError("Expected an acknowledgement")
+            receive_exactly(s, ACK.size)
+
+def text_client(address: Tuple[str, int], readings: int, seed: int) -> None:
+    """
+    Sends readings like the older clients: one 'humidity,temperature,light_level' line each, without acknowledgements.
+    """
+    rng: random.Random = random.Random(seed)
+    with socket.create_connection(address, timeout=60) as s:
+        lines: List[str] = []
+        for _ in range(readings):
+            lines.append('%s,%s,%s\n' % synthetic_reading(rng, now_ms(), 0))
+        s.sendall(''.join(lines).encode())
+
+def stored_readings(database: str) -> int:
+    """
+    Returns the number of readings in a database, from the aggregates.
+    """
+    conn: sqlite3.Connection = sqlite3.connect(database)
+    try:
+        row: Optional[Tuple[int]] = conn.execute('SELECT COALESCE(SUM(count), 0) FROM sensor_aggregates').fetchone()
+    finally:
+        conn.close()
+    return row[0]
+
+def run_clients(clients: List[Callable[[], None]]) -> None:
+    """
+    Runs every client in its own thread and waits for all of them.
+    """
+    errors: List[Exception] = []
+
+    def run(client: Callable[[], None]) -> None:
+        try:
+            client()
+        except Exception as e:
+            errors.append(e)
+
+    threads: List[threading.Thread] = [threading.Thread(target=run, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def bench_tcp(directory: str, database: str, clients: int, readings: int, frame_size: int, seed: int) -> Dict[str, Any]:
+    """
+    Starts laptop_server.py in the work directory and measures its ingest throughput with concurrent fake clients:
+    binary clients that wait for acknowledgements, then text clients whose readings are counted in the database.
+    """
+    config: configparser.ConfigParser = configparser.ConfigParser()
+    config.read(os.path.join(directory, 'config.ini'))
+    address: Tuple[str, int] = (config['SERVER']['ip'], config.getint('SERVER', 'port'))
+    server: subprocess.Popen = subprocess.Popen(
+        [sys.executable, os.path.join(PROJECT_DIR, 'laptop_server.py')],
+        cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline: float = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(address, timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise RuntimeError("laptop_server.py didn't start")
+                time.sleep(0.1)
+
+        results: Dict[str, Any] = {}
+        before: int = stored_readings(database)
+        started: float = time.perf_counter()
+        run_clients([
+            lambda number=number: binary_client(address, f'bench-pi-{number}', readings, frame_size, seed + number)
+            for number in range(clients)
+        ])
+        results['ingest_tcp_binary_readings_per_s'] = round(clients * readings / (time.perf_counter() - started), 1)
+
+        # Text readings are not acknowledged, they are done once the database holds all of them
+        before = stored_readings(database)
+        started = time.perf_counter()
+        run_clients([lambda number=number: text_client(address, readings, seed + number) for number in range(clients)])
+        expected: int = before + clients * readings
+        deadline = time.monotonic() + 300
+        while stored_readings(database) < expected:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Not every text reading was stored")
+            time.sleep(0.05)
+        results['ingest_tcp_text_readings_per_s'] = round(clients * readings / (time.perf_counter() - started), 1)
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+def bench_http(database: str, requests: int, warmup: int) -> Dict[str, Any]:
+    """
+    Measures the latency of the sensor pages with the Flask test client on the generated database.
+    The ranges are relative to the newest reading, so a reused database gives the same pages.
+    """
+    import app
+    conn: sqlite3.Connection = sqlite3.connect(database)
+    newest: Optional[int] = conn.execute(
+        'SELECT MAX(timestamp) FROM readings WHERE device_id = ?', (app.graph_device,)
+    ).fetchone()[0]
+    conn.close()
+    newest = newest if newest is not None else now_ms()
+
+    def since(days: float) -> str:
+        return datetime.fromtimestamp((newest - days * 86400000) / 1000).isoformat(timespec='seconds')
+
+    pages: Dict[str, str] = {
+        'sensor_graph_all': '/sensor_graph',
+        'sensor_graph_day': f'/sensor_graph?from={since(1)}',
+        'sensor_graph_week_lttb': f'/sensor_graph?from={since(7)}&method=lttb',
+        'sensor_data': '/sensor_data',
+    }
+    client: Any = app.app.test_client()
+    results: Dict[str, Any] = {}
+    for name, url in pages.items():
+        for _ in range(warmup):
+            client.get(url)
+        samples: List[float] = []
+        for _ in range(requests):
+            started: float = time.perf_counter()
+            response: Any = client.get(url)
+            samples.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} answered {response.status_code}")
+        for key, value in percentiles(samples).items():
+            results[f'http_{name}_{key}'] = value
+    return results
+
+def bench_cleanup(directory: str, database: str, retention_days: float) -> Dict[str, Any]:
+    """
+    Runs one pass of the cleanup on a copy of the generated database, so it can be reused by the next run.
+    """
+    import cleanup
+    from aggregates import ROLLUP_LEVELS
+    copy: str = os.path.join(directory, 'cleanup.db')
+    source: sqlite3.Connection = sqlite3.connect(database)
+    target: sqlite3.Connection = sqlite3.connect(copy)
+    source.backup(target)
+    source.close()
+    target.close()
+
+    config: configparser.ConfigParser = configparser.ConfigParser()
+    config.read(os.path.join(directory, 'config.ini'))
+    config['RETENTION']['max_age_days'] = str(retention_days)
+    chunk_size: int = config.getint('RETENTION', 'chunk_size')
+    rollup_max_age: Dict[str, float] = {
+        level: config.getfloat('RETENTION', f'rollup_{level}_max_age_days', fallback=0) for level in ROLLUP_LEVELS
+    }
+
+    conn: sqlite3.Connection = sqlite3.connect(copy, timeout=30)
+    results: Dict[str, Any] = {}
+    try:
+        devices: List[str] = [row[0] for row in conn.execute('SELECT device_id FROM devices ORDER BY device_id')]
+        policies: List[Any] = cleanup.load_policies(config, devices)
+        started: float = time.perf_counter()
+        dropped: int = cleanup.drop_expired_partitions(conn, policies)
+        results['cleanup_drop_partitions_s'] = round(time.perf_counter() - started, 3)
+        started = time.perf_counter()
+        # Without the pause between chunks, which only yields to the ingest scripts
+        deleted: int = sum(cleanup.apply_policy(conn, policy, chunk_size, 0) for policy in policies)
+        results['cleanup_apply_policies_s'] = round(time.perf_counter() - started, 3)
+        started = time.perf_counter()
+        cleanup.prune_rollups(conn, rollup_max_age)
+        results['cleanup_prune_rollups_s'] = round(time.perf_counter() - started, 3)
+        print(f"Cleanup dropped {dropped} and deleted {deleted} readings")
+    finally:
+        conn.close()
+        os.remove(copy)
+    return results
+
+def git_revision() -> Optional[str]:
+    """
+    Returns the commit of the working tree, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(previous_path: str, current: Dict[str, Any], threshold: float) -> bool:
+    """
+    Prints every result next to the one of a previous run. Results ending in _per_s are better when higher,
+    the others are durations or sizes that are better when lower.
+
+    Parameters:
+    previous_path (str): The results file of the previous run.
+    current (Dict[str, Any]): The results of this run.
+    threshold (float): The change in percent above which a result is reported as a regression.
+
+    Returns:
+        bool: Whether a result regressed by more than threshold percent.
+    """
+    with open(previous_path, 'r') as file:
+        previous: Dict[str, Any] = json.load(file)
+    if previous['parameters'] != current['parameters']:
+        print("Warning: the runs used different parameters, the results are not comparable")
+    regressed: bool = False
+    print(f"{'result':<44}{previous.get('revision') or 'previous':>14}{current.get('revision') or 'current':>14}{'change':>10}")
+    for key, value in current['results'].items():
+        old: Optional[float] = previous['results'].get(key)
+        if old is None or not old:
+            print(f"{key:<44}{'-':>14}{value:>14}")
+            continue
+        change: float = (value - old) / old * 100
+        worse: float = -change if key.endswith('_per_s') else change
+        flag: str = '  REGRESSION' if worse > threshold else ''
+        regressed = regressed or bool(flag)
+        print(f"{key:<44}{old:>14}{value:>14}{change:>+9.1f}%{flag}")
+    return regressed
+
+def main() -> None:
+    """
+    Runs the selected benchmark phases and saves the results as JSON, optionally compared to an earlier run.
+    """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description='Benchmarks ingest, the sensor pages and the cleanup on synthetic data.')
+    parser.add_argument('--phases', default=','.join(PHASES), help=f"Comma-separated phases out of {', '.join(PHASES)}")
+    parser.add_argument('--work-dir', default=DEFAULT_WORK_DIR, help='Directory of the generated databases, reused between runs')
+    parser.add_argument('--rows', type=int, default=1000000, help='Readings generated per device')
+    parser.add_argument('--interval', type=float, default=10.0, help='Seconds between generated readings')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--regenerate', action='store_true', help='Generate the database even when it exists')
+    parser.add_argument('--serial-readings', type=int, default=50000, help='Readings sent through the fake serial port')
+    parser.add_argument('--clients', type=int, default=4, help='Concurrent fake TCP clients')
+    parser.add_argument('--client-readings', type=int, default=20000, help='Readings sent per TCP client')
+    parser.add_argument('--frame-size', type=int, default=500, help='Readings per binary frame')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per page')
+    parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests per page')
+    parser.add_argument('--retention-days', type=float, default=0, help='Retention of the cleanup pass, 0 for half the generated span')
+    parser.add_argument('--label', default='', help='Name of the results file, defaults to the time and revision')
+    parser.add_argument('--results-dir', default=DEFAULT_RESULTS_DIR)
+    parser.add_argument('--compare', help='Results file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Change in percent reported as a regression')
+    args: argparse.Namespace = parser.parse_args()
+
+    phases: List[str] = [phase.strip() for phase in args.phases.split(',') if phase.strip()]
+    unknown: List[str] = [phase for phase in phases if phase not in PHASES]
+    if unknown:
+        parser.error(f"Unknown phases: {', '.join(unknown)}")
+
+    work_dir: str = os.path.abspath(args.work_dir)
+    database: str = os.path.join(work_dir, 'readings.db')
+    ingest_dir: str = os.path.join(work_dir, 'ingest')
+    ingest_database: str = os.path.join(ingest_dir, 'ingest.db')
+    write_config(work_dir, database, {})
+    write_config(ingest_dir, ingest_database, {'SERVER': {'ip': '127.0.0.1', 'port': str(free_port())}})
+    # The web app reads its spec relative to the working directory
+    shutil.copytree(os.path.join(PROJECT_DIR, 'specifications'), os.path.join(work_dir, 'specifications'), dirs_exist_ok=True)
+
+    parameters: Dict[str, Any] = {
+        key: getattr(args, key) for key in ('rows', 'interval', 'seed', 'serial_readings', 'clients',
+                                            'client_readings', 'frame_size', 'requests', 'warmup', 'retention_days')
+    }
+    results: Dict[str, Any] = {}
+    project_cwd: str = os.getcwd()
+    try:
+        if 'generate' in phases or (not os.path.exists(database) and {'http', 'cleanup'} & set(phases)):
+            if args.regenerate or not os.path.exists(database):
+                print(f"Generating {args.rows} readings per device in {database}")
+                config: configparser.ConfigParser = configparser.ConfigParser()
+                config.read(os.path.join(work_dir, 'config.ini'))
+                results.update(generate_database(database, config, args.rows, args.interval, args.seed))
+            else:
+                print(f"Reusing {database}, pass --regenerate to generate it again")
+
+        if {'serial', 'tcp'} & set(phases):
+            # Ingest is measured on an empty database every run, so the runs stay comparable
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(ingest_database + suffix):
+                    os.remove(ingest_database + suffix)
+        if 'serial' in phases:
+            print("Measuring data.py with a fake serial port")
+            os.chdir(ingest_dir)
+            results.update(bench_serial(args.serial_readings, args.seed))
+        if 'tcp' in phases:
+            print("Measuring laptop_server.py with fake clients")
+            results.update(bench_tcp(ingest_dir, ingest_database, args.clients, args.client_readings, args.frame_size, args.seed))
+
+        if 'http' in phases:
+            print("Measuring the sensor pages")
+            os.chdir(work_dir)
+            results.update(bench_http(database, args.requests, args.warmup))
+        if 'cleanup' in phases:
+            print("Measuring one cleanup pass")
+            os.chdir(work_dir)
+            retention_days: float = args.retention_days or args.rows * args.interval / 86400 / 2
+            results.update(bench_cleanup(work_dir, database, retention_days))
+    finally:
+        os.chdir(project_cwd)
+
+    revision: Optional[str] = git_revision()
+    run: Dict[str, Any] = {
+        'revision': revision,
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'results': results,
+    }
+    os.makedirs(args.results_dir, exist_ok=True)
+    name: str = args.label or f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{revision or 'unknown'}"
+    results_path: str = os.path.join(args.results_dir, f'{name}.json')
+    with open(results_path, 'w') as file:
+        json.dump(run, file, indent=2)
+    for key, value in results.items():
+        print(f"{key:<44}{value:>14}")
+    print("Results saved to", results_path)
+
+    if args.compare and compare(args.compare, run, args.threshold):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import sqlite3
+import threading
+from array import array
+from typing import Any, Dict, List, Optional, Tuple
+from readings import last_reading_id, list_partitions
+
+# Columns of a reading kept in a ring, in the order of the rows passed to RecentRing.append
+RING_COLUMNS: Tuple[str, ...] = ('ids', 'timestamps', 'humidity', 'temperature', 'light_level')
+
+class RecentRing:
+    """
+    Fixed-size ring of the most recent readings of one device, stored as parallel arrays.
+    Every column, including the millisecond timestamps, lives in a typed array so the ring costs
+    a few bytes per reading instead of a dict. Missing values are kept as NaN.
+
+    The readings are kept in timestamp order, also when a client uploads older readings late,
+    so the oldest reading of the ring is the one with the smallest timestamp and every reading
+    from that timestamp on is in the ring.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity: int = max(capacity, 1)
+        self.ids: array = array('q', bytes(8 * self.capacity))
+        self.timestamps: array = array('q', bytes(8 * self.capacity))
+        self.humidity: array = array('d', bytes(8 * self.capacity))
+        self.temperature: array = array('d', bytes(8 * self.capacity))
+        self.light_level: array = array('d', bytes(8 * self.capacity))
+        self.start: int = 0
+        self.size: int = 0
+
+    def append(self, row: Tuple) -> bool:
+        """
+        Adds a (id, timestamp, humidity, temperature, light_level) row, overwriting the oldest one when full.
+        A row older than the newest one is moved to its place in timestamp order.
+
+        Returns:
+            bool: False when the ring is full and the row is older than all of its readings, so it isn't kept.
+        """
+        timestamp: int = row[1]
+        position: int = self.size
+        if self.size and timestamp < self.timestamps[(self.start + self.size - 1) % self.capacity]:
+            position = self.find(timestamp)
+        if self.size == self.capacity:
+            if position == 0:
+                return False
+            self.start = (self.start + 1) % self.capacity
+            self.size -= 1
+            position -= 1
+        # Late rows shift the newer readings one place up, rows in order are written at the end
+        for offset in range(self.size, position, -1):
+            self.copy((self.start + offset - 1) % self.capacity, (self.start + offset) % self.capacity)
+        self.size += 1
+        index: int = (self.start + position) % self.capacity
+        for name, value in zip(RING_COLUMNS, row):
+            getattr(self, name)[index] = float('nan') if value is None else value
+        return True
+
+    def find(self, timestamp: int) -> int:
+        """
+        Returns the position, counted from the oldest reading, after the last reading not newer than timestamp.
+        """
+        low: int = 0
+        high: int = self.size
+        while low < high:
+            middle: int = (low + high) // 2
+            if self.timestamps[(self.start + middle) % self.capacity] <= timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def copy(self, source: int, target: int) -> None:
+        """
+        Copies the reading at one index of the arrays to another.
+        """
+        for name in RING_COLUMNS:
+            column: array = getattr(self, name)
+            column[target] = column[source]
+
+    def oldest_timestamp(self) -> Optional[int]:
+        """
+        Returns the smallest timestamp in the ring.
+        """
+        return self.timestamps[self.start] if self.size else None
+
+    def window(self, start: int, end: int) -> Dict[str, List[Any]]:
+        """
+        Returns the readings between start and end (inclusive, milliseconds) as parallel lists in timestamp order,
+        with None for missing values.
+        """
+        series: Dict[str, List[Any]] = {
+            'timestamps': [], 'humidity': [], 'temperature': [], 'light_level': []
+        }
+        for offset in range(self.find(start - 1), self.size):
+            index: int = (self.start + offset) % self.capacity
+            timestamp: int = self.timestamps[index]
+            if timestamp > end:
+                break
+            series['timestamps'].append(timestamp)
+            for column in ('humidity', 'temperature', 'light_level'):
+                value: float = getattr(self, column)[index]
+                series[column].append(None if value != value else value)
+        return series
+
+class SensorCache:
+    """
+    Latest reading and a ring of recent readings per device.
+
+    The cache is kept current by add_rows, called by the ingest watcher when it is notified of new rows.
+    Processes that don't receive notifications call refresh, which only reads the rows after the
+    cached max(id).
+    """
+
+    def __init__(self, table: str, fields: Tuple[str, ...], capacity: int) -> None:
+        self.table: str = table
+        # Rows are (id, device_id, timestamp, humidity, temperature, light_level)
+        self.fields: Tuple[str, ...] = fields
+        self.capacity: int = capacity
+        self.latest: Dict[str, Dict[str, Any]] = {}
+        self.rings: Dict[str, RecentRing] = {}
+        self.last_id: int = 0
+        # Whether the ring holds every reading of the device (the device has fewer readings than the ring)
+        self.complete: Dict[str, bool] = {}
+        self.lock: threading.Lock = threading.Lock()
+
+    def load(self, conn: sqlite3.Connection) -> None:
+        """
+        Fills the cache with the most recent rows of every registered device,
+        reading the partitions newest first until the ring of the device is full.
+
+        Everything is read in one read transaction, so last_id belongs to the same snapshot as the rows:
+        a reading committed while the cache loads is neither lost nor cached twice by the next add_rows.
+        """
+        conn.execute('BEGIN')
+        try:
+            last_id: int = last_reading_id(conn.cursor())
+            devices: List[str] = [row[0] for row in conn.execute('SELECT device_id FROM devices')]
+            partitions: List[str] = list_partitions(conn.cursor())
+            partitions.reverse()
+            with self.lock:
+                for device in devices:
+                    rows: List[Tuple] = []
+                    for partition in partitions:
+                        rows += conn.execute(f'''
+                            SELECT {', '.join(self.fields)} FROM {partition} WHERE device_id = ? ORDER BY timestamp DESC LIMIT ?
+                        ''', (device, self.capacity - len(rows))).fetchall()
+                        if len(rows) >= self.capacity:
+                            break
+                    rows.reverse()
+                    self.rings[device] = RecentRing(self.capacity)
+                    self.complete[device] = len(rows) < self.capacity
+                    for row in rows:
+                        self.append(row)
+                self.last_id = last_id
+        finally:
+            # Ends the read transaction
+            conn.rollback()
+
+    def append(self, row: Tuple) -> None:
+        """
+        Adds a row to the ring of its device, creating the ring for a device that wasn't seen before.
+        Must be called with the lock held.
+        """
+        device: str = row[1]
+        ring: Optional[RecentRing] = self.rings.get(device)
+        if ring is None:
+            ring = self.rings[device] = RecentRing(self.capacity)
+            self.complete[device] = True
+        if ring.size == ring.capacity:
+            self.complete[device] = False
+        ring.append((row[0],) + tuple(row[2:]))
+        reading: Dict[str, Any] = dict(zip(self.fields, row))
+        # A late upload of older readings doesn't replace the latest one
+        latest: Optional[Dict[str, Any]] = self.latest.get(device)
+        if latest is None or reading['timestamp'] >= latest['timestamp']:
+            self.latest[device] = reading
+
+    def add_rows(self, table: str, rows: List[Tuple]) -> None:
+        """
+        Appends new rows, ignoring rows that are already cached.
+        """
+        with self.lock:
+            for row in rows:
+                if row[0] <= self.last_id:
+                    continue
+                self.append(row)
+                self.last_id = row[0]
+
+    def refresh(self, conn: sqlite3.Connection) -> None:
+        """
+        Reads the rows added since the cached max(id).
+        """
+        rows: List[Tuple] = conn.execute(f'''
+            SELECT {', '.join(self.fields)} FROM {self.table} WHERE id > ? ORDER BY id
+        ''', (self.last_id,)).fetchall()
+        self.add_rows(self.table, rows)
+
+    def get_latest(self, device: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the latest reading of a device.
+        """
+        with self.lock:
+            return self.latest.get(device)
+
+    def get_all_latest(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the latest reading of every device.
+        """
+        with self.lock:
+            return dict(self.latest)
+
+    def get_window(self, device: str, start: int, end: int) -> Optional[Dict[str, List[Any]]]:
+        """
+        Returns the readings of a device between start and end, or None when the ring doesn't cover start.
+        """
+        with self.lock:
+            ring: Optional[RecentRing] = self.rings.get(device)
+            if ring is None:
+                return None
+            oldest: Optional[int] = ring.oldest_timestamp()
+            if not self.complete[device] and (oldest is None or start < oldest):
+                return None
+            return ring.window(start, end)
@@ -1,8 +1,12 @@
 import sqlite3
 import time
 import logging
-from datetime import datetime
+import configparser
+from typing import Dict, List, Optional
 import os
+from aggregates import ROLLUP_LEVELS
+from database import configure_connection, open_database, write_transaction
+from readings import drop_partition, list_partitions, now_ms, setup_readings
 
 # Ensure the logging directory exists
 LOGGING_DIR = 'logging'
@@ -12,54 +16,242 @@ os.makedirs(LOGGING_DIR, exist_ok=True)
 LOG_FILE = os.path.join(LOGGING_DIR, 'cleanup.log')
 logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Path to the database
-DB_PATH = 'sensor_data.db'
+# Load configurations from config.ini
+config = configparser.ConfigParser()
+config.read('config.ini')
 
-def delete_oldest_records(cursor: sqlite3.Cursor, table_name: str, record_limit: int = 100) -> None:
+class RetentionPolicy:
     """
-    Deletes the oldest records from the specified table.
-    
+    Limits for one device: readings older than max_age_days or beyond the newest max_rows are deleted.
+    A limit of 0 disables it.
+    """
+
+    def __init__(self, device_id: str, max_age_days: float, max_rows: int) -> None:
+        self.device_id: str = device_id
+        self.max_age_days: float = max_age_days
+        self.max_rows: int = max_rows
+
+def load_policies(config: configparser.ConfigParser, devices: List[str]) -> List[RetentionPolicy]:
+    """
+    Reads the retention policy of every device. The RETENTION section holds the defaults,
+    a RETENTION:<device_id> section overrides them for one device.
+
     Parameters:
-    cursor (sqlite3.Cursor): The cursor object.
-    table_name (str): The name of the table from which to delete records.
-    record_limit (int): The number of oldest records to delete.
-    """
-    cursor.execute(f'''
-        DELETE FROM {table_name} WHERE id IN (
-        SELECT id 
-        FROM {table_name} 
-        ORDER BY timestamp 
-        LIMIT ?
-        )
-    ''', (record_limit,))
-    logging.info(f'Deleted {record_limit} oldest records from {table_name}')
+    config (configparser.ConfigParser): The loaded configuration.
+    devices (List[str]): The ids of the registered devices.
 
-def main() -> None:
+    Returns:
+        List[RetentionPolicy]: One policy per device.
     """
-    Main function to periodically delete the oldest records from the database tables.
+    policies: List[RetentionPolicy] = []
+    for device_id in devices:
+        section: str = f'RETENTION:{device_id}' if config.has_section(f'RETENTION:{device_id}') else 'RETENTION'
+        policies.append(RetentionPolicy(
+            device_id,
+            config.getfloat(section, 'max_age_days', fallback=config.getfloat('RETENTION', 'max_age_days')),
+            config.getint(section, 'max_rows', fallback=config.getint('RETENTION', 'max_rows')),
+        ))
+    return policies
+
+def table_exists(cursor: sqlite3.Cursor, table_name: str) -> bool:
+    """
+    Returns whether a table exists in the database.
+    """
+    cursor.execute('SELECT name FROM sqlite_master WHERE type = ? AND name = ?', ('table', table_name))
+    return cursor.fetchone() is not None
+
+def delete_in_chunks(conn: sqlite3.Connection, table_name: str, where: str, order_by: str, limit: Optional[int],
+                     params: tuple, chunk_size: int, pause: float) -> int:
     """
-    while True:
-        try:
-            conn: sqlite3.Connection = sqlite3.connect(DB_PATH)
-            cursor: sqlite3.Cursor = conn.cursor()
+    Deletes matching rows in chunks of chunk_size, committing after every chunk,
+    so the write lock is only held briefly and the ingest scripts can write in between.
+
+    Parameters:
+    conn (sqlite3.Connection): The database connection.
+    table_name (str): The table to delete from.
+    where (str): The condition of the rows to delete.
+    order_by (str): The column that decides which rows go first.
+    limit (Optional[int]): The maximum number of rows to delete, None for all matching rows.
+    params (tuple): The parameters of the condition.
+    chunk_size (int): The number of rows deleted per transaction.
+    pause (float): Seconds to sleep between chunks.
 
-            # Delete oldest records from sensor_data table
-            delete_oldest_records(cursor, 'sensor_data')
+    Returns:
+        int: The number of deleted rows.
+    """
+    deleted: int = 0
+    while limit is None or deleted < limit:
+        size: int = chunk_size if limit is None else min(chunk_size, limit - deleted)
+        with write_transaction(conn):
+            cursor: sqlite3.Cursor = conn.execute(f'''
+                DELETE FROM {table_name} WHERE id IN (
+                SELECT id
+                FROM {table_name}
+                WHERE {where}
+                ORDER BY {order_by}
+                LIMIT ?
+                )
+            ''', params + (size,))
+        deleted += cursor.rowcount
+        if cursor.rowcount < size:
+            break
+        time.sleep(pause)
+    return deleted
+
+def row_count(cursor: sqlite3.Cursor, device_id: str) -> int:
+    """
+    Returns the number of readings of a device, from the aggregates.
+    """
+    cursor.execute('SELECT count FROM sensor_aggregates WHERE device_id = ?', (device_id,))
+    row = cursor.fetchone()
+    return row[0] if row is not None else 0
+
+def age_cutoff(max_age_days: float) -> int:
+    """
+    Returns the timestamp in milliseconds before which readings are older than max_age_days.
+    """
+    return now_ms() - int(max_age_days * 24 * 60 * 60 * 1000)
+
+def drop_expired_partitions(conn: sqlite3.Connection, policies: List[RetentionPolicy]) -> int:
+    """
+    Drops the partitions that only hold readings every device's policy has expired.
+    Dropping a table frees its pages at once, without deleting its rows one by one.
+
+    Parameters:
+    conn (sqlite3.Connection): The database connection.
+    policies (List[RetentionPolicy]): The policies of all devices.
 
-            # Delete oldest records from second_sensor_data table
-            delete_oldest_records(cursor, 'second_sensor_data')
+    Returns:
+        int: The number of dropped readings.
+    """
+    # A device that keeps its readings forever keeps every partition
+    if not policies or any(policy.max_age_days <= 0 for policy in policies):
+        return 0
+    cutoff: int = min(age_cutoff(policy.max_age_days) for policy in policies)
+    cursor: sqlite3.Cursor = conn.cursor()
+    cursor.execute('SELECT name FROM reading_partitions WHERE end_ms < ? ORDER BY start_ms', (cutoff,))
+    dropped: int = 0
+    for (name,) in cursor.fetchall():
+        with write_transaction(conn):
+            count: int = drop_partition(conn.cursor(), name)
+        logging.info(f'Dropped partition {name} with {count} records')
+        dropped += count
+    return dropped
+
+def apply_policy(conn: sqlite3.Connection, policy: RetentionPolicy, chunk_size: int, pause: float) -> int:
+    """
+    Applies the retention policy of one device to the partitions that are left after the expired ones
+    were dropped. The deletes walk the (device_id, timestamp) index of each partition, oldest first.
+
+    Parameters:
+    conn (sqlite3.Connection): The database connection.
+    policy (RetentionPolicy): The limits of the device.
+    chunk_size (int): The number of rows deleted per transaction.
+    pause (float): Seconds to sleep between chunks.
+
+    Returns:
+        int: The number of deleted rows.
+    """
+    cursor: sqlite3.Cursor = conn.cursor()
+    deleted: int = 0
+    if policy.max_age_days > 0:
+        cutoff: int = age_cutoff(policy.max_age_days)
+        for partition in list_partitions(cursor, 0, cutoff):
+            deleted += delete_in_chunks(conn, partition, 'device_id = ? AND timestamp < ?', 'timestamp', None,
+                                        (policy.device_id, cutoff), chunk_size, pause)
+        # Aggregates of the edge pre-processing are one row per interval, so they go in one transaction.
+        # The rollups keep their statistics, like those of deleted readings
+        if table_exists(cursor, 'edge_aggregates'):
+            with write_transaction(conn):
+                cursor.execute('DELETE FROM edge_aggregates WHERE device_id = ? AND end_ms < ?', (policy.device_id, cutoff))
+            deleted += cursor.rowcount
+
+    if policy.max_rows > 0:
+        excess: int = row_count(cursor, policy.device_id) - policy.max_rows
+        for partition in list_partitions(cursor):
+            if excess <= 0:
+                break
+            removed: int = delete_in_chunks(conn, partition, 'device_id = ?', 'timestamp', excess,
+                                            (policy.device_id,), chunk_size, pause)
+            excess -= removed
+            deleted += removed
+
+    logging.info(f'Deleted {deleted} records of {policy.device_id}')
+    return deleted
+
+def prune_rollups(conn: sqlite3.Connection, max_age_days: Dict[str, float]) -> None:
+    """
+    Deletes rollup buckets older than the configured age per rollup level (0 keeps them forever).
+    """
+    cursor: sqlite3.Cursor = conn.cursor()
+    for level, days in max_age_days.items():
+        if days <= 0 or not table_exists(cursor, f'sensor_rollup_{level}'):
+            continue
+        cutoff: int = age_cutoff(days) // ROLLUP_LEVELS[level] * ROLLUP_LEVELS[level]
+        with write_transaction(conn):
+            cursor.execute(f'DELETE FROM sensor_rollup_{level} WHERE bucket < ?', (cutoff,))
+        if cursor.rowcount > 0:
+            logging.info(f'Deleted {cursor.rowcount} {level} rollups')
+
+def enable_incremental_vacuum(conn: sqlite3.Connection) -> None:
+    """
+    Switches the database to incremental auto-vacuum. This needs one full VACUUM, which is only done once.
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        logging.info('Converting database to incremental auto-vacuum, running a full VACUUM once')
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+
+def reclaim_space(conn: sqlite3.Connection, pages: int) -> None:
+    """
+    Returns up to pages free pages to the file system (0 for all of them).
+    """
+    free_pages: int = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    if free_pages > 0:
+        # The pragma frees one page per step and execute() only steps it once, executescript runs it to completion
+        conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})' if pages > 0 else 'PRAGMA incremental_vacuum')
+        logging.info(f'Reclaimed {free_pages if pages <= 0 else min(pages, free_pages)} free pages')
+
+def main() -> None:
+    """
+    Main function to periodically apply the retention policies to the database tables.
+    """
+    interval: float = config.getfloat('RETENTION', 'interval')
+    chunk_size: int = config.getint('RETENTION', 'chunk_size')
+    pause: float = config.getfloat('RETENTION', 'chunk_pause')
+    vacuum_pages: int = config.getint('RETENTION', 'vacuum_pages')
+    rollup_max_age: Dict[str, float] = {
+        level: config.getfloat('RETENTION', f'rollup_{level}_max_age_days', fallback=0) for level in ROLLUP_LEVELS
+    }
+    # isolation_level=None: transactions are opened explicitly by the with blocks, so VACUUM can run
+    conn: sqlite3.Connection = open_database(config, isolation_level=None)
+    configure_connection(conn, config)
+    if config.getboolean('RETENTION', 'incremental_vacuum'):
+        enable_incremental_vacuum(conn)
+    conn.isolation_level = ''
+    with write_transaction(conn):
+        setup_readings(conn.cursor(), config)
 
-            # Commit changes
-            conn.commit()
-            logging.info('Oldest records deleted successfully')
+    try:
+        while True:
+            try:
+                # Devices register themselves with their first reading, so the policies are read on every run
+                devices: List[str] = [row[0] for row in conn.execute('SELECT device_id FROM devices ORDER BY device_id')]
+                policies: List[RetentionPolicy] = load_policies(config, devices)
+                drop_expired_partitions(conn, policies)
+                for policy in policies:
+                    apply_policy(conn, policy, chunk_size, pause)
+                prune_rollups(conn, rollup_max_age)
+                if config.getboolean('RETENTION', 'incremental_vacuum'):
+                    reclaim_space(conn, vacuum_pages)
+                logging.info('Retention policies applied successfully')
 
-        except sqlite3.Error as e:
-            logging.error(f"SQLite error: {e}")
-        finally:
-            conn.close()
+            except sqlite3.Error as e:
+                logging.error(f"SQLite error: {e}")
 
-        # Wait for 1 hour
-        time.sleep(3600)
+            time.sleep(interval)
+    finally:
+        conn.close()
 
 if __name__ == "__main__":
     logging.info('Cleanup script started')
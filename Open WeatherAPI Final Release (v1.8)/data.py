@@ -1,53 +1,29 @@
+import time
 import serial
 import sqlite3
 from typing import Any
 import configparser
 from datetime import datetime
+from database import configure_connection, open_database, write_transaction
+from ingest import IngestBuffer, create_buffer
+from metrics import start_metrics_server
+from readings import insert_readings, legacy_tables, now_ms, partition_granularity, setup_readings
 
-def create_table(cursor: sqlite3.Cursor) -> None:
+def create_table(cursor: sqlite3.Cursor, config: configparser.ConfigParser) -> None:
     """
-    Creates sensor_data and users tables if they do not exist.
-    Also creates the average_data table to store calculated averages.
+    Creates the partition registry, the readings view and the device registry if they do not exist.
+    Also creates the aggregate and rollup tables that are updated on every insert.
     """
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sensor_data (
-        id INTEGER PRIMARY KEY,
-        timestamp TEXT,
-        humidity REAL,
-        temperature REAL,
-        light_level REAL
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS average_data (
-        id INTEGER PRIMARY KEY,
-        average_humidity REAL,
-        average_temperature REAL,
-        average_light_level REAL
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TRIGGER IF NOT EXISTS update_average_data
-        AFTER INSERT ON sensor_data
-        BEGIN
-            DELETE FROM average_data;
-            INSERT INTO average_data (average_humidity, average_temperature, average_light_level)
-            SELECT ROUND(AVG(humidity), 2), ROUND(AVG(temperature), 2), ROUND(AVG(light_level), 2)
-            FROM sensor_data;
-        END;
-    ''')
+    setup_readings(cursor, config)
+    if legacy_tables(cursor):
+        print("Found tables of an older version, run migrate.py to move them into the partitioned readings")
 
-def insert_data(cursor: sqlite3.Cursor, humidity: float, temperature: float, light_level: float) -> None:
+def insert_data(cursor: sqlite3.Cursor, config: configparser.ConfigParser, device_id: str,
+                humidity: float, temperature: float, light_level: float) -> None:
     """
-    Inserts data into the sensor_data table.
+    Inserts a reading of a device into the partition of the current time.
     """
-    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    cursor.execute('''
-        INSERT INTO sensor_data (timestamp, humidity, temperature, light_level) VALUES (?, ?, ?, ?)
-    ''', 
-        (current_time, humidity, temperature, light_level))
+    insert_readings(cursor, [(device_id, now_ms(), humidity, temperature, light_level)], partition_granularity(config))
 
 def insert_user(cursor: sqlite3.Cursor, username: str, password: str) -> None:
     """
@@ -58,6 +34,20 @@ def insert_user(cursor: sqlite3.Cursor, username: str, password: str) -> None:
     ''', 
         (username, password))
 
+def flush_buffer(buffer: IngestBuffer, conn: sqlite3.Connection) -> bool:
+    """
+    Flushes the buffer, reporting a failed commit instead of raising. The readings stay in the buffer.
+
+    Returns:
+        bool: Whether the buffer was committed.
+    """
+    try:
+        buffer.flush(conn)
+    except sqlite3.Error as e:
+        print(f"Failed to store {buffer.pending()} readings:", e)
+        return False
+    return True
+
 def main() -> None:
     """
     Main function to create tables and read data from the serial port.
@@ -66,43 +56,65 @@ def main() -> None:
     config = configparser.ConfigParser()
     config.read('config.ini')
 
-    # Connect to SQLite database
-    db_path: str = config['DATABASE']['path']
-    conn: sqlite3.Connection = sqlite3.connect(db_path)
+    # Connect to SQLite database, this script is the only writer of its process
+    conn: sqlite3.Connection = open_database(config)
+    configure_connection(conn, config)
     cursor: sqlite3.Cursor = conn.cursor()
     
     # Create tables
-    create_table(cursor)
-    conn.commit()
+    with write_transaction(conn):
+        create_table(cursor, config)
+
+    # Readings are written in batches instead of one commit per line, tagged with the id of the Arduino
+    device_id: str = config['INGEST']['device_id']
+    buffer: IngestBuffer = create_buffer(config)
+
+    # Backoff after a failed commit, the serial port keeps being read in the meantime
+    retry_delay: float = config.getfloat('INGEST', 'retry_delay', fallback=1.0)
+    max_retry_delay: float = config.getfloat('INGEST', 'max_retry_delay', fallback=60.0)
+    delay: float = retry_delay
+    retry_at: float = 0.0
 
     try:
-        # Attempt to open serial port
+        # Attempt to open serial port, the timeout lets a partial batch be flushed when the sensor goes quiet
         serial_port: str = config['SERIAL_PORT']['port']
         baudrate: int = config.getint('SERIAL_PORT', 'baudrate')
-        ser: Any = serial.Serial(serial_port, baudrate)
+        ser: Any = serial.Serial(serial_port, baudrate, timeout=buffer.flush_interval)
     except serial.SerialException:
         print("Failed to open serial port. Continuing without it...")
         ser = None
 
     if ser:
+        start_metrics_server(config, 'data_port')
         try:
             while True:
                 data: str = ser.readline().decode('latin-1').strip()
-                print("Received at", datetime.now().strftime('%Y-%m-%d %H:%M:%S'), ":", data)
 
-                if 'Loading measurements...' in data:
-                    continue
-                
-                humidity, temperature, light_level = map(float, data.split(','))
-                
-                # Insert data into the sensor_data table
-                insert_data(cursor, humidity, temperature, light_level)
-                conn.commit()
+                if data and 'Loading measurements...' not in data:
+                    current_time: int = now_ms()
+                    print("Received at", datetime.fromtimestamp(current_time / 1000).strftime('%Y-%m-%d %H:%M:%S'), ":", data)
+                    try:
+                        humidity, temperature, light_level = map(float, data.split(','))
+                    except ValueError:
+                        print("Invalid data format:", data)
+                    else:
+                        buffer.add(device_id, current_time, humidity, temperature, light_level)
+
+                # Insert the buffered data into the partitions, a failed batch is retried after a growing delay
+                if buffer.due() and time.monotonic() >= retry_at:
+                    if flush_buffer(buffer, conn):
+                        delay = retry_delay
+                    else:
+                        print(f"Retrying in {delay:g} seconds")
+                        retry_at = time.monotonic() + delay
+                        delay = min(delay * 2, max_retry_delay)
         
         except KeyboardInterrupt:
             print("Stopping...")
         
         finally:
+            if not flush_buffer(buffer, conn):
+                print(f"Lost {buffer.pending()} readings on shutdown")
             conn.close()
     else:
         # If serial port is not available just exit
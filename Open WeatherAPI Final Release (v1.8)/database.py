@@ -0,0 +1,296 @@
+import os
+import time
+import sqlite3
+import threading
+import contextlib
+import configparser
+from urllib.request import pathname2url
+from typing import IO, Any, Callable, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock, the lock file is locked with msvcrt instead
+    fcntl = None
+    import msvcrt
+
+# Values accepted for the PRAGMAs that can be set from config.ini
+JOURNAL_MODES: Tuple[str, ...] = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_MODES: Tuple[str, ...] = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# Seconds between two attempts to take the write lock file of a database
+LOCK_POLL_INTERVAL: float = 0.01
+
+
+def connect(path: str, busy_timeout: float = 30.0, statement_cache: int = 256, read_only: bool = False,
+            factory: type = sqlite3.Connection, **kwargs: Any) -> sqlite3.Connection:
+    """
+    Opens a connection that waits up to busy_timeout seconds for a lock instead of failing with
+    "database is locked", and keeps up to statement_cache prepared statements.
+
+    Read-only connections are opened with a mode=ro URI and query_only, so a reader can never take
+    the write lock, not even by accident.
+
+    Parameters:
+    path (str): The database file.
+    busy_timeout (float): Seconds to wait for a lock.
+    statement_cache (int): The number of prepared statements cached by the connection.
+    read_only (bool): Whether to open the database read-only.
+    factory (type): The connection class.
+    kwargs (Any): Further arguments of sqlite3.connect, like check_same_thread or isolation_level.
+
+    Returns:
+        sqlite3.Connection: The connection.
+    """
+    if read_only:
+        uri: str = f'file:{pathname2url(os.path.abspath(path))}?mode=ro'
+        conn: sqlite3.Connection = sqlite3.connect(uri, uri=True, timeout=busy_timeout, cached_statements=statement_cache,
+                                                   factory=factory, **kwargs)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+    return sqlite3.connect(path, timeout=busy_timeout, cached_statements=statement_cache, factory=factory, **kwargs)
+
+def open_database(config: configparser.ConfigParser, read_only: bool = False, **kwargs: Any) -> sqlite3.Connection:
+    """
+    Opens the database of config.ini with the busy timeout and statement cache of its DATABASE section.
+    """
+    return connect(
+        config['DATABASE']['path'],
+        config.getfloat('DATABASE', 'busy_timeout', fallback=30.0),
+        config.getint('DATABASE', 'statement_cache', fallback=256),
+        read_only,
+        **kwargs,
+    )
+
+def configure_connection(conn: sqlite3.Connection, config: configparser.ConfigParser) -> None:
+    """
+    Applies the journal mode and durability settings from the INGEST section of config.ini.
+
+    With WAL and synchronous = NORMAL a commit no longer waits for an fsync, at the
+    cost of possibly losing the last transactions on a power cut (the database itself
+    stays consistent). synchronous = FULL restores a sync on every commit.
+
+    Parameters:
+    conn (sqlite3.Connection): The connection to configure.
+    config (configparser.ConfigParser): The loaded configuration.
+    """
+    journal_mode: str = config.get('INGEST', 'journal_mode', fallback='WAL').upper()
+    synchronous: str = config.get('INGEST', 'synchronous', fallback='NORMAL').upper()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"Invalid journal_mode in config.ini: {journal_mode}")
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(f"Invalid synchronous setting in config.ini: {synchronous}")
+    conn.execute(f'PRAGMA journal_mode = {journal_mode}')
+    conn.execute(f'PRAGMA synchronous = {synchronous}')
+
+def lock_path(conn: sqlite3.Connection) -> Optional[str]:
+    """
+    Returns the path of the write lock file of the database of a connection, None for an in-memory database.
+    """
+    for _, name, path in conn.execute('PRAGMA database_list'):
+        if name == 'main' and path:
+            return path + '.lock'
+    return None
+
+def try_lock(lock_file: IO[bytes]) -> bool:
+    """
+    Tries to lock a lock file exclusively without waiting, returns whether it succeeded.
+    """
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+@contextlib.contextmanager
+def writer_lock(conn: sqlite3.Connection) -> Iterator[None]:
+    """
+    Holds the write lock file next to the database (<database>.lock) while the block runs.
+
+    data.py, laptop_server.py, cleanup.py, migrate.py and the web process each have their own write
+    connection. SQLite lets only one of them write at a time, but a writer that finds the database locked
+    sleeps in the busy handler and can lose the race to a process that keeps writing. Every write
+    transaction takes this lock first, so the processes write strictly one after the other. Like the busy
+    handler the lock is waited for up to the busy timeout of the connection, then "database is locked"
+    is raised.
+    """
+    path: Optional[str] = lock_path(conn)
+    if path is None:
+        yield
+        return
+    timeout: float = conn.execute('PRAGMA busy_timeout').fetchone()[0] / 1000
+    deadline: float = time.monotonic() + timeout
+    # Every transaction opens the file again, flock locks belong to the open file, not to the process
+    with open(path, 'a+b') as lock_file:
+        while not try_lock(lock_file):
+            if time.monotonic() >= deadline:
+                raise sqlite3.OperationalError('database is locked (write lock file held by another writer)')
+            time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            # Closing the file releases a flock, msvcrt locks are released explicitly
+            if fcntl is None:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+@contextlib.contextmanager
+def write_transaction(conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    """
+    Runs a block in a transaction that takes the write lock up front with BEGIN IMMEDIATE and commits it,
+    or rolls it back on an error. The write lock file of writer_lock is held around the transaction,
+    so only one process writes at a time.
+
+    A deferred transaction that reads first and writes later can't wait for the lock when another
+    process committed in between and fails with "database is locked" at once. An immediate one waits
+    for the busy timeout before it has done anything, so every writer queues up behind the current one.
+    Inside a transaction that is already open the block simply joins it.
+    """
+    if conn.in_transaction:
+        yield conn
+        return
+    with writer_lock(conn):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+class ConnectionPool:
+    """
+    Keeps up to size idle connections of a process for reuse, so a request doesn't pay for opening
+    the database and its statement cache stays warm. More connections are opened when all are in use,
+    the surplus is closed when they are released.
+    """
+
+    def __init__(self, path: str, size: int, read_only: bool = False, busy_timeout: float = 30.0,
+                 statement_cache: int = 256, factory: type = sqlite3.Connection) -> None:
+        self.path: str = path
+        self.size: int = max(size, 0)
+        self.read_only: bool = read_only
+        self.busy_timeout: float = busy_timeout
+        self.statement_cache: int = statement_cache
+        self.factory: type = factory
+        self.idle: List[sqlite3.Connection] = []
+        self.lock: threading.Lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Opens a new connection with the settings of the pool, for a thread that keeps its own.
+        """
+        # A pooled connection is used by one thread at a time, but not always by the same one
+        return connect(self.path, self.busy_timeout, self.statement_cache, self.read_only, self.factory,
+                       check_same_thread=False)
+
+    def acquire(self) -> sqlite3.Connection:
+        """
+        Returns the most recently released connection, or a new one when none is idle.
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self.connect()
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        """
+        Returns a connection to the pool, rolling back what its user left open.
+        """
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = None
+        except sqlite3.Error:
+            conn.close()
+            return
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self) -> None:
+        """
+        Closes the idle connections.
+        """
+        with self.lock:
+            idle: List[sqlite3.Connection] = self.idle
+            self.idle = []
+        for conn in idle:
+            conn.close()
+
+class DatabaseWriter:
+    """
+    The single write connection of a process. Threads take turns through a lock and every transaction
+    takes the write lock file and SQLite's write lock up front, so writes of this process never compete
+    with each other and wait for those of the other processes.
+    """
+
+    def __init__(self, path: str, busy_timeout: float = 30.0, statement_cache: int = 256,
+                 setup: Optional[Callable[[sqlite3.Connection], None]] = None) -> None:
+        self.path: str = path
+        self.busy_timeout: float = busy_timeout
+        self.statement_cache: int = statement_cache
+        # Called once with the connection when it is opened, like configure_connection
+        self.setup: Optional[Callable[[sqlite3.Connection], None]] = setup
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock: threading.Lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Runs a block in a write transaction on the write connection.
+        """
+        with self.lock:
+            if self.conn is None:
+                self.conn = connect(self.path, self.busy_timeout, self.statement_cache, check_same_thread=False)
+                if self.setup is not None:
+                    self.setup(self.conn)
+            with write_transaction(self.conn):
+                yield self.conn
+
+    def close(self) -> None:
+        """
+        Closes the write connection.
+        """
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+def create_pool(config: configparser.ConfigParser, read_only: bool, factory: type = sqlite3.Connection) -> ConnectionPool:
+    """
+    Creates a ConnectionPool using the DATABASE section of config.ini.
+    """
+    return ConnectionPool(
+        config['DATABASE']['path'],
+        config.getint('DATABASE', 'pool_size', fallback=8),
+        read_only,
+        config.getfloat('DATABASE', 'busy_timeout', fallback=30.0),
+        config.getint('DATABASE', 'statement_cache', fallback=256),
+        factory,
+    )
+
+def create_writer(config: configparser.ConfigParser) -> DatabaseWriter:
+    """
+    Creates the DatabaseWriter of a process using the DATABASE section of config.ini.
+    The write connection gets the journal mode and durability settings of the INGEST section.
+    """
+    return DatabaseWriter(
+        config['DATABASE']['path'],
+        config.getfloat('DATABASE', 'busy_timeout', fallback=30.0),
+        config.getint('DATABASE', 'statement_cache', fallback=256),
+        lambda conn: configure_connection(conn, config),
+    )
+
+def is_busy_error(error: sqlite3.Error) -> bool:
+    """
+    Returns whether an error means the database stayed locked for longer than the busy timeout.
+    """
+    message: str = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
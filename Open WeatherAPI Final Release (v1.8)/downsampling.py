@@ -0,0 +1,270 @@
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from aggregates import ROLLUP_LEVELS
+from readings import range_source
+
+# Columns that can be plotted on the sensor graph
+SERIES_COLUMNS: Tuple[str, ...] = ('temperature', 'humidity', 'light_level')
+
+def bucket_width(start: int, end: int, max_points: int) -> int:
+    """
+    Calculates the width in milliseconds of one bucket so that the range is covered by at most max_points buckets.
+
+    Parameters:
+    start (int): Start of the range in milliseconds since the epoch.
+    end (int): End of the range in milliseconds since the epoch.
+    max_points (int): The maximum number of buckets.
+
+    Returns:
+        int: The bucket width in milliseconds (at least 1).
+    """
+    span: int = max(end - start, 0) + 1
+    return max(1, -(-span // max(max_points, 1)))
+
+def rollup_for_width(width: int) -> Optional[str]:
+    """
+    Returns the coarsest rollup level whose buckets fit into a bucket of width milliseconds, or None.
+    """
+    levels: List[str] = [level for level, level_width in ROLLUP_LEVELS.items() if level_width <= width]
+    return max(levels, key=ROLLUP_LEVELS.__getitem__) if levels else None
+
+def empty_series() -> Dict[str, List[Optional[float]]]:
+    """
+    Returns the lists of bucketed_series without any buckets.
+    """
+    series: Dict[str, List[Optional[float]]] = {'timestamps': []}
+    for column in SERIES_COLUMNS:
+        series[column] = []
+        series[f'{column}_min'] = []
+        series[f'{column}_max'] = []
+        series[f'{column}_timestamps'] = series['timestamps']
+    return series
+
+def fill_series(series: Dict[str, List[Optional[float]]], rows: Iterable[Tuple]) -> Dict[str, List[Optional[float]]]:
+    """
+    Adds (bucket, timestamp, then avg, min and max of every series) rows to the lists of bucketed_series.
+    """
+    for row in rows:
+        series['timestamps'].append(row[1])
+        for offset, column in enumerate(SERIES_COLUMNS):
+            series[column].append(row[2 + offset * 3])
+            series[f'{column}_min'].append(row[3 + offset * 3])
+            series[f'{column}_max'].append(row[4 + offset * 3])
+    return series
+
+def rollup_series(cursor: sqlite3.Cursor, device_id: str, start: int, end: int, first: int, width: int,
+                  level: str) -> Dict[str, List[Optional[float]]]:
+    """
+    Downsamples a range from a rollup table, merging its buckets into buckets of width milliseconds.
+    The rollup buckets at the ends of the range may hold a few readings just outside it.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    device_id (str): The device whose readings are plotted.
+    start (int): Start of the range in milliseconds since the epoch.
+    end (int): End of the range in milliseconds since the epoch.
+    first (int): Start of the first bucket, the first reading of the device when the range starts earlier.
+    width (int): The bucket width in milliseconds, at least the width of the rollup level.
+    level (str): The rollup level.
+
+    Returns:
+        Dict[str, List[Optional[float]]]: The lists of bucketed_series.
+    """
+    level_width: int = ROLLUP_LEVELS[level]
+    aggregates: str = ', '.join(
+        f'ROUND(SUM(sum_{column}) / NULLIF(SUM(count_{column}), 0), 2), MIN(min_{column}), MAX(max_{column})'
+        for column in SERIES_COLUMNS
+    )
+    first = first // level_width * level_width
+    cursor.execute(f'''
+        SELECT (bucket - ?) / ? AS slot, MIN(bucket), {aggregates}
+        FROM sensor_rollup_{level}
+        WHERE device_id = ? AND bucket BETWEEN ? AND ?
+        GROUP BY slot
+        ORDER BY slot
+    ''', (first, width, device_id, max(start // level_width * level_width, first), end))
+    return fill_series(empty_series(), cursor)
+
+def bucketed_series(cursor: sqlite3.Cursor, device_id: str, start: int, end: int,
+                    max_points: int) -> Dict[str, List[Optional[float]]]:
+    """
+    Downsamples the readings of a device to at most max_points buckets by grouping on time inside SQLite.
+
+    Every bucket reports the average, minimum and maximum of each series, so the
+    number of rows handed to Python is bounded no matter how many readings the
+    range contains. Only the partitions overlapping the range are read, and a range
+    whose buckets are a minute or wider is read from the coarsest rollup table that
+    fits instead, so a wide range costs as much as a narrow one.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    device_id (str): The device whose readings are plotted.
+    start (int): Start of the range in milliseconds since the epoch.
+    end (int): End of the range in milliseconds since the epoch.
+    max_points (int): The maximum number of points per series.
+
+    Returns:
+        Dict[str, List[Optional[float]]]: 'timestamps' plus '<column>', '<column>_min', '<column>_max'
+        and '<column>_timestamps' lists (the latter all share the bucket timestamps).
+    """
+    # The registry knows the first and last reading of the device, which bound the range that has data
+    cursor.execute('SELECT first_seen, last_seen FROM devices WHERE device_id = ?', (device_id,))
+    seen: Optional[Tuple[Optional[int], Optional[int]]] = cursor.fetchone()
+    if seen is None or seen[0] is None or max(start, seen[0]) > min(end, seen[1]):
+        return empty_series()
+    width: int = bucket_width(max(start, seen[0]), min(end, seen[1]), max_points)
+    level: Optional[str] = rollup_for_width(width)
+    if level is not None:
+        return rollup_series(cursor, device_id, start, end, max(start, seen[0]), width, level)
+
+    source: str = range_source(cursor, start, end)
+    cursor.execute(f'''
+        SELECT MIN(timestamp), MAX(timestamp)
+        FROM {source}
+        WHERE device_id = ? AND timestamp BETWEEN ? AND ?
+    ''', (device_id, start, end))
+    first, last = cursor.fetchone()
+    if first is None:
+        return empty_series()
+
+    width = bucket_width(first, last, max_points)
+    aggregates: str = ', '.join(
+        f'ROUND(AVG({column}), 2), MIN({column}), MAX({column})' for column in SERIES_COLUMNS
+    )
+    cursor.execute(f'''
+        SELECT (timestamp - ?) / ? AS bucket, MIN(timestamp), {aggregates}
+        FROM {source}
+        WHERE device_id = ? AND timestamp BETWEEN ? AND ?
+        GROUP BY bucket
+        ORDER BY bucket
+    ''', (first, width, device_id, start, end))
+    return fill_series(empty_series(), cursor)
+
+def lttb(x: Sequence[float], y: Sequence[float], threshold: int) -> List[int]:
+    """
+    Selects the indices of the points to keep using Largest-Triangle-Three-Buckets.
+
+    Parameters:
+    x (Sequence[float]): The x values in ascending order.
+    y (Sequence[float]): The y values.
+    threshold (int): The number of points to keep.
+
+    Returns:
+        List[int]: The indices of the selected points in ascending order.
+    """
+    length: int = len(x)
+    if threshold >= length:
+        return list(range(length))
+    if threshold < 3:
+        return [0, length - 1][:max(threshold, 1)]
+
+    selected: List[int] = [0]
+    every: float = (length - 2) / (threshold - 2)
+    a: int = 0
+    for i in range(threshold - 2):
+        # Average point of the next bucket is the third vertex of the triangle
+        avg_start: int = int((i + 1) * every) + 1
+        avg_end: int = min(int((i + 2) * every) + 1, length)
+        avg_count: int = avg_end - avg_start
+        avg_x: float = sum(x[avg_start:avg_end]) / avg_count
+        avg_y: float = sum(y[avg_start:avg_end]) / avg_count
+
+        # Pick the point of the current bucket that forms the largest triangle
+        range_start: int = int(i * every) + 1
+        range_end: int = int((i + 1) * every) + 1
+        point_ax: float = x[a]
+        point_ay: float = y[a]
+        max_area: float = -1.0
+        next_a: int = range_start
+        for j in range(range_start, range_end):
+            area: float = abs((point_ax - avg_x) * (y[j] - point_ay) - (point_ax - x[j]) * (avg_y - point_ay))
+            if area > max_area:
+                max_area = area
+                next_a = j
+        selected.append(next_a)
+        a = next_a
+
+    selected.append(length - 1)
+    return selected
+
+def lttb_series(cursor: sqlite3.Cursor, device_id: str, start: int, end: int,
+                max_points: int, max_input: int) -> Dict[str, List[Optional[float]]]:
+    """
+    Downsamples every series of a device separately with LTTB.
+
+    LTTB keeps the visual shape of a series (peaks and dips) better than bucket
+    averages, but it needs its input in memory. The range is first bucketed in
+    SQLite into at most max_input points, which leaves a short range untouched
+    and keeps a long one from loading its whole history into Python.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    device_id (str): The device whose readings are plotted.
+    start (int): Start of the range in milliseconds since the epoch.
+    end (int): End of the range in milliseconds since the epoch.
+    max_points (int): The maximum number of points per series.
+    max_input (int): The maximum number of points handed to LTTB.
+
+    Returns:
+        Dict[str, List[Optional[float]]]: '<column>' and '<column>_timestamps' lists for every series.
+    """
+    buckets: Dict[str, List[Optional[float]]] = bucketed_series(cursor, device_id, start, end, max(max_input, max_points))
+    return lttb_columns(buckets['timestamps'], {column: buckets[column] for column in SERIES_COLUMNS}, max_points)
+
+def lttb_columns(timestamps: List[int], columns: Dict[str, List[float]],
+                 max_points: int) -> Dict[str, List[Optional[float]]]:
+    """
+    Downsamples series that are already in memory with LTTB, each series separately.
+    Missing values (None) are left out of their series.
+
+    Parameters:
+    timestamps (List[int]): The timestamps of the readings in milliseconds since the epoch.
+    columns (Dict[str, List[float]]): The values per series.
+    max_points (int): The maximum number of points per series.
+
+    Returns:
+        Dict[str, List[Optional[float]]]: '<column>' and '<column>_timestamps' lists for every series.
+    """
+    series: Dict[str, List[Optional[float]]] = {}
+    for column in SERIES_COLUMNS:
+        present: List[int] = [i for i, value in enumerate(columns[column]) if value is not None]
+        values: List[float] = [columns[column][i] for i in present]
+        times: List[int] = [timestamps[i] for i in present]
+        indices: List[int] = lttb(times, values, max_points)
+        series[column] = [values[i] for i in indices]
+        series[f'{column}_timestamps'] = [times[i] for i in indices]
+    return series
+
+def bucketed_columns(timestamps: List[int], columns: Dict[str, List[float]],
+                     max_points: int) -> Dict[str, List[Optional[float]]]:
+    """
+    Downsamples series that are already in memory into at most max_points time buckets.
+    Produces the same keys as bucketed_series, missing values (None) are left out of the statistics.
+
+    Parameters:
+    timestamps (List[int]): The timestamps of the readings in milliseconds since the epoch, ascending.
+    columns (Dict[str, List[float]]): The values per series.
+    max_points (int): The maximum number of points per series.
+
+    Returns:
+        Dict[str, List[Optional[float]]]: The bucket timestamps and avg/min/max per series.
+    """
+    series: Dict[str, List[Optional[float]]] = empty_series()
+    if not timestamps:
+        return series
+
+    width: int = bucket_width(timestamps[0], timestamps[-1], max_points)
+    buckets: List[int] = [(timestamp - timestamps[0]) // width for timestamp in timestamps]
+    first: int = 0
+    for index in range(1, len(timestamps) + 1):
+        # Close the bucket when the next reading falls into another one
+        if index < len(timestamps) and buckets[index] == buckets[first]:
+            continue
+        series['timestamps'].append(timestamps[first])
+        for column in SERIES_COLUMNS:
+            values: List[float] = [value for value in columns[column][first:index] if value is not None]
+            series[column].append(round(sum(values) / len(values), 2) if values else None)
+            series[f'{column}_min'].append(min(values, default=None))
+            series[f'{column}_max'].append(max(values, default=None))
+        first = index
+    return series
@@ -0,0 +1,154 @@
+import configparser
+from typing import List, Optional, Tuple, Union
+
+# A reading of the sensor: (timestamp, humidity, temperature, light_level), timestamp in seconds since the epoch
+Reading = Tuple[float, float, float, float]
+# The readings of one interval: (start, end, count, then min, avg, max of humidity, temperature and light level)
+Aggregate = Tuple[float, float, int, float, float, float, float, float, float, float, float, float]
+Record = Union[Reading, Aggregate]
+
+# Number of values of a reading
+VALUE_COUNT: int = 3
+
+class Deadband:
+    """
+    Drops records whose values all stay within their threshold of the last record that was let through.
+    A record is still let through every heartbeat seconds, so the server can tell a steady sensor from a silent one.
+    """
+
+    def __init__(self, thresholds: Tuple[float, ...], heartbeat: float) -> None:
+        self.thresholds: Tuple[float, ...] = thresholds
+        self.heartbeat: float = heartbeat
+        self.last_time: Optional[float] = None
+        self.last_values: Tuple[float, ...] = ()
+
+    def accept(self, timestamp: float, values: Tuple[float, ...], lows: Tuple[float, ...],
+               highs: Tuple[float, ...]) -> bool:
+        """
+        Returns whether a record has to be sent and remembers it if so.
+
+        Parameters:
+        timestamp (float): The time of the record.
+        values (Tuple[float, ...]): The values that are sent, the averages for an aggregate.
+        lows (Tuple[float, ...]): The lowest value of each column, the values themselves for a reading.
+        highs (Tuple[float, ...]): The highest value of each column, the values themselves for a reading.
+
+        Returns:
+            bool: False when nothing moved further than its threshold since the last record that was sent.
+        """
+        if self.last_time is not None and 0 <= timestamp - self.last_time < self.heartbeat and all(
+            high - last <= threshold and last - low <= threshold
+            for low, high, last, threshold in zip(lows, highs, self.last_values, self.thresholds)
+        ):
+            return False
+        self.last_time = timestamp
+        self.last_values = values
+        return True
+
+class Aggregator:
+    """
+    Summarizes the readings of every interval of interval seconds, aligned to the epoch, into one aggregate
+    with their number and the minimum, average and maximum of every value.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval: float = interval
+        self.window_start: float = 0.0
+        self.readings: List[Reading] = []
+
+    def add(self, reading: Reading) -> Optional[Aggregate]:
+        """
+        Adds a reading and returns the aggregate of the previous interval when the reading starts a new one.
+        """
+        window_start: float = reading[0] // self.interval * self.interval
+        finished: Optional[Aggregate] = None
+        if self.readings and window_start != self.window_start:
+            finished = self.flush()
+        if not self.readings:
+            self.window_start = window_start
+        self.readings.append(reading)
+        return finished
+
+    def due(self, now: float) -> bool:
+        """
+        Returns whether the current interval has ended, so its aggregate needn't wait for the next reading.
+        """
+        return bool(self.readings) and now >= self.window_start + self.interval
+
+    def flush(self) -> Optional[Aggregate]:
+        """
+        Returns the aggregate of the buffered readings and starts a new interval, or None when there are none.
+        """
+        if not self.readings:
+            return None
+        readings: List[Reading] = self.readings
+        self.readings = []
+        statistics: List[float] = []
+        for column in range(1, VALUE_COUNT + 1):
+            values: List[float] = [reading[column] for reading in readings]
+            statistics += [min(values), sum(values) / len(values), max(values)]
+        return (readings[0][0], readings[-1][0], len(readings), *statistics)
+
+class EdgeProcessor:
+    """
+    The pre-processing stage of the client between the serial port and the outbox. Readings are
+    summarized per interval when an aggregator is set, and readings or aggregates that didn't move
+    past the deadband are dropped.
+    """
+
+    def __init__(self, deadband: Optional[Deadband], aggregator: Optional[Aggregator]) -> None:
+        self.deadband: Optional[Deadband] = deadband
+        self.aggregator: Optional[Aggregator] = aggregator
+
+    def filter(self, record: Optional[Record]) -> List[Record]:
+        """
+        Applies the deadband to a reading or aggregate and returns the records left to send.
+        """
+        if record is None:
+            return []
+        if self.deadband is None:
+            return [record]
+        if len(record) == VALUE_COUNT + 1:
+            values: Tuple[float, ...] = tuple(record[1:])
+            accepted: bool = self.deadband.accept(record[0], values, values, values)
+        else:
+            statistics: Tuple[float, ...] = tuple(record[3:])
+            accepted = self.deadband.accept(record[1], statistics[1::3], statistics[0::3], statistics[2::3])
+        return [record] if accepted else []
+
+    def add(self, reading: Reading) -> List[Record]:
+        """
+        Processes a reading of the sensor and returns the records that are ready to be sent.
+        """
+        if self.aggregator is None:
+            return self.filter(reading)
+        return self.filter(self.aggregator.add(reading))
+
+    def poll(self, now: float) -> List[Record]:
+        """
+        Returns the aggregate of an interval that has ended meanwhile, if it has to be sent.
+        """
+        if self.aggregator is None or not self.aggregator.due(now):
+            return []
+        return self.filter(self.aggregator.flush())
+
+def create_processor(config: configparser.ConfigParser) -> EdgeProcessor:
+    """
+    Creates an EdgeProcessor using the CLIENT section of config.ini. A deadband of 0 for a value only
+    drops repeated values, an aggregate_interval of 0 disables the aggregation.
+
+    Parameters:
+    config (configparser.ConfigParser): The loaded configuration.
+
+    Returns:
+        EdgeProcessor: The processor.
+    """
+    deadband: Optional[Deadband] = None
+    if config.getboolean('CLIENT', 'deadband', fallback=False):
+        deadband = Deadband(
+            tuple(config.getfloat('CLIENT', f'deadband_{column}', fallback=0.0)
+                  for column in ('humidity', 'temperature', 'light_level')),
+            config.getfloat('CLIENT', 'deadband_heartbeat', fallback=300.0),
+        )
+    interval: float = config.getfloat('CLIENT', 'aggregate_interval', fallback=0.0)
+    return EdgeProcessor(deadband, Aggregator(interval) if interval > 0 else None)
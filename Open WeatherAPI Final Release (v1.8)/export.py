@@ -0,0 +1,212 @@
+import io
+import csv
+import zlib
+import sqlite3
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from aggregates import AGGREGATE_COLUMNS, ROLLUP_LEVELS
+from database import ConnectionPool
+from readings import READING_FIELDS, list_partitions
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # pyarrow is optional, only Parquet exports need it
+    pyarrow = None
+
+EXPORT_FORMATS: Tuple[str, ...] = ('csv', 'parquet')
+
+# Columns of an exported rollup: the averages are computed from the stored sums
+ROLLUP_FIELDS: Tuple[str, ...] = ('device_id', 'bucket', 'count') + tuple(
+    f'{statistic}_{column}' for column in AGGREGATE_COLUMNS for statistic in ('avg', 'min', 'max')
+)
+
+# Tables that can be exported and their columns
+EXPORT_TABLES: Dict[str, Tuple[str, ...]] = {
+    'readings': READING_FIELDS,
+    **{f'rollup_{level}': ROLLUP_FIELDS for level in ROLLUP_LEVELS},
+}
+
+# Content type and file extension per format
+FORMAT_TYPES: Dict[str, Tuple[str, str]] = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+def parquet_available() -> bool:
+    """
+    Returns whether pyarrow could be imported.
+    """
+    return pyarrow is not None
+
+def export_queries(cursor: sqlite3.Cursor, table: str, device_id: Optional[str], start: int,
+                   end: int) -> List[Tuple[str, Tuple]]:
+    """
+    Returns the queries that read a table between start and end, in export order.
+    Readings are read per partition: by time through the (device_id, timestamp) index for one device,
+    by id for all devices, so SQLite never has to sort a partition. Rollups are read in key order.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    table (str): A key of EXPORT_TABLES.
+    device_id (Optional[str]): The device to export, or None for all devices.
+    start (int): Start of the range in milliseconds since the epoch.
+    end (int): End of the range in milliseconds since the epoch.
+
+    Returns:
+        List[Tuple[str, Tuple]]: (sql, parameters) pairs.
+    """
+    device_filter: str = 'device_id = ? AND ' if device_id is not None else ''
+    device_params: Tuple = (device_id,) if device_id is not None else ()
+    if table == 'readings':
+        order: str = 'timestamp' if device_id is not None else 'id'
+        return [(f'''
+            SELECT {', '.join(READING_FIELDS)}
+            FROM {partition}
+            WHERE {device_filter}timestamp BETWEEN ? AND ?
+            ORDER BY {order}
+        ''', device_params + (start, end)) for partition in list_partitions(cursor, start, end)]
+
+    level: str = table[len('rollup_'):]
+    columns: List[str] = ['device_id', 'bucket', 'count']
+    for column in AGGREGATE_COLUMNS:
+        columns += [f'sum_{column} / NULLIF(count_{column}, 0)', f'min_{column}', f'max_{column}']
+    return [(f'''
+        SELECT {', '.join(columns)}
+        FROM sensor_rollup_{level}
+        WHERE {device_filter}bucket BETWEEN ? AND ?
+        ORDER BY device_id, bucket
+    ''', device_params + (start, end))]
+
+def stream_rows(pool: ConnectionPool, table: str, device_id: Optional[str], start: int, end: int,
+                chunk_size: int) -> Iterator[List[Tuple]]:
+    """
+    Yields the rows of an export in chunks of chunk_size from a connection of its own taken from the pool.
+    The export reads one snapshot in a single read transaction, so a partition the cleanup drops
+    meanwhile is still exported; memory use is bounded by one chunk however many rows are exported.
+
+    Parameters:
+    pool (ConnectionPool): The pool of read connections.
+    table (str): A key of EXPORT_TABLES.
+    device_id (Optional[str]): The device to export, or None for all devices.
+    start (int): Start of the range in milliseconds since the epoch.
+    end (int): End of the range in milliseconds since the epoch.
+    chunk_size (int): Rows fetched per fetchmany call.
+
+    Yields:
+        List[Tuple]: The next chunk of rows.
+    """
+    # The response is streamed after the request has ended, so it can't use the request's connection
+    conn: sqlite3.Connection = pool.acquire()
+    try:
+        cursor: sqlite3.Cursor = conn.cursor()
+        cursor.execute('BEGIN')
+        for sql, params in export_queries(cursor, table, device_id, start, end):
+            cursor.execute(sql, params)
+            while True:
+                rows: List[Tuple] = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+    finally:
+        # Ends the read transaction, also when the client went away halfway
+        pool.release(conn)
+
+def csv_stream(columns: Tuple[str, ...], chunks: Iterator[List[Tuple]]) -> Iterator[bytes]:
+    """
+    Yields a header line and then the CSV lines of every chunk.
+    """
+    buffer: io.StringIO = io.StringIO()
+    writer: Any = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    # An empty export still has its header
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+def gzip_stream(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """
+    Compresses a stream into one gzip member chunk by chunk.
+    """
+    compressor: Any = zlib.compressobj(5, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed: bytes = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+class ParquetSink:
+    """
+    Write-only file for pyarrow's ParquetWriter that keeps the written bytes until they are taken,
+    so a Parquet file can be streamed row group by row group.
+    """
+
+    def __init__(self) -> None:
+        self.buffer: bytearray = bytearray()
+        self.position: int = 0
+        self.closed: bool = False
+
+    def write(self, data: Any) -> int:
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def take(self) -> bytes:
+        """
+        Returns and forgets the bytes written since the last call.
+        """
+        data: bytes = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def parquet_schema(columns: Tuple[str, ...]) -> Any:
+    """
+    Returns the Parquet schema of an export: timestamps and rollup buckets as UTC milliseconds.
+    """
+    types: Dict[str, Any] = {
+        'id': pyarrow.int64(),
+        'device_id': pyarrow.string(),
+        'timestamp': pyarrow.timestamp('ms', tz='UTC'),
+        'bucket': pyarrow.timestamp('ms', tz='UTC'),
+        'count': pyarrow.int64(),
+    }
+    return pyarrow.schema([(column, types.get(column, pyarrow.float64())) for column in columns])
+
+def parquet_stream(columns: Tuple[str, ...], chunks: Iterator[List[Tuple]], row_group_size: int) -> Iterator[bytes]:
+    """
+    Yields a Parquet file with one row group per row_group_size rows, each sent as soon as it is written.
+    """
+    schema: Any = parquet_schema(columns)
+    sink: ParquetSink = ParquetSink()
+    writer: Any = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink, mode='w'), schema)
+    pending: List[Tuple] = []
+
+    def write_group(rows: List[Tuple]) -> None:
+        writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array([row[index] for row in rows], type=field.type) for index, field in enumerate(schema)],
+            schema=schema,
+        ))
+
+    for rows in chunks:
+        pending.extend(rows)
+        if len(pending) >= row_group_size:
+            write_group(pending)
+            pending = []
+            yield sink.take()
+    if pending:
+        write_group(pending)
+    writer.close()
+    yield sink.take()
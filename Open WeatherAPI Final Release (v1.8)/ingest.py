@@ -0,0 +1,122 @@
+import sqlite3
+import time
+import configparser
+from typing import Any, Dict, List, Optional, Tuple
+from database import write_transaction
+from metrics import Counter, Gauge, Histogram, registry
+from pubsub import notify_ingest
+from aggregates import insert_edge_aggregates
+from readings import READINGS_TABLE, insert_readings, now_ms, partition_granularity, save_sequences
+
+# Columns written for a reading, in the order the values are passed to IngestBuffer.add
+READING_COLUMNS: Tuple[str, ...] = ('device_id', 'timestamp', 'humidity', 'temperature', 'light_level')
+
+# Metrics of the ingest scripts, served by start_metrics_server
+ingest_readings: Counter = registry.counter('ingest_readings_total', 'Readings written to the database.')
+ingest_flushes: Counter = registry.counter('ingest_flushes_total', 'Batches committed to the database.')
+ingest_flush_seconds: Histogram = registry.histogram('ingest_flush_duration_seconds', 'Time to write and commit one batch.')
+ingest_buffer_depth: Gauge = registry.gauge('ingest_buffer_depth', 'Readings waiting in the buffer for the next flush.')
+ingest_lag_seconds: Gauge = registry.gauge('ingest_lag_seconds', 'Age of the oldest reading of the last committed batch.')
+
+class IngestBuffer:
+    """
+    Collects readings in memory and writes them to their partitions in one transaction, together with the
+    aggregates of the edge pre-processing. A flush is due when batch_size readings and aggregates are buffered
+    or the oldest one has waited flush_interval seconds.
+    """
+
+    def __init__(self, granularity: str, batch_size: int, flush_interval: float) -> None:
+        self.granularity: str = granularity
+        self.batch_size: int = max(batch_size, 1)
+        self.flush_interval: float = flush_interval
+        self.readings: List[Tuple[Any, ...]] = []
+        # Aggregates of the edge pre-processing, one value per column of EDGE_AGGREGATE_COLUMNS
+        self.aggregates: List[Tuple[Any, ...]] = []
+        self.first_added: float = 0.0
+        # Outbox epoch and last sequence number per device of the buffered records of the binary protocol, committed with them
+        self.sequences: Dict[str, Tuple[int, int]] = {}
+        # UDP address of the web process that pushes new readings to browsers
+        self.notify_address: Optional[Tuple[str, int]] = None
+
+    def add(self, *values: Any) -> None:
+        """
+        Adds a reading to the buffer, with one value per column of READING_COLUMNS (timestamp in milliseconds since the epoch).
+        """
+        if not self.pending():
+            self.first_added = time.monotonic()
+        self.readings.append(values)
+        ingest_buffer_depth.set(self.pending())
+
+    def add_aggregate(self, *values: Any) -> None:
+        """
+        Adds an aggregate to the buffer, with one value per column of EDGE_AGGREGATE_COLUMNS (timestamps in milliseconds since the epoch).
+        """
+        if not self.pending():
+            self.first_added = time.monotonic()
+        self.aggregates.append(values)
+        ingest_buffer_depth.set(self.pending())
+
+    def pending(self) -> int:
+        """
+        Returns the number of buffered readings and aggregates.
+        """
+        return len(self.readings) + len(self.aggregates)
+
+    def due(self) -> bool:
+        """
+        Returns whether the buffer should be flushed.
+        """
+        if not self.pending():
+            return False
+        return self.pending() >= self.batch_size or time.monotonic() - self.first_added >= self.flush_interval
+
+    def flush(self, conn: sqlite3.Connection) -> int:
+        """
+        Writes all buffered readings with one executemany per partition, the buffered aggregates and the sequence
+        numbers of their records, commits once and notifies the web process. A failed flush keeps the readings
+        and aggregates for the next one.
+
+        Parameters:
+        conn (sqlite3.Connection): The database connection.
+
+        Returns:
+            int: The number of readings and aggregates written.
+        """
+        if not self.pending():
+            return 0
+        count: int = self.pending()
+        started: float = time.perf_counter()
+        with write_transaction(conn):
+            if self.readings:
+                insert_readings(conn.cursor(), self.readings, self.granularity)
+            if self.aggregates:
+                insert_edge_aggregates(conn.cursor(), self.aggregates)
+            if self.sequences:
+                save_sequences(conn.cursor(), self.sequences)
+        ingest_flush_seconds.observe(time.perf_counter() - started)
+        ingest_flushes.inc()
+        ingest_readings.inc(count)
+        ingest_lag_seconds.set((now_ms() - min(record[1] for record in self.readings + self.aggregates)) / 1000)
+        self.readings = []
+        self.aggregates = []
+        self.sequences = {}
+        ingest_buffer_depth.set(0)
+        notify_ingest(self.notify_address, READINGS_TABLE)
+        return count
+
+def create_buffer(config: configparser.ConfigParser) -> IngestBuffer:
+    """
+    Creates an IngestBuffer using the batch and partition settings from config.ini.
+
+    Parameters:
+    config (configparser.ConfigParser): The loaded configuration.
+
+    Returns:
+        IngestBuffer: The configured buffer.
+    """
+    batch_size: int = config.getint('INGEST', 'batch_size', fallback=50)
+    flush_interval: float = config.getfloat('INGEST', 'flush_interval', fallback=5.0)
+    buffer: IngestBuffer = IngestBuffer(partition_granularity(config), batch_size, flush_interval)
+    if config.getboolean('STREAM', 'enabled', fallback=False):
+        buffer.notify_address = (config['STREAM']['notify_host'], config.getint('STREAM', 'notify_port'))
+    return buffer
@@ -1,7 +1,14 @@
-import socket
+import math
+import time
+import asyncio
 import sqlite3
-from datetime import datetime
 import configparser
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from database import configure_connection, open_database, write_transaction
+from ingest import IngestBuffer, create_buffer
+from metrics import Gauge, registry, start_metrics_server
+from protocol import FLAG_AGGREGATE, MAGIC, ProtocolError, WireRecord, encode_ack, parse_reading, read_frame
+from readings import load_sequences, now_ms, setup_readings
 
 # Load configurations from config.ini
 config = configparser.ConfigParser()
@@ -11,63 +18,330 @@ config.read('config.ini')
 SERVER_IP = config['SERVER']['IP']
 SERVER_PORT = config.getint('SERVER', 'PORT')
 
-# Connect to SQLite database
-db_conn = sqlite3.connect('sensor_data.db')
-cursor = db_conn.cursor()
-
-# Create a new table called second_sensor_data if it doesn't exist
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS second_sensor_data (
-    id INTEGER PRIMARY KEY,
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    humidity REAL,
-    temperature REAL,
-    light_level REAL
-    )
-''')
-db_conn.commit()
+# Longest line accepted from a client and the number of readings and aggregates that may wait for the writer
+MAX_LINE_LENGTH: int = config.getint('SERVER', 'max_line_length', fallback=1024)
+QUEUE_SIZE: int = config.getint('SERVER', 'queue_size', fallback=10000)
+
+# Backoff of the database writer after a failed commit, in seconds
+RETRY_DELAY: float = config.getfloat('INGEST', 'retry_delay', fallback=1.0)
+MAX_RETRY_DELAY: float = config.getfloat('INGEST', 'max_retry_delay', fallback=60.0)
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+# Window around the time of receipt in which a sensor timestamp is trusted, in seconds.
+# The past covers readings a client buffered during an outage, the future a clock running slightly ahead
+MAX_TIMESTAMP_AGE: float = config.getfloat('SERVER', 'max_timestamp_age', fallback=366 * 24 * 60 * 60)
+MAX_CLOCK_SKEW: float = config.getfloat('SERVER', 'max_clock_skew', fallback=300.0)
+
+class QueuedRecord(NamedTuple):
     """
-    Sets up the server to listen for incoming connections and handle received data.
+    One record of the binary protocol, a reading or an aggregate, queued for the database writer with the
+    outbox epoch and sequence number the writer checks against the last committed ones of the device.
+    values holds one value per column of READING_COLUMNS, or of EDGE_AGGREGATE_COLUMNS for an aggregate.
     """
-    # Bind the socket to the IP address and port
-    s.bind((SERVER_IP, SERVER_PORT))
-    print(f"Socket bound to port {SERVER_PORT}")
+    device: str
+    epoch: int
+    sequence: int
+    values: Tuple
+    aggregate: bool
 
-    # Listen for incoming connections
-    s.listen()
-    print("Listening for incoming connections...")
+# Readings and aggregates received from the clients that the database writer hasn't taken yet
+queue_depth: Gauge = registry.gauge('ingest_queue_depth', 'Readings and aggregates waiting in the queue of the database writer.')
 
-    # Accept connection
-    client_conn, addr = s.accept()
-    print('Connected by', addr)
+async def handle_text_client(reader: asyncio.StreamReader, queue: asyncio.Queue, device: str, prefix: bytes) -> None:
+    """
+    Reads newline-framed text readings from a client and queues them for the database writer.
 
+    Parameters:
+    reader (asyncio.StreamReader): The stream to read from.
+    queue (asyncio.Queue): The queue consumed by the database writer.
+    device (str): The device the readings are tagged with.
+    prefix (bytes): Bytes that were already read from the stream.
+    """
     while True:
-        # Receive raw data from the client
-        raw_data: str = client_conn.recv(1024).decode().strip()
-        print("Received raw data:", raw_data)
+        try:
+            line: bytes = prefix + await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            # Connection closed, a trailing reading without newline is still used
+            line = prefix + e.partial
+            if not line:
+                break
+        prefix = b''
 
+        raw_data: str = line.decode(errors='replace').strip()
         if not raw_data:
-            break
+            continue
 
-        # Divide the received raw data into humidity, temperature, and light_level
         try:
-            data_parts: list = raw_data.split(',')
-            if len(data_parts) != 3:
-                raise ValueError("Invalid data format")
-            
-            humidity: float = float(data_parts[0])
-            temperature: float = float(data_parts[1])
-            light_level: float = float(data_parts[2])
-        except ValueError:
+            humidity, temperature, light_level = parse_reading(raw_data)
+        except (ValueError, IndexError):
             print("Invalid data format:", raw_data)
             continue
 
-        timestamp: str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        timestamp: int = now_ms()
+        await queue.put((device, timestamp, humidity, temperature, light_level))
+
+def valid_time(sensor_time: float, received: float) -> bool:
+    """
+    Returns whether a sensor timestamp (seconds since the epoch) is finite and within the trusted window around
+    the time of receipt. Other timestamps, from a clock that was never set or a corrupt record, have no partition.
+    """
+    return math.isfinite(sensor_time) and received - MAX_TIMESTAMP_AGE <= sensor_time <= received + MAX_CLOCK_SKEW
+
+def check_times(device: str, record: WireRecord, aggregate: bool, received: float) -> WireRecord:
+    """
+    Returns a record whose timestamps are valid, replacing invalid ones by the time of receipt.
+
+    Parameters:
+    device (str): The device that sent the record.
+    record (WireRecord): The reading or aggregate as received.
+    aggregate (bool): Whether the record is an aggregate, which has the timestamps of its first and last reading.
+    received (float): The time the frame was received, in seconds since the epoch.
+
+    Returns:
+        WireRecord: The record, or a copy with the time of receipt.
+    """
+    if not aggregate:
+        if valid_time(record[1], received):
+            return record
+        print(f"Invalid timestamp {record[1]} from {device}, using the time of receipt")
+        return (record[0], received, *record[2:])
+    start, end = record[1], record[2]
+    if valid_time(start, received) and valid_time(end, received) and start <= end:
+        return record
+    print(f"Invalid interval {start} - {end} from {device}, using the time of receipt")
+    return (record[0], received, received, *record[3:])
+
+def queued_record(device: str, epoch: int, record: WireRecord, aggregate: bool) -> QueuedRecord:
+    """
+    Converts a record as received, with valid timestamps, into a QueuedRecord with timestamps in milliseconds.
+    An aggregate is queued as it is, it goes to the rollups instead of being turned into readings.
+    """
+    if aggregate:
+        sequence, start, end, count, *statistics = record
+        return QueuedRecord(device, epoch, sequence, (device, int(round(start * 1000)), int(round(end * 1000)), count, *statistics), True)
+    sequence, sensor_time, humidity, temperature, light_level = record
+    return QueuedRecord(device, epoch, sequence, (device, int(round(sensor_time * 1000)), humidity, temperature, light_level), False)
+
+async def handle_binary_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, queue: asyncio.Queue) -> None:
+    """
+    Reads binary frames from a client and queues their records for the database writer, which drops records
+    that were already committed.
+    Every frame is acknowledged once its readings are committed, so the client can remove them from its buffer.
+
+    Parameters:
+    reader (asyncio.StreamReader): The stream to read from, positioned after the magic bytes of the first frame.
+    writer (asyncio.StreamWriter): The stream the acknowledgements are written to.
+    queue (asyncio.Queue): The queue consumed by the database writer.
+    """
+    magic: bytes = MAGIC
+    while True:
+        try:
+            flags, device, epoch, readings = await read_frame(reader, magic)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                print("Incomplete frame received")
+            break
+        magic = b''
+        received: float = time.time()
+
+        aggregate: bool = bool(flags & FLAG_AGGREGATE)
+        for reading in readings:
+            await queue.put(queued_record(device, epoch, check_times(device, reading, aggregate, received), aggregate))
+
+        if readings:
+            # The writer resolves the future after the next commit
+            stored: asyncio.Future = asyncio.get_running_loop().create_future()
+            await queue.put(stored)
+            await stored
+            writer.write(encode_ack(max(reading[0] for reading in readings)))
+            await writer.drain()
+
+async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, queue: asyncio.Queue) -> None:
+    """
+    Serves one client, using the binary protocol when the stream starts with its magic bytes and text lines otherwise.
+
+    Parameters:
+    reader (asyncio.StreamReader): The stream to read from.
+    writer (asyncio.StreamWriter): The stream of the same connection.
+    queue (asyncio.Queue): The queue consumed by the database writer.
+    """
+    addr: Tuple = writer.get_extra_info('peername')
+    print('Connected by', addr)
+
+    try:
+        try:
+            prefix: bytes = await reader.readexactly(len(MAGIC))
+        except asyncio.IncompleteReadError as e:
+            prefix = e.partial
+
+        if prefix == MAGIC:
+            await handle_binary_client(reader, writer, queue)
+        elif prefix:
+            await handle_text_client(reader, queue, str(addr[0]), prefix)
+    except asyncio.LimitOverrunError:
+        print("Line too long from", addr)
+    except ProtocolError as e:
+        print("Invalid frame from", addr, e)
+    except sqlite3.Error as e:
+        # The readings weren't acknowledged, the client sends them again after reconnecting
+        print("Readings from", addr, "not stored:", e)
+    except ConnectionError as e:
+        print("Connection error from", addr, e)
+    finally:
+        writer.close()
+        print('Disconnected', addr)
+
+def take_item(item: Any, buffer: IngestBuffer, sequences: Dict[str, Tuple[Optional[int], int]],
+              waiting: List[asyncio.Future]) -> None:
+    """
+    Moves an item of the queue into the buffer, or to the clients waiting for an acknowledgement.
+
+    A record whose sequence number is not above the last one of its device in the same outbox epoch was
+    already committed or queued, it is sent again when an acknowledgement got lost, and is dropped.
+    A record of another epoch comes from a new outbox on the client, whose sequence numbers start again,
+    and is always taken. Gaps within an epoch are reported.
+
+    Parameters:
+    item (Any): A reading of a text client, a QueuedRecord or a future of a waiting client.
+    buffer (IngestBuffer): The buffer for the readings and aggregates.
+    sequences (Dict[str, Tuple[Optional[int], int]]): The epoch and last sequence number per device that was
+        committed or is buffered.
+    waiting (List[asyncio.Future]): The clients waiting for the next flush.
+    """
+    if isinstance(item, asyncio.Future):
+        waiting.append(item)
+        return
+    if not isinstance(item, QueuedRecord):
+        buffer.add(*item)
+        return
+    epoch, last = sequences.get(item.device, (None, 0))
+    if item.epoch != epoch:
+        if epoch is not None:
+            print(f"New outbox epoch from {item.device}, sequence numbers start again")
+    elif item.sequence <= last:
+        return
+    elif last < item.sequence - 1:
+        print(f"Missing {item.sequence - last - 1} records from {item.device}")
+    sequences[item.device] = (item.epoch, item.sequence)
+    buffer.sequences[item.device] = (item.epoch, item.sequence)
+    if item.aggregate:
+        buffer.add_aggregate(*item.values)
+    else:
+        buffer.add(*item.values)
+
+async def database_writer(queue: asyncio.Queue, conn: sqlite3.Connection, buffer: IngestBuffer) -> None:
+    """
+    The only task that writes to the database: drains the queue into the buffer and flushes it in batches.
+    Futures in the queue are clients waiting for an acknowledgement; they force a flush and are resolved after it.
+
+    The outbox epoch and last sequence number of every device are committed with its readings, so records that a client sends
+    again after a lost acknowledgement are dropped, also after a reconnect or a restart of the server.
+
+    When a flush fails the batch stays in the buffer and is retried after a delay that doubles with every
+    failure. The waiting clients get the error instead of an acknowledgement, so they disconnect and send
+    their readings again.
+
+    Parameters:
+    queue (asyncio.Queue): The queue filled by the client handlers.
+    conn (sqlite3.Connection): The database connection.
+    buffer (IngestBuffer): The buffer for the readings.
+    """
+    waiting: List[asyncio.Future] = []
+    delay: float = RETRY_DELAY
+    sequences: Dict[str, Tuple[Optional[int], int]] = load_sequences(conn.cursor())
+    try:
+        while True:
+            try:
+                item: Any = await asyncio.wait_for(queue.get(), timeout=buffer.flush_interval)
+                while True:
+                    take_item(item, buffer, sequences, waiting)
+                    if queue.empty() or buffer.pending() >= buffer.batch_size:
+                        break
+                    item = queue.get_nowait()
+            except asyncio.TimeoutError:
+                pass
+            queue_depth.set(queue.qsize())
+
+            if buffer.due() or waiting:
+                try:
+                    # Run the commit in a thread so the clients keep being served while SQLite syncs
+                    count: int = await asyncio.to_thread(buffer.flush, conn)
+                except sqlite3.Error as e:
+                    print(f"Failed to store {buffer.pending()} readings and aggregates, retrying in {delay:g} seconds:", e)
+                    fail_waiting(waiting, e)
+                    waiting = []
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, MAX_RETRY_DELAY)
+                    continue
+                delay = RETRY_DELAY
+                if count:
+                    print("Data stored in database:", count, "readings")
+                for stored in waiting:
+                    if not stored.done():
+                        stored.set_result(count)
+                waiting = []
+    finally:
+        while not queue.empty():
+            take_item(queue.get_nowait(), buffer, sequences, waiting)
+        try:
+            count = buffer.flush(conn)
+        except sqlite3.Error as e:
+            print(f"Lost {buffer.pending()} readings and aggregates on shutdown:", e)
+            fail_waiting(waiting, e)
+        else:
+            for stored in waiting:
+                if not stored.done():
+                    stored.set_result(count)
+
+def fail_waiting(waiting: List[asyncio.Future], error: Exception) -> None:
+    """
+    Passes an error to the clients waiting for an acknowledgement.
+    """
+    for stored in waiting:
+        if not stored.done():
+            stored.set_exception(error)
+
+async def main() -> None:
+    """
+    Sets up the server to listen for incoming connections from many clients and store the received data.
+    """
+    # Connect to SQLite database, the writer task may commit from a worker thread
+    db_conn: sqlite3.Connection = open_database(config, check_same_thread=False)
+    configure_connection(db_conn, config)
+    with write_transaction(db_conn):
+        setup_readings(db_conn.cursor(), config)
+    start_metrics_server(config, 'server_port')
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    buffer: IngestBuffer = create_buffer(config)
+    writer_task: asyncio.Task = asyncio.create_task(database_writer(queue, db_conn, buffer))
+
+    server: asyncio.AbstractServer = await asyncio.start_server(
+        lambda reader, writer: handle_client(reader, writer, queue),
+        SERVER_IP, SERVER_PORT, limit=MAX_LINE_LENGTH
+    )
+    print(f"Socket bound to port {SERVER_PORT}")
+    print("Listening for incoming connections...")
+
+    try:
+        async with server:
+            serving: asyncio.Task = asyncio.create_task(server.serve_forever())
+            await asyncio.wait((serving, writer_task), return_when=asyncio.FIRST_COMPLETED)
+            if writer_task.done():
+                # Without the writer the clients would wait forever for their acknowledgements
+                print("Database writer stopped, shutting down")
+                serving.cancel()
+                writer_task.result()
+    finally:
+        if not writer_task.done():
+            writer_task.cancel()
+            try:
+                await writer_task
+            except asyncio.CancelledError:
+                pass
+        db_conn.close()
 
-        # Store the parsed data in the database along with the formatted timestamp
-        cursor.execute("INSERT INTO second_sensor_data (timestamp, humidity, temperature, light_level) VALUES (?, ?, ?, ?)",
-                        (timestamp, humidity, temperature, light_level))
-        db_conn.commit()
-        print("Data stored in database:", timestamp, humidity, temperature, light_level)
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("Stopping...")
@@ -0,0 +1,223 @@
+import math
+import threading
+import configparser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE: str = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds of the latency histogram buckets, +Inf is added automatically
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    """
+    Formats label pairs as {name="value",...}, escaping the values.
+    """
+    pairs: List[str] = [
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(10), chr(92) + "n").replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value: float) -> str:
+    """
+    Formats a sample value, integers without a decimal point.
+    """
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metric:
+    """
+    Base of the metric types: a name, a help text, label names and one value per label combination.
+    Types that keep more than one value per label combination, like Histogram, override samples.
+    """
+    kind: str = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: Tuple[str, ...] = labelnames
+        self.lock: threading.Lock = threading.Lock()
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def samples(self) -> List[str]:
+        """
+        Returns the sample lines of the metric, one per label combination.
+        """
+        with self.lock:
+            values: List[Tuple[Tuple[str, ...], float]] = list(self.values.items())
+        return [f'{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}' for labels, value in values]
+
+    def render(self) -> str:
+        """
+        Returns the metric in the Prometheus text format.
+        """
+        lines: List[str] = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """
+    A value that only goes up, like the number of handled requests.
+    """
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0, labels: Tuple[str, ...] = ()) -> None:
+        """
+        Adds amount to the value of a label combination.
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0.0) + amount
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, like the depth of a queue.
+    """
+    kind = 'gauge'
+
+    def set(self, value: float, labels: Tuple[str, ...] = ()) -> None:
+        """
+        Sets the value of a label combination.
+        """
+        with self.lock:
+            self.values[labels] = value
+
+class Histogram(Metric):
+    """
+    Counts observations, like request latencies, in cumulative buckets and keeps their sum.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets)) + (math.inf,)
+        # Per label combination: the count per bucket (not cumulative) and the sum
+        self.counts: Dict[Tuple[str, ...], List[int]] = {}
+        self.sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, labels: Tuple[str, ...] = ()) -> None:
+        """
+        Records one observation for a label combination.
+        """
+        index: int = 0
+        while value > self.buckets[index]:
+            index += 1
+        with self.lock:
+            counts: Optional[List[int]] = self.counts.get(labels)
+            if counts is None:
+                counts = self.counts[labels] = [0] * len(self.buckets)
+            counts[index] += 1
+            self.sums[labels] = self.sums.get(labels, 0.0) + value
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            series: List[Tuple[Tuple[str, ...], List[int], float]] = [
+                (labels, list(counts), self.sums[labels]) for labels, counts in self.counts.items()
+            ]
+        lines: List[str] = []
+        for labels, counts, total in series:
+            cumulative: int = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket: str = format_labels(self.labelnames, labels, f'le="{format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{bucket} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+class Registry:
+    """
+    The metrics of one process, rendered together for a scrape.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+        self.lock: threading.Lock = threading.Lock()
+
+    def add(self, metric: Metric) -> Metric:
+        """
+        Registers a metric and returns it.
+        """
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self.add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        with self.lock:
+            metrics: List[Metric] = list(self.metrics)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+# Metrics of this process, each script registers its own metrics here
+registry: Registry = Registry()
+
+def serve_metrics(host: str, port: int) -> ThreadingHTTPServer:
+    """
+    Serves /metrics of this process from a background thread, for the scripts that have no web server.
+
+    Parameters:
+    host (str): The address to listen on.
+    port (int): The port to listen on.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body: bytes = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            # Scrapes every few seconds would flood the console
+            pass
+
+    server: ThreadingHTTPServer = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_metrics_server(config: configparser.ConfigParser, option: str) -> Optional[ThreadingHTTPServer]:
+    """
+    Starts the metrics server of a script when METRICS is enabled and the script has a port (0 disables it).
+
+    Parameters:
+    config (configparser.ConfigParser): The loaded configuration.
+    option (str): The option of the METRICS section holding the port of the script.
+
+    Returns:
+        Optional[ThreadingHTTPServer]: The running server, or None.
+    """
+    port: int = config.getint('METRICS', option, fallback=0)
+    if not config.getboolean('METRICS', 'enabled', fallback=False) or port <= 0:
+        return None
+    try:
+        server: ThreadingHTTPServer = serve_metrics(config.get('METRICS', 'host', fallback='127.0.0.1'), port)
+    except OSError as e:
+        print("Failed to start the metrics server:", e)
+        return None
+    print(f"Metrics served on port {port}")
+    return server
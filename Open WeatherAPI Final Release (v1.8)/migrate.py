@@ -0,0 +1,155 @@
+import sys
+import sqlite3
+import configparser
+from typing import List, Tuple
+from aggregates import AGGREGATE_COLUMNS, ROLLUP_LEVELS
+from database import open_database, write_transaction
+from readings import insert_readings, legacy_tables, partition_granularity, setup_readings
+
+# Load configurations from config.ini
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+# Readings are copied in chunks of this size, so a large table doesn't have to fit in memory
+CHUNK_SIZE: int = 10000
+
+# Older versions stored local time as '%Y-%m-%d %H:%M:%S' text
+TEXT_TO_MS: str = "CAST(strftime('%s', {column}, 'utc') AS INTEGER) * 1000"
+
+# The rollup buckets of older versions were timestamp prefixes, the hour prefix needs its minutes to be parsed
+BUCKET_SUFFIXES: dict = {
+    'minute': '',
+    'hour': ':00',
+    'day': '',
+}
+
+def table_exists(cursor: sqlite3.Cursor, table_name: str) -> bool:
+    """
+    Returns whether a table exists in the database.
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+    return cursor.fetchone() is not None
+
+def merge_rollups(cursor: sqlite3.Cursor, source: str, level: str, device: str, where: str, params: Tuple) -> None:
+    """
+    Copies the rollup buckets of an older version, converting their text buckets to milliseconds.
+    An old bucket also counts the readings the cleanup removed, so it wins over the bucket rebuilt from the rows.
+    Old sums never skipped a NULL, so every value count is the count of the bucket.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    source (str): The old rollup table.
+    level (str): The rollup level.
+    device (str): SQL expression for the device of a bucket.
+    where (str): The condition of the buckets to copy.
+    params (Tuple): The parameters of device and where.
+    """
+    width: int = ROLLUP_LEVELS[level]
+    bucket: str = TEXT_TO_MS.format(column=f"bucket || '{BUCKET_SUFFIXES[level]}'")
+    columns: List[str] = ['count'] + [f'sum_{column}' for column in AGGREGATE_COLUMNS] + [
+        f'{extreme}_{column}' for column in AGGREGATE_COLUMNS for extreme in ('min', 'max')
+    ]
+    value_counts: List[str] = [f'count_{column}' for column in AGGREGATE_COLUMNS]
+    cursor.execute(f'''
+        INSERT INTO sensor_rollup_{level} ({', '.join(['device_id', 'bucket'] + columns + value_counts)})
+        SELECT {device}, {bucket} / {width} * {width}, {', '.join(columns + ['count'] * len(value_counts))}
+        FROM {source}
+        WHERE {where}
+        ON CONFLICT (device_id, bucket) DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in columns + value_counts)}
+        WHERE excluded.count > count
+    ''', params)
+
+def migrate_table(conn: sqlite3.Connection, table_name: str, device_id: str, granularity: str, drop: bool) -> int:
+    """
+    Moves the rows of a table of an older version into the partitions in one transaction,
+    so an interrupted migration can simply be run again.
+
+    Text timestamps are converted to milliseconds and rows without a device of their own are assigned
+    device_id. The rollups of a per-sensor table are kept, so history removed by the cleanup is not lost.
+    The old table is dropped, or renamed to migrated_<table> when drop is False.
+
+    Parameters:
+    conn (sqlite3.Connection): The database connection.
+    table_name (str): The table to migrate.
+    device_id (str): The device the readings of the table belong to.
+    granularity (str): The partition granularity.
+    drop (bool): Whether to drop the old table instead of keeping it as migrated_<table>.
+
+    Returns:
+        int: The number of migrated readings.
+    """
+    cursor: sqlite3.Cursor = conn.cursor()
+    cursor.execute(f'PRAGMA table_info({table_name})')
+    columns: List[str] = [row[1] for row in cursor.fetchall()]
+    if 'device_id' in columns:
+        device: str = 'COALESCE(device_id, ?)'
+    elif 'device' in columns:
+        device = 'COALESCE(device, ?)'
+    else:
+        device = '?'
+    timestamp: str = TEXT_TO_MS.format(column="COALESCE(timestamp, datetime('now', 'localtime'))")
+
+    count: int = 0
+    with write_transaction(conn):
+        rows: sqlite3.Cursor = conn.execute(f'''
+            SELECT {device}, {timestamp}, humidity, temperature, light_level
+            FROM {table_name}
+            ORDER BY id
+        ''', (device_id,))
+        while True:
+            chunk: List[Tuple] = rows.fetchmany(CHUNK_SIZE)
+            if not chunk:
+                break
+            insert_readings(cursor, chunk, granularity)
+            count += len(chunk)
+
+        for level in ROLLUP_LEVELS:
+            if table_exists(cursor, f'legacy_rollup_{level}'):
+                merge_rollups(cursor, f'legacy_rollup_{level}', level, '?', 'table_name = ?', (device_id, table_name))
+                cursor.execute(f'DELETE FROM legacy_rollup_{level} WHERE table_name = ?', (table_name,))
+
+        if drop:
+            cursor.execute(f'DROP TABLE {table_name}')
+        else:
+            cursor.execute(f'ALTER TABLE {table_name} RENAME TO migrated_{table_name}')
+    return count
+
+def migrate_device_rollups(conn: sqlite3.Connection) -> None:
+    """
+    Converts the per-device rollups of the previous version and drops the old rollup tables
+    once every table has been migrated.
+    """
+    cursor: sqlite3.Cursor = conn.cursor()
+    with write_transaction(conn):
+        for level in ROLLUP_LEVELS:
+            if table_exists(cursor, f'legacy_device_rollup_{level}'):
+                merge_rollups(cursor, f'legacy_device_rollup_{level}', level, 'device_id', '1', ())
+            cursor.execute(f'DROP TABLE IF EXISTS legacy_device_rollup_{level}')
+            cursor.execute(f'DROP TABLE IF EXISTS legacy_rollup_{level}')
+
+def main() -> None:
+    """
+    Migrates the tables of older versions into the partitioned readings. Pass --drop to drop the old tables
+    instead of keeping them as migrated_<table>.
+    """
+    drop: bool = '--drop' in sys.argv[1:]
+    granularity: str = partition_granularity(config)
+
+    conn: sqlite3.Connection = open_database(config)
+    cursor: sqlite3.Cursor = conn.cursor()
+    with write_transaction(conn):
+        setup_readings(cursor, config)
+
+    tables: List[str] = legacy_tables(cursor)
+    if not tables:
+        print("Nothing to migrate")
+    for table_name in tables:
+        device_id: str = config.get('MIGRATION', table_name, fallback=table_name)
+        count: int = migrate_table(conn, table_name, device_id, granularity, drop)
+        print(f"Migrated {count} readings from {table_name}, readings without a device were assigned to {device_id}")
+
+    migrate_device_rollups(conn)
+    conn.close()
+
+if __name__ == "__main__":
+    main()
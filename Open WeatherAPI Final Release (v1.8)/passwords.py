@@ -0,0 +1,200 @@
+import os
+import hmac
+import time
+import base64
+import threading
+import configparser
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from hashlib import pbkdf2_hmac
+from typing import Deque, Dict, Tuple
+
+# Prefix of stored passwords that carry their own parameters: pbkdf2_<hash_name>$<iterations>$<base64 salt>$<base64 hash>.
+# Passwords stored as pbkdf2_<hash_name>$<iterations>$<base64 salt + hash> have a salt of legacy_salt_length bytes
+HASH_PREFIX: str = 'pbkdf2_'
+
+class HasherBusy(Exception):
+    """
+    Raised when every hashing worker is busy and the queue of waiting requests is full,
+    or a hash didn't finish within the timeout.
+    """
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords with PBKDF2 on a small pool of worker threads.
+
+    hashlib releases the GIL while it hashes, so the workers run in parallel with the request threads.
+    The pool caps how many hashes run at once and max_pending caps how many requests may wait for one,
+    so a burst of logins can't take the CPU away from the sensor pages.
+    """
+
+    def __init__(self, hash_name: str, iterations: int, salt_length: int, dk_length: int, legacy_iterations: int,
+                 legacy_salt_length: int, workers: int, max_pending: int, timeout: float) -> None:
+        self.hash_name: str = hash_name
+        self.iterations: int = iterations
+        self.salt_length: int = salt_length
+        self.dk_length: int = dk_length
+        # Iterations of passwords stored as plain base64(salt + hash), before the parameters were stored with them
+        self.legacy_iterations: int = legacy_iterations
+        # Salt length of passwords stored with salt and hash in one base64 field, which doesn't tell where the salt ends
+        self.legacy_salt_length: int = legacy_salt_length
+        self.timeout: float = timeout
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='pbkdf2')
+        self.slots: threading.BoundedSemaphore = threading.BoundedSemaphore(max(workers, 1) + max(max_pending, 0))
+
+    def run(self, hash_name: str, password: str, salt: bytes, iterations: int, dk_length: int) -> bytes:
+        """
+        Runs one PBKDF2 computation on the pool and waits for the result.
+
+        Raises:
+            HasherBusy: When the pool and its queue are full or the hash took longer than the timeout.
+        """
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future: Future = self.executor.submit(pbkdf2_hmac, hash_name, password.encode(), salt, iterations, dk_length)
+        except RuntimeError:
+            self.slots.release()
+            raise
+        # The slot is freed when the hash is done, also when the caller stopped waiting for it
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HasherBusy()
+
+    def hash(self, password: str) -> str:
+        """
+        Hashes a password with a new random salt and the configured parameters.
+
+        Returns:
+            str: The password as stored in the users table.
+        """
+        salt: bytes = os.urandom(self.salt_length)
+        hashed: bytes = self.run(self.hash_name, password, salt, self.iterations, self.dk_length)
+        encoded_salt: str = base64.b64encode(salt).decode('utf-8')
+        encoded_hash: str = base64.b64encode(hashed).decode('utf-8')
+        return f'{HASH_PREFIX}{self.hash_name}${self.iterations}${encoded_salt}${encoded_hash}'
+
+    def parse(self, stored_password: str) -> Tuple[str, int, bytes, bytes]:
+        """
+        Splits a stored password into its hash name, iterations, salt and hash.
+        Passwords of older versions, with salt and hash in one field, are split at the legacy salt length.
+        """
+        if stored_password.startswith(HASH_PREFIX):
+            algorithm, iterations, encoded = stored_password.split('$', 2)
+            hash_name: str = algorithm[len(HASH_PREFIX):]
+            rounds: int = int(iterations)
+            if '$' in encoded:
+                encoded_salt, encoded_hash = encoded.split('$', 1)
+                return hash_name, rounds, base64.b64decode(encoded_salt), base64.b64decode(encoded_hash)
+        else:
+            hash_name, rounds, encoded = self.hash_name, self.legacy_iterations, stored_password
+        decoded: bytes = base64.b64decode(encoded)
+        return hash_name, rounds, decoded[:self.legacy_salt_length], decoded[self.legacy_salt_length:]
+
+    def verify(self, stored_password: str, provided_password: str) -> bool:
+        """
+        Checks a password against the stored one, comparing the hashes in constant time.
+        """
+        hash_name, rounds, salt, stored_hash = self.parse(stored_password)
+        provided_hash: bytes = self.run(hash_name, provided_password, salt, rounds, len(stored_hash))
+        return hmac.compare_digest(stored_hash, provided_hash)
+
+    def verify_missing(self, provided_password: str) -> bool:
+        """
+        Spends the time of a verify for a username that doesn't exist, so response times don't reveal
+        which usernames do. Always returns False.
+        """
+        self.run(self.hash_name, provided_password, bytes(self.salt_length), self.iterations, self.dk_length)
+        return False
+
+    def needs_rehash(self, stored_password: str) -> bool:
+        """
+        Returns whether a stored password was hashed with other parameters than the configured ones,
+        so it should be hashed again the next time the user logs in.
+        """
+        hash_name, rounds, salt, stored_hash = self.parse(stored_password)
+        return (not stored_password.startswith(HASH_PREFIX) or stored_password.count('$') != 3 or hash_name != self.hash_name
+                or rounds != self.iterations or len(salt) != self.salt_length or len(stored_hash) != self.dk_length)
+
+class RateLimiter:
+    """
+    Counts failed attempts per key (a username or an IP address) in a sliding window of window seconds.
+    A key with max_attempts failures in the window is blocked until the oldest one expires.
+    At most max_keys keys are tracked, so many different usernames can't grow the table without bound.
+    """
+
+    def __init__(self, max_attempts: int, window: float, max_keys: int = 10000) -> None:
+        self.max_attempts: int = max_attempts
+        self.window: float = window
+        self.max_keys: int = max_keys
+        self.failures: Dict[str, Deque[float]] = {}
+        self.lock: threading.Lock = threading.Lock()
+
+    def expire(self, key: str, now: float) -> Deque[float]:
+        """
+        Removes the failures of a key that are older than the window. Must be called with the lock held.
+        """
+        failures: Deque[float] = self.failures.get(key, deque())
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            self.failures.pop(key, None)
+        return failures
+
+    def retry_after(self, key: str) -> float:
+        """
+        Returns the seconds until a key may try again, 0 when it isn't blocked.
+        """
+        if self.max_attempts <= 0:
+            return 0.0
+        now: float = time.monotonic()
+        with self.lock:
+            failures: Deque[float] = self.expire(key, now)
+            if len(failures) < self.max_attempts:
+                return 0.0
+            return failures[-self.max_attempts] + self.window - now
+
+    def fail(self, key: str) -> None:
+        """
+        Records a failed attempt of a key.
+        """
+        now: float = time.monotonic()
+        with self.lock:
+            self.expire(key, now)
+            failures: Deque[float] = self.failures.setdefault(key, deque())
+            failures.append(now)
+            # Only the newest max_attempts failures decide when the key is unblocked
+            while len(failures) > max(self.max_attempts, 1):
+                failures.popleft()
+            if len(self.failures) > self.max_keys:
+                for other in list(self.failures):
+                    self.expire(other, now)
+                # Still full: forget the keys that failed first
+                while len(self.failures) > self.max_keys:
+                    self.failures.pop(next(iter(self.failures)))
+
+    def reset(self, key: str) -> None:
+        """
+        Forgets the failures of a key, after a successful attempt.
+        """
+        with self.lock:
+            self.failures.pop(key, None)
+
+def create_hasher(config: configparser.ConfigParser) -> PasswordHasher:
+    """
+    Creates a PasswordHasher from the PBKDF2 section of config.ini.
+    """
+    iterations: int = config.getint('PBKDF2', 'iterations')
+    return PasswordHasher(
+        config['PBKDF2']['hash_name'],
+        iterations,
+        config.getint('PBKDF2', 'salt_length'),
+        config.getint('PBKDF2', 'dk_length'),
+        config.getint('PBKDF2', 'legacy_iterations', fallback=iterations),
+        config.getint('PBKDF2', 'legacy_salt_length', fallback=config.getint('PBKDF2', 'salt_length')),
+        config.getint('PBKDF2', 'workers', fallback=2),
+        config.getint('PBKDF2', 'max_pending', fallback=16),
+        config.getfloat('PBKDF2', 'timeout', fallback=10.0),
+    )
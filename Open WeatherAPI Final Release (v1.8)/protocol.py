@@ -0,0 +1,211 @@
+import math
+import zlib
+import struct
+import asyncio
+from typing import Any, List, Tuple, Union
+
+# Every frame starts with the magic bytes, so the server can tell it apart from the text lines of older clients
+MAGIC: bytes = b'OW'
+VERSION: int = 2
+
+# Frame header: magic, version, flags, payload length
+HEADER: struct.Struct = struct.Struct('!2sBBI')
+# Payload: device id length followed by the device id, then the outbox epoch and the number of readings
+DEVICE_LENGTH: struct.Struct = struct.Struct('!B')
+# The epoch is a random number a client picks when it creates its outbox. Sequence numbers only increase within
+# one epoch, a new one tells the server that the client starts counting again
+EPOCH: struct.Struct = struct.Struct('!I')
+COUNT: struct.Struct = struct.Struct('!H')
+# One reading: sequence number, sensor timestamp (seconds since the epoch), humidity, temperature, light level
+READING: struct.Struct = struct.Struct('!Idfff')
+# One aggregate: sequence number, timestamps of the first and last reading, number of readings,
+# then minimum, average and maximum of humidity, temperature and light level
+AGGREGATE: struct.Struct = struct.Struct('!IddI9f')
+
+# Flag of the frame the server sends back once the readings of a frame are stored, its payload is the highest sequence number
+FLAG_ACK: int = 0x01
+ACK: struct.Struct = struct.Struct('!I')
+# Flag of a frame whose records are aggregates instead of readings
+FLAG_AGGREGATE: int = 0x02
+# Flag of a frame whose payload is zlib-compressed, used for the bursts a client sends after an outage
+FLAG_COMPRESSED: int = 0x04
+
+# Upper bounds that keep a corrupt or hostile length field from allocating a huge buffer
+MAX_READINGS: int = 0xFFFF
+MAX_PAYLOAD: int = DEVICE_LENGTH.size + 255 + EPOCH.size + COUNT.size + MAX_READINGS * max(READING.size, AGGREGATE.size)
+# The number of readings an aggregate claims goes into the rollups, it is limited to MAX_READINGS and to
+# MAX_READING_RATE readings per second of its interval so one record cannot skew them without bound
+MAX_READING_RATE: float = 100.0
+
+# A reading on the wire: (sequence, timestamp, humidity, temperature, light_level)
+WireReading = Tuple[int, float, float, float, float]
+# An aggregate on the wire: (sequence, start, end, count, humidity min/avg/max, temperature min/avg/max, light_level min/avg/max)
+WireAggregate = Tuple[int, float, float, int, float, float, float, float, float, float, float, float, float]
+WireRecord = Union[WireReading, WireAggregate]
+
+class ProtocolError(ValueError):
+    """
+    Raised when a frame cannot be decoded.
+    """
+
+def parse_reading(raw_data: str) -> Tuple[float, float, float]:
+    """
+    Divides a serial line into humidity, temperature and light_level.
+    Accepts both 'humidity,temperature,light_level' and 'Humidity: x%, Temperature: y°C, Light Level: z'.
+
+    Parameters:
+    raw_data (str): The text line without its newline.
+
+    Returns:
+        Tuple[float, float, float]: The humidity, temperature and light level.
+    """
+    data_parts: list = raw_data.split(',')
+    if len(data_parts) != 3:
+        raise ValueError("Invalid data format")
+    if ':' in raw_data:
+        data_parts = [part.split(':', 1)[1] for part in data_parts]
+    humidity: float = float(data_parts[0].strip().rstrip('%'))
+    temperature: float = float(data_parts[1].strip().rstrip('C').rstrip('°'))
+    light_level: float = float(data_parts[2].strip())
+    return humidity, temperature, light_level
+
+def record_struct(flags: int) -> struct.Struct:
+    """
+    Returns the layout of the records of a frame with the given flags.
+    """
+    return AGGREGATE if flags & FLAG_AGGREGATE else READING
+
+def encode_frame(device_id: str, epoch: int, readings: List[WireRecord], flags: int = 0) -> bytes:
+    """
+    Packs a batch of readings, or of aggregates with FLAG_AGGREGATE, into one length-prefixed frame.
+    With FLAG_COMPRESSED the payload is compressed.
+
+    Parameters:
+    device_id (str): The id of the sending device (at most 255 bytes as UTF-8).
+    epoch (int): The epoch of the outbox the sequence numbers belong to.
+    readings (List[WireRecord]): The readings or aggregates to send.
+    flags (int): Frame flags.
+
+    Returns:
+        bytes: The encoded frame.
+    """
+    device: bytes = device_id.encode()
+    if len(device) > 255:
+        raise ProtocolError("Device id too long")
+    if len(readings) > MAX_READINGS:
+        raise ProtocolError("Too many readings in one frame")
+    payload: bytearray = bytearray(DEVICE_LENGTH.pack(len(device)))
+    payload += device
+    payload += EPOCH.pack(epoch & 0xFFFFFFFF)
+    payload += COUNT.pack(len(readings))
+    record: struct.Struct = record_struct(flags)
+    for sequence, *values in readings:
+        payload += record.pack(sequence & 0xFFFFFFFF, *values)
+    if flags & FLAG_COMPRESSED:
+        payload = bytearray(zlib.compress(bytes(payload)))
+    return HEADER.pack(MAGIC, VERSION, flags, len(payload)) + bytes(payload)
+
+def encode_ack(sequence: int) -> bytes:
+    """
+    Packs an acknowledgement for all readings up to and including a sequence number.
+
+    Parameters:
+    sequence (int): The highest stored sequence number.
+
+    Returns:
+        bytes: The encoded acknowledgement frame.
+    """
+    return HEADER.pack(MAGIC, VERSION, FLAG_ACK, ACK.size) + ACK.pack(sequence & 0xFFFFFFFF)
+
+def decode_header(header: bytes) -> Tuple[int, int]:
+    """
+    Checks a frame header and returns its flags and payload length.
+
+    Parameters:
+    header (bytes): The HEADER.size bytes at the start of a frame.
+
+    Returns:
+        Tuple[int, int]: The flags and the payload length.
+    """
+    magic, version, flags, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError("Invalid magic bytes")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version: {version}")
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Payload too large: {length}")
+    return flags, length
+
+def decompress_payload(payload: bytes) -> bytes:
+    """
+    Decompresses the payload of a FLAG_COMPRESSED frame, refusing to inflate it beyond MAX_PAYLOAD.
+    """
+    decompressor: Any = zlib.decompressobj()
+    try:
+        data: bytes = decompressor.decompress(payload, MAX_PAYLOAD + 1)
+    except zlib.error as e:
+        raise ProtocolError(f"Invalid compressed payload: {e}") from e
+    if len(data) > MAX_PAYLOAD or decompressor.unconsumed_tail or not decompressor.eof:
+        raise ProtocolError("Invalid compressed payload")
+    return data
+
+def aggregate_limit(start: float, end: float) -> int:
+    """
+    Returns the highest number of readings an aggregate of the interval from start to end may claim.
+    Intervals the server cannot trust are replaced by the time of receipt, they only get MAX_READINGS.
+    """
+    duration: float = end - start
+    if not math.isfinite(duration) or duration < 0:
+        return MAX_READINGS
+    return min(MAX_READINGS, int(duration * MAX_READING_RATE) + 1)
+
+def decode_payload(payload: bytes, flags: int = 0) -> Tuple[str, int, List[WireRecord]]:
+    """
+    Unpacks the device id, the outbox epoch and the readings, or aggregates, from a frame payload.
+
+    Parameters:
+    payload (bytes): The payload following the header.
+    flags (int): The flags of the frame.
+
+    Returns:
+        Tuple[str, int, List[WireRecord]]: The device id, the epoch and the records.
+    """
+    if flags & FLAG_COMPRESSED:
+        payload = decompress_payload(payload)
+    record: struct.Struct = record_struct(flags)
+    try:
+        (device_length,) = DEVICE_LENGTH.unpack_from(payload, 0)
+        offset: int = DEVICE_LENGTH.size
+        device_id: str = payload[offset:offset + device_length].decode()
+        offset += device_length
+        (epoch,) = EPOCH.unpack_from(payload, offset)
+        offset += EPOCH.size
+        (count,) = COUNT.unpack_from(payload, offset)
+        offset += COUNT.size
+        if len(payload) != offset + count * record.size:
+            raise ProtocolError("Payload length does not match the number of readings")
+        readings: List[WireRecord] = list(record.iter_unpack(payload[offset:]))
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ProtocolError(str(e)) from e
+    if flags & FLAG_AGGREGATE:
+        for _, start, end, aggregate_count, *_ in readings:
+            if not 0 < aggregate_count <= aggregate_limit(start, end):
+                raise ProtocolError(f"Invalid number of readings in an aggregate: {aggregate_count}")
+    return device_id, epoch, readings
+
+async def read_frame(reader: asyncio.StreamReader, magic: bytes = b'') -> Tuple[int, str, int, List[WireRecord]]:
+    """
+    Reads one complete frame from a stream.
+
+    Parameters:
+    reader (asyncio.StreamReader): The stream to read from.
+    magic (bytes): Bytes of the header that have already been read from the stream.
+
+    Returns:
+        Tuple[int, str, int, List[WireRecord]]: The flags, device id, outbox epoch and readings (aggregates with FLAG_AGGREGATE).
+    """
+    header: bytes = magic + await reader.readexactly(HEADER.size - len(magic))
+    flags, length = decode_header(header)
+    payload: bytes = await reader.readexactly(length)
+    device_id, epoch, readings = decode_payload(payload, flags)
+    return flags, device_id, epoch, readings
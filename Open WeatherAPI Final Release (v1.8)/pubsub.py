@@ -0,0 +1,155 @@
+import json
+import queue
+import socket
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+class Broker:
+    """
+    In-process publish/subscribe: every subscriber gets its own bounded queue of messages.
+    A subscriber that falls behind loses its oldest messages instead of blocking the publisher.
+    """
+
+    def __init__(self, queue_size: int) -> None:
+        self.queue_size: int = queue_size
+        self.subscribers: List[queue.Queue] = []
+        self.lock: threading.Lock = threading.Lock()
+
+    def subscribe(self) -> queue.Queue:
+        """
+        Registers a new subscriber and returns the queue its messages arrive on.
+        """
+        subscriber: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue) -> None:
+        """
+        Removes a subscriber.
+        """
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def has_subscribers(self) -> bool:
+        """
+        Returns whether anyone is listening.
+        """
+        with self.lock:
+            return bool(self.subscribers)
+
+    def publish(self, message: str) -> None:
+        """
+        Delivers a message to every subscriber.
+        """
+        with self.lock:
+            subscribers: List[queue.Queue] = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+                subscriber.put_nowait(message)
+
+def notify_ingest(address: Optional[Tuple[str, int]], table_name: str) -> None:
+    """
+    Tells the web process that new rows were committed to a table. Errors are ignored:
+    the web process falls back to checking the database every poll interval.
+
+    Parameters:
+    address (Optional[Tuple[str, int]]): The UDP address the web process listens on, None to disable.
+    table_name (str): The table that received new rows.
+    """
+    if address is None:
+        return
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.sendto(table_name.encode(), address)
+    except OSError:
+        pass
+
+class IngestWatcher(threading.Thread):
+    """
+    Background thread of the web process that turns ingest notifications into new rows for its handlers.
+
+    One watcher reads each new row once and passes it to every handler (the SSE broker, the cache), so
+    the number of open dashboards doesn't change the number of database queries. Only one process can
+    bind the notification port; in other processes the watcher checks the database every poll_interval.
+    """
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection], tables: Tuple[str, ...], fields: Tuple[str, ...],
+                 address: Optional[Tuple[str, int]], poll_interval: float, start_ids: Dict[str, int]) -> None:
+        super().__init__(daemon=True)
+        # Opens the connection the thread keeps for itself, like ConnectionPool.connect
+        self.connect: Callable[[], sqlite3.Connection] = connect
+        self.tables: Tuple[str, ...] = tables
+        self.fields: Tuple[str, ...] = fields
+        self.poll_interval: float = poll_interval
+        self.last_ids: Dict[str, int] = dict(start_ids)
+        self.handlers: List[Callable[[str, List[Tuple]], None]] = []
+
+        # Bind right away so the caller knows whether new rows will be pushed
+        self.listener: Optional[socket.socket] = None
+        if address is not None:
+            listener: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                listener.bind(address)
+                listener.settimeout(poll_interval)
+                self.listener = listener
+            except OSError:
+                listener.close()
+
+    @property
+    def listening(self) -> bool:
+        """
+        Returns whether this watcher receives the ingest notifications.
+        """
+        return self.listener is not None
+
+    def add_handler(self, handler: Callable[[str, List[Tuple]], None]) -> None:
+        """
+        Registers a function called with the table name and the new rows (tuples in fields order).
+        """
+        self.handlers.append(handler)
+
+    def run(self) -> None:
+        """
+        Waits for notifications (or the poll interval) and hands the rows added since the last check to the handlers.
+        """
+        conn: sqlite3.Connection = self.connect()
+        while True:
+            if self.listener is not None:
+                try:
+                    self.listener.recvfrom(256)
+                except socket.timeout:
+                    pass
+            else:
+                time.sleep(self.poll_interval)
+
+            try:
+                for table in self.tables:
+                    rows: List[Tuple] = conn.execute(f'''
+                        SELECT {', '.join(self.fields)} FROM {table} WHERE id > ? ORDER BY id
+                    ''', (self.last_ids[table],)).fetchall()
+                    if not rows:
+                        continue
+                    self.last_ids[table] = rows[-1][0]
+                    for handler in self.handlers:
+                        handler(table, rows)
+            except sqlite3.Error as e:
+                print("Ingest watcher error:", e)
+
+def publish_rows(broker: Broker, fields: Tuple[str, ...], table: str, rows: List[Tuple]) -> None:
+    """
+    Publishes new rows as JSON messages, one per reading (each carries the id of its device).
+    """
+    if not broker.has_subscribers():
+        return
+    for row in rows:
+        broker.publish(json.dumps(dict(zip(fields, row)), separators=(',', ':')))
@@ -1,6 +1,15 @@
 import serial
 import socket
+import sqlite3
+import random
+import threading
+import time
+import itertools
 import configparser
+from typing import Any, List, Tuple
+from edge import EdgeProcessor, Record, create_processor
+from protocol import (ACK, FLAG_ACK, FLAG_AGGREGATE, FLAG_COMPRESSED, HEADER, ProtocolError, WireRecord, decode_header,
+                      encode_frame, parse_reading)
 
 # Load configurations from config.ini
 config = configparser.ConfigParser()
@@ -14,39 +23,229 @@ BAUD_RATE = config.getint('SERIAL_PORT', 'baudrate')
 SERVER_IP = config['SERVER']['ip']
 SERVER_PORT = config.getint('SERVER', 'port')
 
-with serial.Serial(SERIAL_PORT, BAUD_RATE) as ser:
+# Device id sent with every frame and the number of readings packed into one frame
+DEVICE_ID: str = config.get('CLIENT', 'device_id', fallback=socket.gethostname())
+BATCH_SIZE: int = config.getint('CLIENT', 'batch_size', fallback=1)
+FLUSH_INTERVAL: float = config.getfloat('CLIENT', 'flush_interval', fallback=5.0)
+
+# Local buffer that keeps readings while the server is unreachable
+BUFFER_PATH: str = config.get('CLIENT', 'buffer_path', fallback='client_buffer.db')
+MAX_BUFFERED: int = config.getint('CLIENT', 'max_buffered', fallback=100000)
+DRAIN_BATCH: int = config.getint('CLIENT', 'drain_batch', fallback=500)
+
+# Reconnect backoff and how long to wait for the server to acknowledge a frame
+RECONNECT_MIN: float = config.getfloat('CLIENT', 'reconnect_min', fallback=1.0)
+RECONNECT_MAX: float = config.getfloat('CLIENT', 'reconnect_max', fallback=60.0)
+ACK_TIMEOUT: float = config.getfloat('CLIENT', 'ack_timeout', fallback=30.0)
+
+# Frames of at least this many readings, like the backlog sent after an outage, are compressed (0 never compresses)
+COMPRESS_MIN: int = config.getint('CLIENT', 'compress_min', fallback=0)
+
+# Columns the outbox has besides those of a reading, NULL for readings, filled in for aggregates
+AGGREGATE_COLUMNS: Tuple[str, ...] = (
+    'end_time', 'count', 'humidity_min', 'humidity_max', 'temperature_min', 'temperature_max',
+    'light_level_min', 'light_level_max',
+)
+
+def open_buffer(path: str) -> sqlite3.Connection:
+    """
+    Opens the on-disk buffer and creates the outbox table if it doesn't exist.
+    The AUTOINCREMENT id is used as sequence number, so it keeps increasing across restarts. A new buffer
+    gets a random epoch that is sent with every frame, so the server knows the sequence numbers start again.
+    An aggregate is stored with its averages as values and its other statistics in the AGGREGATE_COLUMNS.
+
+    Parameters:
+    path (str): The path of the buffer database.
+
+    Returns:
+        sqlite3.Connection: The connection to the buffer.
+    """
+    conn: sqlite3.Connection = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp REAL,
+        humidity REAL,
+        temperature REAL,
+        light_level REAL
+        )
+    ''')
+    # Buffers of older versions are extended rather than recreated, so buffered readings aren't lost
+    existing: List[str] = [row[1] for row in conn.execute('PRAGMA table_info(outbox)')]
+    for column in AGGREGATE_COLUMNS:
+        if column not in existing:
+            conn.execute(f'ALTER TABLE outbox ADD COLUMN {column} {"INTEGER" if column == "count" else "REAL"}')
+    conn.execute('CREATE TABLE IF NOT EXISTS outbox_epoch (epoch INTEGER NOT NULL)')
+    conn.execute('INSERT INTO outbox_epoch SELECT ? WHERE NOT EXISTS (SELECT 1 FROM outbox_epoch)', (random.getrandbits(32),))
+    conn.commit()
+    return conn
+
+def outbox_row(record: Record) -> Tuple:
     """
-    Connects to the server and sends sensor data read from the serial port.
+    Returns the outbox columns of a reading or an aggregate, in the order of the INSERT in store_readings.
     """
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        # Connect to the server
-        s.connect((SERVER_IP, SERVER_PORT))
-        print(f"Connected to server at {SERVER_IP}:{SERVER_PORT}")
+    if len(record) == 4:
+        return tuple(record) + (None,) * len(AGGREGATE_COLUMNS)
+    start, end, count, humidity_min, humidity, humidity_max, temperature_min, temperature, temperature_max, \
+        light_level_min, light_level, light_level_max = record
+    return (start, humidity, temperature, light_level, end, count, humidity_min, humidity_max,
+            temperature_min, temperature_max, light_level_min, light_level_max)
 
-        while True:
-            # Read data from serial port
-            raw_data: str = ser.readline().decode().strip()
-            print("Raw data:", raw_data)
-            
-            # Send raw data to the server
-            s.sendall(raw_data.encode())
-            print("Sent raw data:", raw_data)
-            
-            # Skip lines that don't contain valid sensor data
-            if not raw_data.startswith("Humidity:") or ',' not in raw_data:
-                continue
-            
-            # Make the data
+def outbox_epoch(conn: sqlite3.Connection) -> int:
+    """
+    Returns the epoch of the outbox, which the sequence numbers of its rows belong to.
+    """
+    return conn.execute('SELECT epoch FROM outbox_epoch').fetchone()[0]
+
+def store_readings(conn: sqlite3.Connection, readings: List[Record]) -> None:
+    """
+    Appends readings and aggregates to the outbox and drops the oldest ones when it holds more than MAX_BUFFERED.
+
+    Parameters:
+    conn (sqlite3.Connection): The connection to the buffer.
+    readings (List[Record]): (timestamp, humidity, temperature, light_level) tuples or aggregates of edge.py.
+    """
+    columns: Tuple[str, ...] = ('timestamp', 'humidity', 'temperature', 'light_level') + AGGREGATE_COLUMNS
+    with conn:
+        conn.executemany(
+            f'INSERT INTO outbox ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+            [outbox_row(reading) for reading in readings],
+        )
+        cursor: sqlite3.Cursor = conn.execute('DELETE FROM outbox WHERE seq <= (SELECT MAX(seq) FROM outbox) - ?', (MAX_BUFFERED,))
+    if cursor.rowcount > 0:
+        print("Buffer full, dropped", cursor.rowcount, "oldest readings")
+
+def collect(ser: Any, new_data: threading.Event) -> None:
+    """
+    Reads the serial port and stores the readings in the outbox, whether or not the server is reachable.
+    Readings first pass the deadband and aggregation configured in the CLIENT section.
+
+    Parameters:
+    ser (Any): The opened serial port.
+    new_data (threading.Event): Set whenever readings were stored.
+    """
+    conn: sqlite3.Connection = open_buffer(BUFFER_PATH)
+    processor: EdgeProcessor = create_processor(config)
+    batch: List[Record] = []
+    batch_started: float = time.monotonic()
+
+    while True:
+        # Read data from serial port, the timeout lets a partial batch be stored when the sensor goes quiet
+        raw_data: str = ser.readline().decode(errors='replace').strip()
+
+        # Skip empty lines and the start-up message of the Arduino
+        records: List[Record] = []
+        if raw_data and 'Loading measurements...' not in raw_data:
             try:
-                _, humidity_str, _, temperature_str, _, light_level_str = raw_data.split(',')
-                humidity: float = float(humidity_str.split(':')[1].strip())
-                temperature: float = float(temperature_str.split(':')[1].strip())
-                light_level: float = float(light_level_str.split(':')[1].strip())
+                humidity, temperature, light_level = parse_reading(raw_data)
             except ValueError:
                 print("Invalid data format:", raw_data)
-                continue
-            
-            # Send data to the server
-            message: str = f"Humidity: {humidity}%, Temperature: {temperature}°C, Light Level: {light_level}"
-            s.sendall(message.encode())
-            print("Sent parsed data:", message)
+            else:
+                records = processor.add((time.time(), humidity, temperature, light_level))
+
+        # An interval that ended while the sensor was quiet is sent without waiting for the next reading
+        records += processor.poll(time.time())
+        if records and not batch:
+            batch_started = time.monotonic()
+        batch.extend(records)
+
+        if batch and (len(batch) >= BATCH_SIZE or time.monotonic() - batch_started >= FLUSH_INTERVAL):
+            store_readings(conn, batch)
+            batch = []
+            new_data.set()
+
+def receive_exactly(s: socket.socket, size: int) -> bytes:
+    """
+    Receives exactly size bytes from a socket.
+    """
+    data: bytearray = bytearray()
+    while len(data) < size:
+        chunk: bytes = s.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by server")
+        data += chunk
+    return bytes(data)
+
+def receive_ack(s: socket.socket) -> int:
+    """
+    Waits for the acknowledgement frame of the server.
+
+    Returns:
+        int: The highest sequence number the server has stored.
+    """
+    flags, length = decode_header(receive_exactly(s, HEADER.size))
+    if not flags & FLAG_ACK or length != ACK.size:
+        raise ProtocolError("Expected an acknowledgement")
+    (sequence,) = ACK.unpack(receive_exactly(s, ACK.size))
+    return sequence
+
+def drain(s: socket.socket, conn: sqlite3.Connection, new_data: threading.Event) -> None:
+    """
+    Sends the outbox to the server in bulk frames and removes readings once they are acknowledged.
+    Readings and aggregates go in separate frames, large frames are compressed.
+    Returns only by raising when the connection fails.
+
+    Parameters:
+    s (socket.socket): The connected socket.
+    conn (sqlite3.Connection): The connection to the buffer.
+    new_data (threading.Event): Set by the collector whenever readings were stored.
+    """
+    epoch: int = outbox_epoch(conn)
+    while True:
+        new_data.clear()
+        rows: List[Tuple] = conn.execute('''
+            SELECT seq, timestamp, end_time, count, humidity_min, humidity, humidity_max,
+            temperature_min, temperature, temperature_max, light_level_min, light_level, light_level_max
+            FROM outbox
+            ORDER BY seq
+            LIMIT ?
+        ''', (DRAIN_BATCH,)).fetchall()
+        if not rows:
+            new_data.wait(FLUSH_INTERVAL)
+            continue
+
+        # A frame holds one kind of record, so send the rows up to the first one of the other kind
+        aggregate: bool = rows[0][3] is not None
+        rows = list(itertools.takewhile(lambda row: (row[3] is not None) == aggregate, rows))
+        flags: int = FLAG_AGGREGATE if aggregate else 0
+        if 0 < COMPRESS_MIN <= len(rows):
+            flags |= FLAG_COMPRESSED
+        records: List[WireRecord] = [row if aggregate else (row[0], row[1], row[5], row[8], row[11]) for row in rows]
+        s.sendall(encode_frame(DEVICE_ID, epoch, records, flags))
+        acked: int = receive_ack(s)
+        with conn:
+            conn.execute('DELETE FROM outbox WHERE seq <= ?', (acked,))
+        print("Sent", len(rows), "readings")
+
+def main() -> None:
+    """
+    Collects sensor data from the serial port in a background thread and forwards it to the server,
+    reconnecting with exponential backoff whenever the connection is lost.
+    """
+    new_data: threading.Event = threading.Event()
+    conn: sqlite3.Connection = open_buffer(BUFFER_PATH)
+
+    with serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=FLUSH_INTERVAL) as ser:
+        threading.Thread(target=collect, args=(ser, new_data), daemon=True).start()
+
+        delay: float = RECONNECT_MIN
+        while True:
+            try:
+                with socket.create_connection((SERVER_IP, SERVER_PORT), timeout=ACK_TIMEOUT) as s:
+                    print(f"Connected to server at {SERVER_IP}:{SERVER_PORT}")
+                    delay = RECONNECT_MIN
+                    drain(s, conn, new_data)
+            except (OSError, ProtocolError) as e:
+                print("Connection to server lost:", e)
+
+            # Wait before reconnecting, with jitter so several Pis don't reconnect at the same moment
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, RECONNECT_MAX)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Stopping...")
@@ -0,0 +1,414 @@
+import time
+import sqlite3
+import configparser
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from aggregates import MAX_TIMESTAMP, create_aggregate_triggers, setup_aggregates, subtract_aggregates
+
+# View over all partitions, used by queries that are not limited to a time range
+READINGS_TABLE: str = 'readings'
+
+# Readings are stored in one table per UTC month or day, named readings_<YYYYMM> or readings_<YYYYMMDD>
+PARTITION_PREFIX: str = 'readings_'
+PARTITION_FORMATS: Dict[str, str] = {
+    'month': '%Y%m',
+    'day': '%Y%m%d',
+}
+
+# Columns of a stored reading, timestamp is in milliseconds since the epoch
+READING_FIELDS: Tuple[str, ...] = ('id', 'device_id', 'timestamp', 'humidity', 'temperature', 'light_level')
+
+# Tables of older versions, moved into the partitions by migrate.py
+LEGACY_TABLES: Tuple[str, ...] = ('sensor_data', 'second_sensor_data', 'legacy_readings')
+
+# Columns of a device in the registry
+DEVICE_FIELDS: Tuple[str, ...] = ('device_id', 'name', 'latitude', 'longitude', 'first_seen', 'last_seen')
+
+def now_ms() -> int:
+    """
+    Returns the current time in milliseconds since the epoch.
+    """
+    return int(time.time() * 1000)
+
+def retire_text_readings(cursor: sqlite3.Cursor) -> bool:
+    """
+    Moves the readings table of the previous version, which stored text timestamps in a single table,
+    out of the way as legacy_readings so migrate.py can convert it. Its device registry, which had text
+    first_seen and last_seen columns, is renamed to legacy_devices.
+
+    Returns:
+        bool: Whether there was a table to retire.
+    """
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = ?", (READINGS_TABLE,))
+    row: Optional[Tuple[str]] = cursor.fetchone()
+    if row is None or row[0] != 'table':
+        return False
+    cursor.execute(f'DROP TRIGGER IF EXISTS {READINGS_TABLE}_register_device')
+    cursor.execute(f'DROP INDEX IF EXISTS idx_{READINGS_TABLE}_device_timestamp')
+    cursor.execute(f'ALTER TABLE {READINGS_TABLE} RENAME TO legacy_readings')
+    cursor.execute('ALTER TABLE devices RENAME TO legacy_devices')
+    return True
+
+def create_readings_tables(cursor: sqlite3.Cursor) -> None:
+    """
+    Creates the device registry, the partition registry, the id counter and the view over the partitions.
+    """
+    retired: bool = retire_text_readings(cursor)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS devices (
+        device_id TEXT PRIMARY KEY,
+        name TEXT,
+        latitude REAL,
+        longitude REAL,
+        first_seen INTEGER,
+        last_seen INTEGER,
+        last_sequence INTEGER,
+        last_epoch INTEGER
+        )
+    ''')
+    # The last sequence number of the binary protocol that was committed and the outbox epoch it belongs to,
+    # so resent records are dropped
+    cursor.execute('PRAGMA table_info(devices)')
+    existing: List[str] = [row[1] for row in cursor.fetchall()]
+    for column in ('last_sequence', 'last_epoch'):
+        if column not in existing:
+            cursor.execute(f'ALTER TABLE devices ADD COLUMN {column} INTEGER')
+    if retired:
+        # first_seen and last_seen are filled in again, as milliseconds, when the readings are migrated
+        cursor.execute('INSERT INTO devices (device_id, name, latitude, longitude) SELECT device_id, name, latitude, longitude FROM legacy_devices')
+        cursor.execute('DROP TABLE legacy_devices')
+    # Aggregates of the edge pre-processing register their device like readings do
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS edge_aggregates_register_device
+        AFTER INSERT ON edge_aggregates
+        BEGIN
+            INSERT INTO devices (device_id, first_seen, last_seen) VALUES (NEW.device_id, NEW.start_ms, NEW.end_ms)
+            ON CONFLICT (device_id) DO UPDATE SET
+            first_seen = MIN(COALESCE(first_seen, excluded.first_seen), excluded.first_seen),
+            last_seen = MAX(COALESCE(last_seen, excluded.last_seen), excluded.last_seen);
+        END;
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reading_partitions (
+        name TEXT PRIMARY KEY,
+        start_ms INTEGER NOT NULL,
+        end_ms INTEGER NOT NULL
+        )
+    ''')
+
+    # Ids are handed out from one counter, so they are unique and increasing over all partitions
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reading_ids (
+        last_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT INTO reading_ids SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM reading_ids)')
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'view' AND name = ?", (READINGS_TABLE,))
+    if cursor.fetchone() is None:
+        create_readings_view(cursor)
+
+def create_readings_view(cursor: sqlite3.Cursor) -> None:
+    """
+    (Re)creates the readings view as the UNION ALL of every partition.
+    """
+    cursor.execute(f'DROP VIEW IF EXISTS {READINGS_TABLE}')
+    cursor.execute(f'CREATE VIEW {READINGS_TABLE} AS {union_select(list_partitions(cursor))}')
+
+def union_select(partitions: List[str]) -> str:
+    """
+    Builds a SELECT of every reading column over the given partitions.
+    Without partitions the SELECT has the same columns but no rows.
+    """
+    columns: str = ', '.join(READING_FIELDS)
+    if not partitions:
+        return f'SELECT {", ".join(f"NULL AS {field}" for field in READING_FIELDS)} WHERE 0'
+    return ' UNION ALL '.join(f'SELECT {columns} FROM {partition}' for partition in partitions)
+
+def partition_bounds(timestamp: int, granularity: str) -> Tuple[str, int, int]:
+    """
+    Returns the partition a timestamp belongs to.
+
+    Parameters:
+    timestamp (int): Milliseconds since the epoch.
+    granularity (str): 'month' or 'day'.
+
+    Returns:
+        Tuple[str, int, int]: The partition table name and its first and last millisecond.
+    """
+    if granularity not in PARTITION_FORMATS:
+        raise ValueError(f"Invalid partition granularity: {granularity}")
+    moment: datetime = datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc)
+    if granularity == 'day':
+        start: datetime = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        end: datetime = datetime.fromordinal(start.toordinal() + 1).replace(tzinfo=timezone.utc)
+    else:
+        start = moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    name: str = PARTITION_PREFIX + start.strftime(PARTITION_FORMATS[granularity])
+    return name, int(start.timestamp() * 1000), int(end.timestamp() * 1000) - 1
+
+def ensure_partition(cursor: sqlite3.Cursor, timestamp: int, granularity: str) -> str:
+    """
+    Returns the partition for a timestamp, creating it with its index and triggers when it doesn't exist yet.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    timestamp (int): Milliseconds since the epoch.
+    granularity (str): 'month' or 'day'.
+
+    Returns:
+        str: The partition table name.
+    """
+    name, start, end = partition_bounds(timestamp, granularity)
+    cursor.execute('SELECT 1 FROM reading_partitions WHERE name = ?', (name,))
+    if cursor.fetchone() is not None:
+        return name
+
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY,
+        device_id TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        humidity REAL,
+        temperature REAL,
+        light_level REAL
+        )
+    ''')
+    # The values are part of the index, so range queries and latest-per-device lookups never read the table
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS idx_{name}_device_timestamp
+        ON {name} (device_id, timestamp, humidity, temperature, light_level)
+    ''')
+    # Every insert registers its device and moves the device's last_seen forward
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {name}_register_device
+        AFTER INSERT ON {name}
+        BEGIN
+            INSERT INTO devices (device_id, first_seen, last_seen) VALUES (NEW.device_id, NEW.timestamp, NEW.timestamp)
+            ON CONFLICT (device_id) DO UPDATE SET
+            first_seen = MIN(COALESCE(first_seen, excluded.first_seen), excluded.first_seen),
+            last_seen = MAX(COALESCE(last_seen, excluded.last_seen), excluded.last_seen);
+        END;
+    ''')
+    create_aggregate_triggers(cursor, name)
+    cursor.execute('INSERT INTO reading_partitions VALUES (?, ?, ?)', (name, start, end))
+    create_readings_view(cursor)
+    return name
+
+def drop_partition(cursor: sqlite3.Cursor, name: str) -> int:
+    """
+    Drops a whole partition, subtracting its readings from the per-device aggregates first.
+    The rollups keep the history of the dropped readings.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    name (str): The partition table name.
+
+    Returns:
+        int: The number of dropped readings.
+    """
+    cursor.execute(f'SELECT COUNT(*) FROM {name}')
+    count: int = cursor.fetchone()[0]
+    subtract_aggregates(cursor, name)
+    cursor.execute(f'DROP TABLE {name}')
+    cursor.execute('DELETE FROM reading_partitions WHERE name = ?', (name,))
+    create_readings_view(cursor)
+    return count
+
+def list_partitions(cursor: sqlite3.Cursor, start: int = 0, end: int = MAX_TIMESTAMP) -> List[str]:
+    """
+    Returns the partitions that overlap a time range, oldest first.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    start (int): Start of the range in milliseconds since the epoch.
+    end (int): End of the range in milliseconds since the epoch.
+
+    Returns:
+        List[str]: The partition table names.
+    """
+    cursor.execute('''
+        SELECT name FROM reading_partitions WHERE end_ms >= ? AND start_ms <= ? ORDER BY start_ms
+    ''', (start, end))
+    return [row[0] for row in cursor.fetchall()]
+
+def range_source(cursor: sqlite3.Cursor, start: int, end: int) -> str:
+    """
+    Returns what to put after FROM to read the readings of a time range, so only the partitions
+    that overlap the range are scanned.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    start (int): Start of the range in milliseconds since the epoch.
+    end (int): End of the range in milliseconds since the epoch.
+
+    Returns:
+        str: A partition table name or a parenthesized UNION ALL subquery.
+    """
+    partitions: List[str] = list_partitions(cursor, start, end)
+    if len(partitions) == 1:
+        return partitions[0]
+    return f'({union_select(partitions)})'
+
+def insert_readings(cursor: sqlite3.Cursor, readings: Iterable[Tuple], granularity: str) -> int:
+    """
+    Inserts readings into their partitions, creating partitions as needed.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object, inside a transaction.
+    readings (Iterable[Tuple]): (device_id, timestamp, humidity, temperature, light_level) tuples,
+        timestamp in milliseconds since the epoch.
+    granularity (str): 'month' or 'day'.
+
+    Returns:
+        int: The number of inserted readings.
+    """
+    readings = list(readings)
+    if not readings:
+        return 0
+    cursor.execute('UPDATE reading_ids SET last_id = last_id + ? RETURNING last_id', (len(readings),))
+    next_id: int = cursor.fetchone()[0] - len(readings) + 1
+
+    partitions: Dict[str, List[Tuple]] = {}
+    name, start, end = '', 0, -1
+    for reading in readings:
+        # Batches rarely cross a partition boundary, so the partition is only looked up when it changes
+        if not start <= reading[1] <= end:
+            name, start, end = partition_bounds(reading[1], granularity)
+            ensure_partition(cursor, reading[1], granularity)
+        partitions.setdefault(name, []).append((next_id,) + tuple(reading))
+        next_id += 1
+
+    for name, rows in partitions.items():
+        cursor.executemany(f'''
+            INSERT INTO {name} ({', '.join(READING_FIELDS)}) VALUES ({', '.join('?' for _ in READING_FIELDS)})
+        ''', rows)
+    return len(readings)
+
+def last_reading_id(cursor: sqlite3.Cursor) -> int:
+    """
+    Returns the id handed to the newest reading, or 0 when there are none.
+    """
+    cursor.execute('SELECT last_id FROM reading_ids')
+    row: Optional[Tuple[int]] = cursor.fetchone()
+    return row[0] if row is not None else 0
+
+def register_device(cursor: sqlite3.Cursor, device_id: str, name: Optional[str] = None,
+                    latitude: Optional[float] = None, longitude: Optional[float] = None) -> None:
+    """
+    Adds a device to the registry or updates its name and location.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    device_id (str): The id the device sends its readings with.
+    name (Optional[str]): The name shown on the dashboard.
+    latitude (Optional[float]): The latitude of the device.
+    longitude (Optional[float]): The longitude of the device.
+    """
+    cursor.execute('''
+        INSERT INTO devices (device_id, name, latitude, longitude) VALUES (?, ?, ?, ?)
+        ON CONFLICT (device_id) DO UPDATE SET
+        name = COALESCE(excluded.name, name),
+        latitude = COALESCE(excluded.latitude, latitude),
+        longitude = COALESCE(excluded.longitude, longitude)
+    ''', (device_id, name, latitude, longitude))
+
+def load_sequences(cursor: sqlite3.Cursor) -> Dict[str, Tuple[Optional[int], int]]:
+    """
+    Returns the outbox epoch and the last committed sequence number of every device that sent records with
+    the binary protocol. The epoch is None for sequence numbers committed before epochs were stored.
+    """
+    cursor.execute('SELECT device_id, last_epoch, last_sequence FROM devices WHERE last_sequence IS NOT NULL')
+    return {device_id: (epoch, sequence) for device_id, epoch, sequence in cursor.fetchall()}
+
+def save_sequences(cursor: sqlite3.Cursor, sequences: Dict[str, Tuple[int, int]]) -> None:
+    """
+    Stores the outbox epoch and the last sequence number per device, in the transaction that writes the
+    readings of those records.
+    """
+    cursor.executemany('''
+        INSERT INTO devices (device_id, last_epoch, last_sequence) VALUES (?, ?, ?)
+        ON CONFLICT (device_id) DO UPDATE SET last_epoch = excluded.last_epoch, last_sequence = excluded.last_sequence
+    ''', [(device_id, epoch, sequence) for device_id, (epoch, sequence) in sequences.items()])
+
+def register_configured_devices(cursor: sqlite3.Cursor, config: configparser.ConfigParser) -> None:
+    """
+    Registers every device that has a DEVICE:<device_id> section in config.ini.
+    """
+    for section in config.sections():
+        if section.startswith('DEVICE:'):
+            register_device(
+                cursor, section[len('DEVICE:'):],
+                config.get(section, 'name', fallback=None),
+                config.getfloat(section, 'latitude', fallback=None),
+                config.getfloat(section, 'longitude', fallback=None),
+            )
+
+def setup_readings(cursor: sqlite3.Cursor, config: Optional[configparser.ConfigParser] = None) -> None:
+    """
+    Creates the readings schema and its aggregates, and registers the devices from config.ini.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    config (Optional[configparser.ConfigParser]): The loaded configuration.
+    """
+    setup_aggregates(cursor)
+    create_readings_tables(cursor)
+    if config is not None:
+        register_configured_devices(cursor, config)
+
+def partition_granularity(config: configparser.ConfigParser) -> str:
+    """
+    Reads the partition granularity from the STORAGE section of config.ini.
+    """
+    granularity: str = config.get('STORAGE', 'partition', fallback='month')
+    if granularity not in PARTITION_FORMATS:
+        raise ValueError(f"Invalid partition in config.ini: {granularity}")
+    return granularity
+
+def legacy_tables(cursor: sqlite3.Cursor) -> List[str]:
+    """
+    Returns the tables of older versions that still have to be migrated.
+    """
+    cursor.execute(f'''
+        SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ({', '.join('?' for _ in LEGACY_TABLES)})
+    ''', LEGACY_TABLES)
+    return [row[0] for row in cursor.fetchall()]
+
+def list_devices(cursor: sqlite3.Cursor) -> List[Dict[str, Any]]:
+    """
+    Returns the registered devices ordered by id.
+    """
+    cursor.execute(f'SELECT {", ".join(DEVICE_FIELDS)} FROM devices ORDER BY device_id')
+    return [dict(zip(DEVICE_FIELDS, row)) for row in cursor.fetchall()]
+
+def latest_per_device(cursor: sqlite3.Cursor, fields: Tuple[str, ...]) -> List[Tuple]:
+    """
+    Returns the newest reading of every registered device in one query.
+    The registry knows when each device was last seen, so every device costs a single seek at the end
+    of its range of the (device_id, timestamp) index of the partition holding that moment.
+
+    Parameters:
+    cursor (sqlite3.Cursor): The cursor object.
+    fields (Tuple[str, ...]): The reading columns to return.
+
+    Returns:
+        List[Tuple]: One row per device that has readings, ordered by device id.
+    """
+    cursor.execute('''
+        SELECT d.device_id, p.name
+        FROM devices d
+        JOIN reading_partitions p ON d.last_seen BETWEEN p.start_ms AND p.end_ms
+        ORDER BY d.device_id
+    ''')
+    lookups: List[Tuple[str, str]] = cursor.fetchall()
+    if not lookups:
+        return []
+    cursor.execute(' UNION ALL '.join(f'''
+        SELECT * FROM (
+            SELECT {', '.join(fields)} FROM {partition} WHERE device_id = ? ORDER BY timestamp DESC LIMIT 1
+        )''' for _, partition in lookups
+    ), [device_id for device_id, _ in lookups])
+    return cursor.fetchall()
@@ -0,0 +1,175 @@
+import time
+import queue
+import random
+import sqlite3
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Dict, Optional, Tuple
+
+# Fields of a request record, written after the message in this order
+REQUEST_FIELDS: Tuple[str, ...] = ('method', 'path', 'endpoint', 'status', 'duration_ms', 'db_ms', 'db_queries', 'bytes')
+
+class RequestFormatter(logging.Formatter):
+    """
+    Formats records like the plain formatter and appends the request fields as key=value pairs,
+    so the lines stay readable and can still be parsed.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        line: str = super().format(record)
+        fields: str = ' '.join(
+            f'{field}={getattr(record, field)}' for field in REQUEST_FIELDS if getattr(record, field, None) is not None
+        )
+        return f'{line} {fields}' if fields else line
+
+def setup_queue_logging(logger: logging.Logger, file_path: str, max_bytes: int, backup_count: int) -> QueueListener:
+    """
+    Sends the records of a logger through a queue to a listener thread that writes and rotates the file,
+    so a request only pays for putting a record on the queue.
+
+    Parameters:
+    logger (logging.Logger): The logger to attach the queue to.
+    file_path (str): The log file.
+    max_bytes (int): The size at which the file is rotated.
+    backup_count (int): The number of rotated files to keep.
+
+    Returns:
+        QueueListener: The started listener, stop it to flush the queue on shutdown.
+    """
+    file_handler: RotatingFileHandler = RotatingFileHandler(file_path, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(RequestFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(records))
+    listener: QueueListener = QueueListener(records, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor that adds the time spent in execute and fetch calls and the number of fetched rows to its connection.
+    """
+
+    def execute(self, *args: Any) -> 'TimedCursor':
+        started: float = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            self.connection.add_query_time(time.perf_counter() - started, 1)
+
+    def executemany(self, *args: Any) -> 'TimedCursor':
+        started: float = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            self.connection.add_query_time(time.perf_counter() - started, 1)
+
+    def fetchone(self) -> Any:
+        started: float = time.perf_counter()
+        row: Any = None
+        try:
+            row = super().fetchone()
+            return row
+        finally:
+            self.connection.add_query_time(time.perf_counter() - started, 0, int(row is not None))
+
+    def fetchmany(self, *args: Any) -> Any:
+        started: float = time.perf_counter()
+        rows: Any = ()
+        try:
+            rows = super().fetchmany(*args)
+            return rows
+        finally:
+            self.connection.add_query_time(time.perf_counter() - started, 0, len(rows))
+
+    def fetchall(self) -> Any:
+        started: float = time.perf_counter()
+        rows: Any = ()
+        try:
+            rows = super().fetchall()
+            return rows
+        finally:
+            self.connection.add_query_time(time.perf_counter() - started, 0, len(rows))
+
+    def __next__(self) -> Any:
+        started: float = time.perf_counter()
+        fetched: int = 0
+        try:
+            row: Any = super().__next__()
+            fetched = 1
+            return row
+        finally:
+            self.connection.add_query_time(time.perf_counter() - started, 0, fetched)
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Connection that keeps the total time spent in queries, the number of statements and the number of rows
+    fetched, so the request log and the metrics can report the database share of a request.
+    Pass it as factory to sqlite3.connect.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.query_time: float = 0.0
+        self.query_count: int = 0
+        self.rows_fetched: int = 0
+
+    def reset_query_time(self) -> None:
+        """
+        Starts counting from zero, for a pooled connection that serves a new request.
+        """
+        self.query_time = 0.0
+        self.query_count = 0
+        self.rows_fetched = 0
+
+    def add_query_time(self, seconds: float, statements: int, rows: int = 0) -> None:
+        """
+        Adds the duration of a call, the number of statements it ran and the number of rows it fetched.
+        """
+        self.query_time += seconds
+        self.query_count += statements
+        self.rows_fetched += rows
+
+    def cursor(self, factory: type = TimedCursor) -> sqlite3.Cursor:
+        return super().cursor(factory)
+
+    def execute(self, *args: Any) -> sqlite3.Cursor:
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args: Any) -> sqlite3.Cursor:
+        return self.cursor().executemany(*args)
+
+class RequestSampler:
+    """
+    Decides which requests are logged. Endpoints with a sample rate below 1 are logged for that fraction
+    of requests; errors and slow requests are always logged.
+    """
+
+    def __init__(self, rates: Dict[str, float], slow_ms: float) -> None:
+        self.rates: Dict[str, float] = rates
+        self.slow_ms: float = slow_ms
+
+    def keep(self, endpoint: Optional[str], status: int, duration_ms: float) -> bool:
+        """
+        Returns whether a finished request should be logged.
+        """
+        if status >= 400 or duration_ms >= self.slow_ms:
+            return True
+        rate: float = self.rates.get(endpoint or '', 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+def parse_sample_rates(value: str) -> Dict[str, float]:
+    """
+    Parses 'endpoint:rate, endpoint:rate' from config.ini into a dict.
+
+    Raises:
+        ValueError: When an entry has no rate or the rate is not a number.
+    """
+    rates: Dict[str, float] = {}
+    for entry in value.split(','):
+        if not entry.strip():
+            continue
+        endpoint, rate = entry.split(':')
+        rates[endpoint.strip()] = float(rate)
+    return rates
@@ -0,0 +1,114 @@
+/**
+ * Charts of the sensor graph page, drawn from the JSON data the page embeds once in #chart-data.
+ */
+var CHARTS = [
+    { key: 'temperature', canvas: 'temperatureChart', box: 'temperature-chart', label: 'Temperature (°C)', color: 'red' },
+    { key: 'humidity', canvas: 'humidityChart', box: 'humidity-chart', label: 'Humidity (%)', color: 'blue' },
+    { key: 'light_level', canvas: 'lightLevelChart', box: 'light-level-chart', label: 'Light Level (lux)', color: 'black' }
+];
+var currentChartIndex = 0;
+
+/**
+ * Format timestamps to include both date and time, with date only when it changes
+ * @param {Array} timestamps - The timestamps of a series.
+ * @returns {Array} The labels of the x axis.
+ */
+function formatTimestamps(timestamps) {
+    var formattedTimestamps = [];
+    var previousDate = null;
+    timestamps.forEach(function(timestamp) {
+        var date = new Date(timestamp);
+        var currentDate = date.toLocaleDateString('en-US', { year: 'numeric', month: 'short', day: 'numeric' });
+        var currentTime = date.toLocaleTimeString('en-US', { hour: 'numeric', minute: 'numeric', hour12: false });
+        if (currentDate !== previousDate) {
+            formattedTimestamps.push(currentDate + ' ' + currentTime);
+            previousDate = currentDate;
+        } else {
+            formattedTimestamps.push(currentTime);
+        }
+    });
+    return formattedTimestamps;
+}
+
+/**
+ * Create a new bar Chart object for one series
+ * @param {Object} chart - The entry of CHARTS.
+ * @param {Array} labels - The formatted timestamps.
+ * @param {Array} values - The values of the series.
+ */
+function createChart(chart, labels, values) {
+    var ctx = document.getElementById(chart.canvas).getContext('2d');
+    return new Chart(ctx, {
+        type: 'bar',
+        data: {
+            labels: labels,
+            datasets: [{
+                label: chart.label,
+                data: values,
+                borderColor: chart.color,
+                backgroundColor: chart.color,
+                borderWidth: 1
+            }]
+        },
+        options: {
+            responsive: true,
+            maintainAspectRatio: true,
+            animation: false,
+            hover: {
+                mode: 'nearest',
+                intersect: false
+            },
+            plugins: {
+                legend: {
+                    display: false
+                },
+                tooltip: {
+                    enabled: false
+                }
+            },
+            interaction: {
+                mode: 'index',
+                intersect: false,
+                axis: 'x',
+                hover: false
+            }
+        }
+    });
+}
+
+/**
+ * Show the previous chart in the list
+ */
+function showPreviousChart() {
+    currentChartIndex = (currentChartIndex + CHARTS.length - 1) % CHARTS.length;
+    showCurrentChart();
+}
+
+/**
+ * Show the next chart in the list
+ */
+function showNextChart() {
+    currentChartIndex = (currentChartIndex + 1) % CHARTS.length;
+    showCurrentChart();
+}
+
+/**
+ * Display the current chart based on the index
+ */
+function showCurrentChart() {
+    CHARTS.forEach(function(chart, index) {
+        var chartBox = document.querySelector('.' + chart.box);
+        chartBox.style.display = index === currentChartIndex ? 'block' : 'none';
+    });
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    var data = JSON.parse(document.getElementById('chart-data').textContent);
+    // The labels of the shared timestamps are formatted once for every chart that uses them
+    var sharedLabels = formatTimestamps(data.timestamps);
+    CHARTS.forEach(function(chart) {
+        var series = data.series[chart.key];
+        var labels = series.timestamps ? formatTimestamps(series.timestamps) : sharedLabels;
+        createChart(chart, labels, series.values);
+    });
+});
@@ -77,26 +77,67 @@ document.addEventListener('DOMContentLoaded', function() {
 });
 
 /**
- * Initializes Google Maps with predefined locations and markers.
+ * Initializes a Google Map with a marker for every device that has a location.
  */
 function initMap() {
-    var location1 = {lat: 51.359584, lng: 6.160963};
-    var map1 = new google.maps.Map(document.getElementById('map1'), {
-        zoom: 8,
-        center: location1
-    });
-    var marker1 = new google.maps.Marker({
-        position: location1,
-        map: map1
+    document.querySelectorAll('.device-map').forEach(function(element) {
+        var location = {
+            lat: parseFloat(element.getAttribute('data-lat')),
+            lng: parseFloat(element.getAttribute('data-lng'))
+        };
+        var map = new google.maps.Map(element, {
+            zoom: 8,
+            center: location
+        });
+        var marker = new google.maps.Marker({
+            position: location,
+            map: map
+        });
     });
+}
 
-    var location2 = {lat: 51.451130, lng: 5.481224};
-    var map2 = new google.maps.Map(document.getElementById('map2'), {
-        zoom: 8,
-        center: location2
-    });
-    var marker2 = new google.maps.Marker({
-        position: location2,
-        map: map2
+/**
+ * Formats a timestamp in milliseconds since the epoch as local 'YYYY-MM-DD HH:MM:SS', like the server renders it.
+ */
+function formatTimestamp(milliseconds) {
+    var date = new Date(milliseconds);
+    var pad = function(value) { return String(value).padStart(2, '0'); };
+    return date.getFullYear() + '-' + pad(date.getMonth() + 1) + '-' + pad(date.getDate()) + ' ' +
+        pad(date.getHours()) + ':' + pad(date.getMinutes()) + ':' + pad(date.getSeconds());
+}
+
+/**
+ * Subscribes to the live readings stream and updates the table of the device a reading belongs to.
+ * A reading older than the one shown, from a client uploading its backlog, leaves the table as it is.
+ */
+function subscribeToReadings() {
+    if (!window.EventSource) {
+        return;
+    }
+    var source = new EventSource('/stream');
+    source.addEventListener('reading', function(event) {
+        var reading = JSON.parse(event.data);
+        var table = document.querySelector('table[data-device="' + CSS.escape(reading.device_id) + '"]');
+        var cells = table ? table.querySelectorAll('[data-field]') : [];
+
+        // The page was rendered without this device or without data for it, reload it to get the full table
+        if (cells.length === 0) {
+            source.close();
+            window.location.reload();
+            return;
+        }
+        var shown = table.querySelector('[data-timestamp]');
+        if (shown && reading.timestamp < Number(shown.getAttribute('data-timestamp'))) {
+            return;
+        }
+        if (shown) {
+            shown.setAttribute('data-timestamp', reading.timestamp);
+        }
+        cells.forEach(function(cell) {
+            var field = cell.getAttribute('data-field');
+            cell.textContent = field === 'timestamp' ? formatTimestamp(reading.timestamp) : reading[field];
+        });
     });
 }
+
+document.addEventListener('DOMContentLoaded', subscribeToReadings);
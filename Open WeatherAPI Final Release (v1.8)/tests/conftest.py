@@ -0,0 +1,34 @@
+import os
+import sys
+import sqlite3
+from typing import Iterator, List, Tuple
+import pytest
+
+# The modules read config.ini from the working directory when they are imported
+PROJECT_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+os.chdir(PROJECT_DIR)
+
+from database import write_transaction
+from readings import insert_readings, setup_readings
+
+# 2026-09-21 14:13:20 UTC, a timestamp in the middle of a minute, an hour and a day
+T0: int = 1790000000000
+MINUTE: int = 60 * 1000
+
+@pytest.fixture
+def conn() -> Iterator[sqlite3.Connection]:
+    """
+    An in-memory database with the readings schema, transactions are opened explicitly.
+    """
+    connection: sqlite3.Connection = sqlite3.connect(':memory:', isolation_level=None)
+    setup_readings(connection.cursor())
+    yield connection
+    connection.close()
+
+def insert(conn: sqlite3.Connection, readings: List[Tuple], granularity: str = 'month') -> int:
+    """
+    Inserts (device_id, timestamp, humidity, temperature, light_level) readings in one write transaction.
+    """
+    with write_transaction(conn):
+        return insert_readings(conn.cursor(), readings, granularity)
@@ -0,0 +1,62 @@
+import sqlite3
+from conftest import MINUTE, T0, insert
+from aggregates import read_averages, rollup_level
+from database import write_transaction
+from readings import drop_partition, list_partitions
+
+def aggregate_row(conn: sqlite3.Connection, device_id: str) -> tuple:
+    """
+    Returns the count, the humidity and temperature sums and their value counts of a device.
+    """
+    return conn.execute('''
+        SELECT count, sum_humidity, sum_temperature, count_humidity, count_temperature
+        FROM sensor_aggregates WHERE device_id = ?
+    ''', (device_id,)).fetchone()
+
+def test_insert_updates_global_aggregates(conn: sqlite3.Connection) -> None:
+    insert(conn, [('a', T0, 40.0, 20.0, 100.0), ('a', T0 + 1, None, 22.0, 200.0), ('b', T0, 50.0, 10.0, 0.0)])
+    assert aggregate_row(conn, 'a') == (2, 40.0, 42.0, 1, 2)
+    assert aggregate_row(conn, 'b') == (1, 50.0, 10.0, 1, 1)
+
+def test_rollups_leave_out_missing_values(conn: sqlite3.Connection) -> None:
+    insert(conn, [('a', T0, None, 20.0, 100.0), ('a', T0 + 1, 45.0, 18.0, None), ('a', T0 + 2, 41.0, 25.0, 300.0)])
+    row: tuple = conn.execute('''
+        SELECT count, min_humidity, max_humidity, min_temperature, max_temperature, count_humidity, count_light_level
+        FROM sensor_rollup_minute WHERE device_id = 'a' AND bucket = ?
+    ''', (T0 // MINUTE * MINUTE,)).fetchone()
+    assert row == (3, 41.0, 45.0, 18.0, 25.0, 2, 2)
+
+def test_rollup_buckets_per_level(conn: sqlite3.Connection) -> None:
+    insert(conn, [('a', T0, 40.0, 20.0, 100.0), ('a', T0 + MINUTE, 42.0, 22.0, 100.0)])
+    for level, buckets in (('minute', 2), ('hour', 1), ('day', 1)):
+        assert conn.execute(f'SELECT COUNT(*) FROM sensor_rollup_{level}').fetchone()[0] == buckets
+    assert conn.execute('SELECT count, sum_humidity FROM sensor_rollup_day').fetchone() == (2, 82.0)
+
+def test_delete_subtracts_from_global_aggregates_only(conn: sqlite3.Connection) -> None:
+    insert(conn, [('a', T0, 40.0, 20.0, 100.0), ('a', T0 + 1, None, 22.0, 200.0)])
+    partition: str = list_partitions(conn.cursor())[0]
+    with write_transaction(conn):
+        conn.execute(f'DELETE FROM {partition} WHERE timestamp = ?', (T0 + 1,))
+    assert aggregate_row(conn, 'a') == (1, 40.0, 20.0, 1, 1)
+    # The rollups keep the history of deleted readings
+    assert conn.execute('SELECT count FROM sensor_rollup_minute').fetchone() == (2,)
+
+def test_drop_partition_subtracts_its_readings(conn: sqlite3.Connection) -> None:
+    next_month: int = T0 + 31 * 24 * 60 * MINUTE
+    insert(conn, [('a', T0, 40.0, 20.0, 100.0), ('a', T0 + 1, None, 22.0, 200.0), ('a', next_month, 50.0, 30.0, 0.0)])
+    with write_transaction(conn):
+        assert drop_partition(conn.cursor(), list_partitions(conn.cursor())[0]) == 2
+    assert aggregate_row(conn, 'a') == (1, 50.0, 30.0, 1, 1)
+
+def test_read_averages(conn: sqlite3.Connection) -> None:
+    insert(conn, [('a', T0, 40.0, 20.0, None), ('a', T0 + MINUTE, 50.0, None, None)])
+    assert read_averages(conn.cursor(), 'a') == (45.0, 20.0, None)
+    assert read_averages(conn.cursor(), 'a', T0 + MINUTE) == (50.0, None, None)
+    assert read_averages(conn.cursor(), 'unknown') == (None, None, None)
+
+def test_rollup_level() -> None:
+    day: int = 24 * 60 * MINUTE
+    assert rollup_level(0, 2 * day - 1) == 'day'
+    assert rollup_level(0, 2 * day - 1000) == 'day'
+    assert rollup_level(60 * MINUTE, 3 * 60 * MINUTE - 1) == 'hour'
+    assert rollup_level(T0, T0 + day) == 'minute'
@@ -0,0 +1,82 @@
+import os
+import gzip
+import hashlib
+from pathlib import Path
+import pytest
+import assets
+from assets import HASH_LENGTH, Asset, AssetManifest, VendorFile, missing_vendor_files, vendor_file_valid
+
+SCRIPT: bytes = b'function update() { return 42; }\n' * 50
+VENDOR: str = 'vendor/chart.umd.js'
+
+def static_folder(tmp_path: Path) -> Path:
+    """
+    Creates a static folder with a script, an image, a stylesheet pointing at the image and a hidden file.
+    """
+    (tmp_path / 'images').mkdir()
+    (tmp_path / 'images' / 'logo.png').write_bytes(b'\x89PNG' + bytes(1000))
+    (tmp_path / 'script.js').write_bytes(SCRIPT)
+    (tmp_path / 'style.css').write_bytes(b'body { background: url("images/logo.png"); }\nh1 { background: url(data:x); }\n')
+    (tmp_path / '.hidden').write_bytes(b'secret')
+    return tmp_path
+
+def test_manifest_serves_plain_and_hashed_names(tmp_path: Path) -> None:
+    manifest: AssetManifest = AssetManifest(str(static_folder(tmp_path)), 512)
+    assert sorted(manifest.assets) == ['images/logo.png', 'script.js', 'style.css']
+    script: Asset = manifest.assets['script.js']
+    assert script.hashed_name == f'script.{hashlib.sha256(SCRIPT).hexdigest()[:HASH_LENGTH]}.js'
+    assert manifest.url_name('script.js') == script.hashed_name
+    assert manifest.url_name('unknown.js') == 'unknown.js'
+    assert manifest.find(script.hashed_name) == (script, True)
+    assert manifest.find('script.js') == (script, False)
+    assert manifest.find('.hidden') == (None, False)
+
+def test_stylesheets_point_to_hashed_names(tmp_path: Path) -> None:
+    manifest: AssetManifest = AssetManifest(str(static_folder(tmp_path)), 512)
+    css: bytes = manifest.assets['style.css'].encodings['identity']
+    assert f'url("{manifest.url_name("images/logo.png")}")'.encode() in css
+    assert b'url(data:x)' in css
+
+def test_precompressed_versions(tmp_path: Path) -> None:
+    manifest: AssetManifest = AssetManifest(str(static_folder(tmp_path)), 512)
+    script: Asset = manifest.assets['script.js']
+    encoding, body = script.select(['gzip'])
+    assert encoding == 'gzip' and gzip.decompress(body) == SCRIPT
+    assert script.select([]) == ('identity', SCRIPT)
+    assert script.select(['br', 'gzip'])[0] == ('br' if assets.brotli is not None else 'gzip')
+    # Images aren't compressed, nor are files below the minimum size
+    assert list(manifest.assets['images/logo.png'].encodings) == ['identity']
+    assert list(manifest.assets['style.css'].encodings) == ['identity']
+
+def test_reload_picks_up_changed_files(tmp_path: Path) -> None:
+    manifest: AssetManifest = AssetManifest(str(static_folder(tmp_path)), 512, reload=True)
+    old_name: str = manifest.url_name('script.js')
+    (tmp_path / 'script.js').write_bytes(b'changed')
+    os.utime(tmp_path / 'script.js', (0, 0))
+    new_name: str = manifest.url_name('script.js')
+    assert new_name != old_name
+    assert manifest.find(old_name) == (None, False)
+    assert manifest.find(new_name)[0].encodings['identity'] == b'changed'
+    (tmp_path / 'new.js').write_bytes(b'new')
+    assert manifest.get('new.js') is not None
+    assert manifest.get('../config.ini') is None
+
+def test_manifest_without_reload_keeps_its_files(tmp_path: Path) -> None:
+    manifest: AssetManifest = AssetManifest(str(static_folder(tmp_path)), 512)
+    (tmp_path / 'new.js').write_bytes(b'new')
+    assert manifest.get('new.js') is None
+
+def test_missing_vendor_files(tmp_path: Path) -> None:
+    assert missing_vendor_files(AssetManifest(str(tmp_path), 512)) == list(assets.VENDOR_FILES)
+    (tmp_path / 'vendor').mkdir()
+    (tmp_path / 'vendor' / 'chart.umd.js').write_bytes(SCRIPT)
+    assert missing_vendor_files(AssetManifest(str(tmp_path), 512)) == []
+
+def test_vendor_file_must_match_its_pin(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    (tmp_path / 'vendor').mkdir()
+    (tmp_path / 'vendor' / 'chart.umd.js').write_bytes(SCRIPT)
+    manifest: AssetManifest = AssetManifest(str(tmp_path), 512)
+    monkeypatch.setitem(assets.VENDOR_FILES, VENDOR, VendorFile('https://example.com/chart.js', hashlib.sha256(SCRIPT).hexdigest()))
+    assert vendor_file_valid(manifest, VENDOR)
+    monkeypatch.setitem(assets.VENDOR_FILES, VENDOR, VendorFile('https://example.com/chart.js', '0' * 64))
+    assert not vendor_file_valid(manifest, VENDOR)
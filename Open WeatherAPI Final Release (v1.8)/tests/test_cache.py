@@ -0,0 +1,87 @@
+import random
+import sqlite3
+from typing import List, Tuple
+from conftest import T0, insert
+from cache import RecentRing, SensorCache
+
+FIELDS: Tuple[str, ...] = ('id', 'device_id', 'timestamp', 'humidity', 'temperature', 'light_level')
+
+def ring_timestamps(ring: RecentRing) -> List[int]:
+    """
+    Returns the timestamps of a ring from the oldest on.
+    """
+    return [ring.timestamps[(ring.start + offset) % ring.capacity] for offset in range(ring.size)]
+
+def test_ring_overwrites_the_oldest_reading() -> None:
+    ring: RecentRing = RecentRing(3)
+    for number in range(5):
+        ring.append((number, T0 + number, 40.0, 20.0, 100.0))
+    assert ring_timestamps(ring) == [T0 + 2, T0 + 3, T0 + 4]
+    assert ring.oldest_timestamp() == T0 + 2
+
+def test_ring_keeps_late_readings_in_timestamp_order() -> None:
+    ring: RecentRing = RecentRing(4)
+    for number, offset in enumerate((10, 30, 20, 40, 25)):
+        ring.append((number, T0 + offset, 40.0, 20.0, 100.0))
+    assert ring_timestamps(ring) == [T0 + 20, T0 + 25, T0 + 30, T0 + 40]
+
+def test_ring_drops_readings_older_than_a_full_ring() -> None:
+    ring: RecentRing = RecentRing(2)
+    ring.append((1, T0 + 10, 40.0, 20.0, 100.0))
+    ring.append((2, T0 + 20, 40.0, 20.0, 100.0))
+    assert not ring.append((3, T0, 40.0, 20.0, 100.0))
+    assert ring_timestamps(ring) == [T0 + 10, T0 + 20]
+
+def test_ring_order_with_random_late_readings() -> None:
+    rng: random.Random = random.Random(1)
+    ring: RecentRing = RecentRing(50)
+    timestamps: List[int] = []
+    for number in range(500):
+        timestamp: int = T0 + number * 10 - rng.randrange(300)
+        timestamps.append(timestamp)
+        ring.append((number, timestamp, 40.0, 20.0, 100.0))
+        kept: List[int] = ring_timestamps(ring)
+        assert kept == sorted(kept)
+    # Every reading from the oldest kept one on is in the ring
+    assert ring_timestamps(ring) == sorted(timestamps)[-50:]
+
+def test_window_returns_missing_values_as_none() -> None:
+    ring: RecentRing = RecentRing(5)
+    ring.append((1, T0, 40.0, None, 100.0))
+    ring.append((2, T0 + 10, 41.0, 21.0, None))
+    ring.append((3, T0 + 20, 42.0, 22.0, 300.0))
+    assert ring.window(T0, T0 + 10) == {
+        'timestamps': [T0, T0 + 10], 'humidity': [40.0, 41.0], 'temperature': [None, 21.0], 'light_level': [100.0, None],
+    }
+
+def test_cache_keeps_the_latest_reading_of_late_uploads() -> None:
+    cache: SensorCache = SensorCache('readings', FIELDS, 10)
+    cache.add_rows('readings', [(1, 'pi', T0 + 100, 40.0, 20.0, 100.0), (2, 'pi', T0, 30.0, 10.0, 0.0)])
+    assert cache.get_latest('pi')['timestamp'] == T0 + 100
+    assert cache.last_id == 2
+    # Rows that are already cached are ignored
+    cache.add_rows('readings', [(2, 'pi', T0 + 200, 50.0, 20.0, 100.0)])
+    assert cache.get_latest('pi')['timestamp'] == T0 + 100
+
+def test_cache_window_only_when_the_ring_covers_it() -> None:
+    cache: SensorCache = SensorCache('readings', FIELDS, 2)
+    cache.add_rows('readings', [(1, 'pi', T0, 40.0, 20.0, 100.0)])
+    # The device has fewer readings than the ring, so the ring holds all of them
+    assert cache.get_window('pi', 0, T0 + 100)['timestamps'] == [T0]
+    cache.add_rows('readings', [(2, 'pi', T0 + 10, 40.0, 20.0, 100.0), (3, 'pi', T0 + 20, 40.0, 20.0, 100.0)])
+    assert cache.get_window('pi', T0, T0 + 100) is None
+    assert cache.get_window('pi', T0 + 10, T0 + 100)['timestamps'] == [T0 + 10, T0 + 20]
+    assert cache.get_window('unknown', T0, T0 + 100) is None
+
+def test_load_and_refresh(conn: sqlite3.Connection) -> None:
+    insert(conn, [('a', T0 + number, 40.0, 20.0, float(number)) for number in range(5)] + [('b', T0, 50.0, 10.0, 0.0)])
+    cache: SensorCache = SensorCache('readings', FIELDS, 3)
+    cache.load(conn)
+    assert not conn.in_transaction
+    assert cache.last_id == 6
+    assert ring_timestamps(cache.rings['a']) == [T0 + 2, T0 + 3, T0 + 4]
+    assert cache.complete == {'a': False, 'b': True}
+    insert(conn, [('b', T0 + 1, 51.0, 11.0, 1.0)])
+    cache.refresh(conn)
+    assert cache.get_latest('b')['humidity'] == 51.0
+    assert cache.last_id == 7
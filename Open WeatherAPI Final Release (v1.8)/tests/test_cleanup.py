@@ -0,0 +1,80 @@
+import sqlite3
+import configparser
+from typing import List
+from conftest import insert
+from aggregates import insert_edge_aggregates
+from cleanup import (RetentionPolicy, apply_policy, delete_in_chunks, drop_expired_partitions, load_policies,
+                     prune_rollups, row_count)
+from database import write_transaction
+from readings import list_partitions, now_ms
+
+DAY: int = 24 * 60 * 60 * 1000
+
+def readings_of(conn: sqlite3.Connection, device_id: str) -> List[int]:
+    """
+    Returns the timestamps of the readings of a device, oldest first.
+    """
+    return [row[0] for row in conn.execute('SELECT timestamp FROM readings WHERE device_id = ? ORDER BY timestamp', (device_id,))]
+
+def test_delete_in_chunks_commits_every_chunk(conn: sqlite3.Connection) -> None:
+    now: int = now_ms()
+    insert(conn, [('a', now - number, 40.0, 20.0, 100.0) for number in range(25)])
+    partition: str = list_partitions(conn.cursor())[0]
+    commits: List[str] = []
+    conn.set_trace_callback(lambda statement: commits.append(statement) if statement == 'COMMIT' else None)
+    deleted: int = delete_in_chunks(conn, partition, 'device_id = ?', 'timestamp', 12, ('a',), 5, 0)
+    conn.set_trace_callback(None)
+    assert deleted == 12
+    assert len(commits) == 3
+    # The oldest rows go first
+    assert readings_of(conn, 'a') == [now - number for number in range(12, -1, -1)]
+
+def test_max_rows_keeps_the_newest_readings(conn: sqlite3.Connection) -> None:
+    now: int = now_ms()
+    insert(conn, [('a', now - number * 1000, 40.0, 20.0, 100.0) for number in range(10)] + [('b', now, 40.0, 20.0, 100.0)])
+    assert apply_policy(conn, RetentionPolicy('a', 0, 4), 3, 0) == 6
+    assert readings_of(conn, 'a') == [now - number * 1000 for number in range(3, -1, -1)]
+    assert row_count(conn.cursor(), 'a') == 4
+    assert row_count(conn.cursor(), 'b') == 1
+
+def test_max_age_deletes_old_readings_and_edge_aggregates(conn: sqlite3.Connection) -> None:
+    now: int = now_ms()
+    insert(conn, [('a', now - 10 * DAY, 40.0, 20.0, 100.0), ('a', now - DAY, 41.0, 21.0, 100.0)])
+    with write_transaction(conn):
+        insert_edge_aggregates(conn.cursor(), [
+            ('a', now - 10 * DAY, now - 10 * DAY + 60000, 60) + (1.0,) * 9,
+            ('a', now - DAY, now - DAY + 60000, 60) + (1.0,) * 9,
+        ])
+    assert apply_policy(conn, RetentionPolicy('a', 5, 0), 100, 0) == 2
+    assert readings_of(conn, 'a') == [now - DAY]
+    assert conn.execute('SELECT start_ms FROM edge_aggregates').fetchall() == [(now - DAY,)]
+
+def test_drop_expired_partitions(conn: sqlite3.Connection) -> None:
+    now: int = now_ms()
+    insert(conn, [('a', now - 100 * DAY, 40.0, 20.0, 100.0), ('a', now, 41.0, 21.0, 100.0)], 'day')
+    policies: List[RetentionPolicy] = [RetentionPolicy('a', 30, 0), RetentionPolicy('b', 60, 0)]
+    assert drop_expired_partitions(conn, policies) == 1
+    assert len(list_partitions(conn.cursor())) == 1
+    assert row_count(conn.cursor(), 'a') == 1
+    # A device without an age limit keeps every partition
+    insert(conn, [('a', now - 100 * DAY, 40.0, 20.0, 100.0)], 'day')
+    assert drop_expired_partitions(conn, policies + [RetentionPolicy('c', 0, 10)]) == 0
+
+def test_prune_rollups_per_level(conn: sqlite3.Connection) -> None:
+    now: int = now_ms()
+    insert(conn, [('a', now - 40 * DAY, 40.0, 20.0, 100.0), ('a', now, 41.0, 21.0, 100.0)])
+    prune_rollups(conn, {'minute': 30, 'hour': 0, 'day': 0})
+    assert conn.execute('SELECT COUNT(*) FROM sensor_rollup_minute').fetchone() == (1,)
+    assert conn.execute('SELECT COUNT(*) FROM sensor_rollup_hour').fetchone() == (2,)
+
+def test_load_policies_with_overrides() -> None:
+    config: configparser.ConfigParser = configparser.ConfigParser()
+    config.read_string('''
+        [RETENTION]
+        max_age_days = 365
+        max_rows = 1000
+        [RETENTION:b]
+        max_age_days = 7
+    ''')
+    policies: List[RetentionPolicy] = load_policies(config, ['a', 'b'])
+    assert [(policy.device_id, policy.max_age_days, policy.max_rows) for policy in policies] == [('a', 365, 1000), ('b', 7, 1000)]
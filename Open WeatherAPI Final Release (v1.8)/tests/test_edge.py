@@ -0,0 +1,95 @@
+import sqlite3
+from typing import List, Optional
+from conftest import MINUTE, T0, insert
+from aggregates import insert_edge_aggregates
+from database import write_transaction
+from edge import Aggregate, Aggregator, Deadband, EdgeProcessor, Record
+from ingest import IngestBuffer
+from readings import list_devices
+
+# Start of a minute, where the aggregation intervals begin
+START: float = T0 // MINUTE * MINUTE / 1000
+
+def store(conn: sqlite3.Connection, aggregates: List[tuple]) -> int:
+    """
+    Stores edge aggregates in one write transaction and returns how many were new.
+    """
+    with write_transaction(conn):
+        return insert_edge_aggregates(conn.cursor(), aggregates)
+
+def rollup(conn: sqlite3.Connection, level: str) -> tuple:
+    """
+    Returns the count, humidity statistics and light level value count of the only rollup row of a level.
+    """
+    return conn.execute(f'''
+        SELECT count, sum_humidity, min_humidity, max_humidity, count_humidity, count_light_level
+        FROM sensor_rollup_{level}
+    ''').fetchone()
+
+def test_aggregator_summarizes_each_interval() -> None:
+    aggregator: Aggregator = Aggregator(60.0)
+    assert aggregator.add((START, 40.0, 20.0, 100.0)) is None
+    assert aggregator.add((START + 30, 50.0, 22.0, 300.0)) is None
+    finished: Optional[Aggregate] = aggregator.add((START + 60, 45.0, 21.0, 200.0))
+    assert finished == (START, START + 30, 2, 40.0, 45.0, 50.0, 20.0, 21.0, 22.0, 100.0, 200.0, 300.0)
+    assert not aggregator.due(START + 119)
+    assert aggregator.due(START + 120)
+    assert aggregator.flush() == (START + 60, START + 60, 1, 45.0, 45.0, 45.0, 21.0, 21.0, 21.0, 200.0, 200.0, 200.0)
+    assert aggregator.flush() is None
+
+def test_deadband_drops_small_changes_until_the_heartbeat() -> None:
+    processor: EdgeProcessor = EdgeProcessor(Deadband((1.0, 0.5, 10.0), 300.0), None)
+    sent: List[Record] = []
+    for offset, humidity in ((0, 40.0), (10, 40.5), (20, 41.5), (30, 41.0), (330, 41.0)):
+        sent += processor.add((START + offset, humidity, 20.0, 100.0))
+    # 40.5 and 41.0 stay within 1.0 of the last reading sent, the last one is the heartbeat
+    assert [record[0] for record in sent] == [START, START + 20, START + 330]
+
+def test_deadband_compares_the_extremes_of_aggregates() -> None:
+    processor: EdgeProcessor = EdgeProcessor(Deadband((1.0, 1.0, 1.0), 3600.0), Aggregator(60.0))
+    assert processor.add((START, 40.0, 20.0, 100.0)) == []
+    assert len(processor.poll(START + 60)) == 1
+    # The average stays the same, but the humidity peaked past the deadband
+    processor.add((START + 60, 38.0, 20.0, 100.0))
+    processor.add((START + 61, 42.0, 20.0, 100.0))
+    assert len(processor.poll(START + 120)) == 1
+    processor.add((START + 120, 40.0, 20.0, 100.0))
+    assert processor.poll(START + 180) == []
+
+def test_edge_aggregates_add_to_every_rollup(conn: sqlite3.Connection) -> None:
+    insert(conn, [('a', T0 + 1, 40.0, 20.0, 100.0)])
+    assert store(conn, [
+        ('a', T0, T0 + MINUTE - 1000, 60, 30.0, 35.0, 45.0, 19.0, 20.0, 21.0, None, None, None),
+        ('a', T0 + MINUTE, T0 + 2 * MINUTE - 1000, 10, 50.0, 55.0, 60.0, 19.0, 20.0, 21.0, 0.0, 5.0, 10.0),
+    ]) == 2
+    # The minute rollup holds the first aggregate and the reading, the day rollup everything
+    assert conn.execute('''
+        SELECT count, sum_humidity, min_humidity, max_humidity, count_humidity, count_light_level
+        FROM sensor_rollup_minute ORDER BY bucket LIMIT 1
+    ''').fetchone() == (61, 60 * 35.0 + 40.0, 30.0, 45.0, 61, 1)
+    assert rollup(conn, 'day') == (71, 60 * 35.0 + 40.0 + 10 * 55.0, 30.0, 60.0, 71, 11)
+    assert conn.execute('SELECT min_light_level, max_light_level FROM sensor_rollup_day').fetchone() == (0.0, 100.0)
+
+def test_edge_aggregates_leave_the_readings_alone(conn: sqlite3.Connection) -> None:
+    store(conn, [('b', T0, T0 + 59000, 60) + (1.0,) * 9])
+    assert conn.execute('SELECT COUNT(*) FROM readings').fetchone() == (0,)
+    assert conn.execute('SELECT COUNT(*) FROM sensor_aggregates').fetchone() == (0,)
+    devices = list_devices(conn.cursor())
+    assert [(device['device_id'], device['first_seen'], device['last_seen']) for device in devices] == [('b', T0, T0 + 59000)]
+
+def test_resent_edge_aggregates_are_ignored(conn: sqlite3.Connection) -> None:
+    aggregate: tuple = ('a', T0, T0 + 59000, 60) + (1.0,) * 9
+    store(conn, [aggregate])
+    assert store(conn, [aggregate]) == 0
+    assert rollup(conn, 'hour') == (60, 60.0, 1.0, 1.0, 60, 60)
+
+def test_buffer_flushes_readings_and_aggregates(conn: sqlite3.Connection) -> None:
+    buffer: IngestBuffer = IngestBuffer('month', 1000, 60)
+    buffer.add('a', T0, 40.0, 20.0, 100.0)
+    buffer.add_aggregate('a', T0 + MINUTE, T0 + 2 * MINUTE, 5, *(2.0,) * 9)
+    assert buffer.pending() == 2
+    assert buffer.flush(conn) == 2
+    assert buffer.pending() == 0
+    assert conn.execute('SELECT COUNT(*) FROM readings').fetchone() == (1,)
+    assert conn.execute('SELECT count FROM edge_aggregates').fetchone() == (5,)
+    assert rollup(conn, 'day')[0] == 6
@@ -0,0 +1,118 @@
+import asyncio
+import sqlite3
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import pytest
+from conftest import T0
+from ingest import IngestBuffer
+from laptop_server import QueuedRecord, check_times, database_writer, queued_record, take_item
+from raspberry_pi_client import open_buffer, outbox_epoch
+from readings import load_sequences, setup_readings
+
+RECEIVED: float = T0 / 1000
+
+def reading(epoch: int, sequence: int, device: str = 'pi') -> QueuedRecord:
+    """
+    Returns a queued reading of a record with the given outbox epoch and sequence number.
+    """
+    return queued_record(device, epoch, (sequence, RECEIVED + sequence, 40.0, 20.0, 100.0), False)
+
+def take_all(items: List[QueuedRecord], sequences: Dict[str, Tuple[Optional[int], int]]) -> IngestBuffer:
+    """
+    Takes the items into a new buffer and returns it.
+    """
+    buffer: IngestBuffer = IngestBuffer('month', 1000, 60)
+    for item in items:
+        take_item(item, buffer, sequences, [])
+    return buffer
+
+def test_resent_records_are_dropped() -> None:
+    sequences: Dict[str, Tuple[Optional[int], int]] = {}
+    buffer: IngestBuffer = take_all([reading(5, 1), reading(5, 2), reading(5, 1), reading(5, 2), reading(5, 3)], sequences)
+    assert [values[1] for values in buffer.readings] == [T0 + 1000, T0 + 2000, T0 + 3000]
+    assert sequences == buffer.sequences == {'pi': (5, 3)}
+
+def test_resent_first_record_is_dropped() -> None:
+    sequences: Dict[str, Tuple[Optional[int], int]] = {'pi': (5, 1)}
+    assert take_all([reading(5, 1)], sequences).pending() == 0
+
+def test_new_epoch_starts_counting_again() -> None:
+    sequences: Dict[str, Tuple[Optional[int], int]] = {'pi': (5, 900)}
+    buffer: IngestBuffer = take_all([reading(8, 1), reading(8, 2), reading(8, 2)], sequences)
+    assert buffer.pending() == 2
+    assert sequences == {'pi': (8, 2)}
+
+def test_sequences_of_older_versions_are_replaced_by_the_first_epoch() -> None:
+    sequences: Dict[str, Tuple[Optional[int], int]] = {'pi': (None, 50)}
+    assert take_all([reading(3, 1)], sequences).pending() == 1
+
+def test_devices_are_counted_separately() -> None:
+    sequences: Dict[str, Tuple[Optional[int], int]] = {}
+    buffer: IngestBuffer = take_all([reading(1, 1, 'a'), reading(1, 1, 'b'), reading(1, 1, 'a')], sequences)
+    assert buffer.pending() == 2
+    assert sequences == {'a': (1, 1), 'b': (1, 1)}
+
+def test_gaps_are_reported(capsys: pytest.CaptureFixture) -> None:
+    take_all([reading(1, 1), reading(1, 5)], {})
+    assert 'Missing 3 records from pi' in capsys.readouterr().out
+
+def test_text_readings_and_futures() -> None:
+    async def take() -> Tuple[IngestBuffer, List[asyncio.Future]]:
+        buffer: IngestBuffer = IngestBuffer('month', 1000, 60)
+        waiting: List[asyncio.Future] = []
+        take_item(('10.0.0.2', T0, 40.0, 20.0, 100.0), buffer, {}, waiting)
+        take_item(asyncio.get_running_loop().create_future(), buffer, {}, waiting)
+        return buffer, waiting
+    buffer, waiting = asyncio.run(take())
+    assert buffer.readings == [('10.0.0.2', T0, 40.0, 20.0, 100.0)]
+    assert len(waiting) == 1
+
+def test_queued_aggregate_keeps_its_statistics() -> None:
+    aggregate = (4, RECEIVED, RECEIVED + 59.5, 60, 40.0, 45.0, 50.0, 20.0, 21.0, 22.0, 0.0, 150.0, 300.0)
+    item: QueuedRecord = queued_record('pi', 2, aggregate, True)
+    assert item.aggregate and item.sequence == 4 and item.epoch == 2
+    assert item.values == ('pi', T0, T0 + 59500, 60, 40.0, 45.0, 50.0, 20.0, 21.0, 22.0, 0.0, 150.0, 300.0)
+    buffer: IngestBuffer = take_all([item], {})
+    assert buffer.aggregates == [item.values] and buffer.readings == []
+
+def test_check_times_keeps_valid_timestamps() -> None:
+    record = (1, RECEIVED - 3600, 40.0, 20.0, 100.0)
+    assert check_times('pi', record, False, RECEIVED) == record
+
+@pytest.mark.parametrize('sensor_time', [0.0, RECEIVED + 3600, float('nan'), float('inf')])
+def test_check_times_replaces_invalid_timestamps(sensor_time: float) -> None:
+    assert check_times('pi', (1, sensor_time, 40.0, 20.0, 100.0), False, RECEIVED)[1] == RECEIVED
+
+def test_check_times_replaces_reversed_intervals() -> None:
+    aggregate = (1, RECEIVED - 10, RECEIVED - 20, 5) + (0.0,) * 9
+    assert check_times('pi', aggregate, True, RECEIVED)[1:3] == (RECEIVED, RECEIVED)
+
+def test_writer_commits_sequences_with_the_readings() -> None:
+    # The writer commits from a worker thread
+    conn: sqlite3.Connection = sqlite3.connect(':memory:', isolation_level=None, check_same_thread=False)
+    setup_readings(conn.cursor())
+
+    async def run(items: List[QueuedRecord]) -> None:
+        queue: asyncio.Queue = asyncio.Queue()
+        writer: asyncio.Task = asyncio.create_task(database_writer(queue, conn, IngestBuffer('month', 1000, 60)))
+        for item in items:
+            await queue.put(item)
+        stored: asyncio.Future = asyncio.get_running_loop().create_future()
+        await queue.put(stored)
+        await stored
+        writer.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await writer
+
+    asyncio.run(run([reading(7, 1), reading(7, 2)]))
+    assert load_sequences(conn.cursor()) == {'pi': (7, 2)}
+    # After a restart of the server the writer still knows which records were committed
+    asyncio.run(run([reading(7, 2), reading(7, 3)]))
+    assert conn.execute("SELECT COUNT(*) FROM readings WHERE device_id = 'pi'").fetchone() == (3,)
+
+def test_outbox_keeps_its_epoch(tmp_path: Path) -> None:
+    path: str = str(tmp_path / 'client_buffer.db')
+    first: sqlite3.Connection = open_buffer(path)
+    epoch: int = outbox_epoch(first)
+    first.close()
+    assert outbox_epoch(open_buffer(path)) == epoch
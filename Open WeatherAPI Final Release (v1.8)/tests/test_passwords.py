@@ -0,0 +1,86 @@
+import time
+import base64
+from hashlib import pbkdf2_hmac
+import pytest
+from passwords import HASH_PREFIX, HasherBusy, PasswordHasher, RateLimiter
+
+def hasher(iterations: int = 1000, workers: int = 2, max_pending: int = 4) -> PasswordHasher:
+    """
+    Returns a hasher with few iterations, so the tests run fast.
+    """
+    return PasswordHasher('sha256', iterations, 16, 32, 500, 8, workers, max_pending, 10.0)
+
+def legacy_password(password: str, salt: bytes, iterations: int) -> str:
+    """
+    Returns a password as older versions stored it, salt and hash in one base64 field.
+    """
+    return base64.b64encode(salt + pbkdf2_hmac('sha256', password.encode(), salt, iterations, 32)).decode('utf-8')
+
+def test_hash_and_verify() -> None:
+    stored: str = hasher().hash('secret')
+    assert stored.startswith(f'{HASH_PREFIX}sha256$1000$')
+    assert hasher().verify(stored, 'secret')
+    assert not hasher().verify(stored, 'Secret')
+    assert not hasher().needs_rehash(stored)
+
+def test_hash_uses_a_new_salt() -> None:
+    assert hasher().hash('secret') != hasher().hash('secret')
+
+def test_verify_missing_is_always_false() -> None:
+    assert not hasher().verify_missing('secret')
+
+def test_legacy_passwords_verify_and_need_a_rehash() -> None:
+    stored: str = legacy_password('secret', b'12345678', 500)
+    assert hasher().verify(stored, 'secret')
+    assert not hasher().verify(stored, 'other')
+    assert hasher().needs_rehash(stored)
+
+def test_prefixed_passwords_with_one_field_verify_and_need_a_rehash() -> None:
+    stored: str = f'{HASH_PREFIX}sha256$700${legacy_password("secret", b"abcdefgh", 700)}'
+    assert hasher().verify(stored, 'secret')
+    assert hasher().needs_rehash(stored)
+
+def test_other_parameters_need_a_rehash() -> None:
+    stored: str = hasher(iterations=2000).hash('secret')
+    # The stored iterations are used to verify, so the password still matches
+    assert hasher().verify(stored, 'secret')
+    assert hasher().needs_rehash(stored)
+    assert PasswordHasher('sha512', 1000, 16, 32, 500, 8, 1, 1, 10.0).needs_rehash(hasher().hash('secret'))
+
+def test_busy_hasher_rejects_requests() -> None:
+    busy: PasswordHasher = PasswordHasher('sha256', 1000, 16, 32, 500, 8, 1, 0, 10.0)
+    busy.slots.acquire()
+    with pytest.raises(HasherBusy):
+        busy.hash('secret')
+    busy.slots.release()
+    assert busy.verify(busy.hash('secret'), 'secret')
+
+def test_rate_limiter_blocks_after_max_attempts() -> None:
+    limiter: RateLimiter = RateLimiter(3, 60.0)
+    for _ in range(2):
+        limiter.fail('alice')
+    assert limiter.retry_after('alice') == 0.0
+    limiter.fail('alice')
+    assert 59.0 < limiter.retry_after('alice') <= 60.0
+    assert limiter.retry_after('bob') == 0.0
+    limiter.reset('alice')
+    assert limiter.retry_after('alice') == 0.0
+
+def test_rate_limiter_failures_expire() -> None:
+    limiter: RateLimiter = RateLimiter(1, 0.05)
+    limiter.fail('alice')
+    assert limiter.retry_after('alice') > 0.0
+    time.sleep(0.06)
+    assert limiter.retry_after('alice') == 0.0
+    assert 'alice' not in limiter.failures
+
+def test_rate_limiter_tracks_at_most_max_keys() -> None:
+    limiter: RateLimiter = RateLimiter(2, 60.0, max_keys=3)
+    for key in ('a', 'b', 'c', 'd'):
+        limiter.fail(key)
+    assert list(limiter.failures) == ['b', 'c', 'd']
+
+def test_disabled_rate_limiter() -> None:
+    limiter: RateLimiter = RateLimiter(0, 60.0)
+    limiter.fail('alice')
+    assert limiter.retry_after('alice') == 0.0
@@ -0,0 +1,108 @@
+import zlib
+import asyncio
+import pytest
+from protocol import (ACK, FLAG_ACK, FLAG_AGGREGATE, FLAG_COMPRESSED, HEADER, MAGIC, MAX_PAYLOAD, MAX_READING_RATE,
+                      MAX_READINGS, VERSION, ProtocolError, aggregate_limit, decode_header, decode_payload, encode_ack,
+                      encode_frame, parse_reading, read_frame)
+
+READINGS = [(1, 1790000000.5, 40.5, 21.25, 300.0), (2, 1790000001.5, 41.0, 21.5, 310.0)]
+AGGREGATE = (3, 1790000000.0, 1790000059.0, 60, 40.0, 45.0, 50.0, 20.0, 21.0, 22.0, 0.0, 150.0, 300.0)
+
+def split_frame(frame: bytes) -> tuple:
+    """
+    Returns the flags and the payload of an encoded frame.
+    """
+    flags, length = decode_header(frame[:HEADER.size])
+    payload: bytes = frame[HEADER.size:]
+    assert len(payload) == length
+    return flags, payload
+
+def test_readings_round_trip() -> None:
+    flags, payload = split_frame(encode_frame('pi-eindhoven', 7, READINGS))
+    assert decode_payload(payload, flags) == ('pi-eindhoven', 7, READINGS)
+
+def test_aggregates_round_trip() -> None:
+    flags, payload = split_frame(encode_frame('pi', 7, [AGGREGATE], FLAG_AGGREGATE))
+    assert flags == FLAG_AGGREGATE
+    assert decode_payload(payload, flags) == ('pi', 7, [AGGREGATE])
+
+def test_compressed_round_trip() -> None:
+    readings = [(number, 1790000000.0 + number, 40.0, 21.0, 300.0) for number in range(1, 201)]
+    plain: bytes = encode_frame('pi', 1, readings)
+    frame: bytes = encode_frame('pi', 1, readings, FLAG_COMPRESSED)
+    assert len(frame) < len(plain)
+    flags, payload = split_frame(frame)
+    assert decode_payload(payload, flags) == ('pi', 1, readings)
+
+def test_ack_round_trip() -> None:
+    flags, payload = split_frame(encode_ack(12345))
+    assert flags & FLAG_ACK
+    assert ACK.unpack(payload) == (12345,)
+
+def test_rejects_bad_headers() -> None:
+    with pytest.raises(ProtocolError):
+        decode_header(HEADER.pack(b'XX', VERSION, 0, 10))
+    with pytest.raises(ProtocolError):
+        decode_header(HEADER.pack(MAGIC, VERSION + 1, 0, 10))
+    with pytest.raises(ProtocolError):
+        decode_header(HEADER.pack(MAGIC, VERSION, 0, MAX_PAYLOAD + 1))
+
+def test_rejects_payload_of_wrong_length() -> None:
+    flags, payload = split_frame(encode_frame('pi', 1, READINGS))
+    with pytest.raises(ProtocolError):
+        decode_payload(payload[:-1], flags)
+    with pytest.raises(ProtocolError):
+        decode_payload(payload + b'\0', flags)
+
+def test_rejects_compression_bomb() -> None:
+    payload: bytes = zlib.compress(bytes(MAX_PAYLOAD + 1000))
+    with pytest.raises(ProtocolError):
+        decode_payload(payload, FLAG_COMPRESSED)
+    with pytest.raises(ProtocolError):
+        decode_payload(b'not zlib', FLAG_COMPRESSED)
+
+def test_aggregate_limit() -> None:
+    assert aggregate_limit(0.0, 0.0) == 1
+    assert aggregate_limit(0.0, 10.0) == int(10 * MAX_READING_RATE) + 1
+    assert aggregate_limit(0.0, 1e9) == MAX_READINGS
+    assert aggregate_limit(10.0, 0.0) == MAX_READINGS
+    assert aggregate_limit(0.0, float('nan')) == MAX_READINGS
+
+@pytest.mark.parametrize('count', [0, 59 * int(MAX_READING_RATE) + 2, MAX_READINGS + 1])
+def test_rejects_aggregates_claiming_too_many_readings(count: int) -> None:
+    aggregate = AGGREGATE[:3] + (count,) + AGGREGATE[4:]
+    # The count field is 32 bits wide on the wire, so counts above MAX_READINGS can be sent
+    flags, payload = split_frame(encode_frame('pi', 1, [aggregate], FLAG_AGGREGATE))
+    with pytest.raises(ProtocolError):
+        decode_payload(payload, flags)
+
+def test_rejects_device_id_too_long() -> None:
+    with pytest.raises(ProtocolError):
+        encode_frame('x' * 256, 1, READINGS)
+
+def test_read_frame_after_magic() -> None:
+    async def read() -> tuple:
+        reader: asyncio.StreamReader = asyncio.StreamReader()
+        frame: bytes = encode_frame('pi', 9, READINGS)
+        reader.feed_data(frame[len(MAGIC):])
+        reader.feed_eof()
+        return await read_frame(reader, MAGIC)
+    assert asyncio.run(read()) == (0, 'pi', 9, READINGS)
+
+@pytest.mark.parametrize('line, expected', [
+    ('40.5,21.25,300', (40.5, 21.25, 300.0)),
+    ('Humidity: 40.5%, Temperature: 21.25°C, Light Level: 300', (40.5, 21.25, 300.0)),
+])
+def test_parse_reading(line: str, expected: tuple) -> None:
+    assert parse_reading(line) == expected
+
+def test_parse_reading_rejects_other_formats() -> None:
+    with pytest.raises(ValueError):
+        parse_reading('40.5,21.25')
+    with pytest.raises(ValueError):
+        parse_reading('a,b,c')
+
+def test_sequence_numbers_wrap_to_32_bits() -> None:
+    flags, payload = split_frame(encode_frame('pi', 2 ** 32 + 5, [(2 ** 32 + 1,) + READINGS[0][1:]]))
+    _, epoch, readings = decode_payload(payload, flags)
+    assert (epoch, readings[0][0]) == (5, 1)
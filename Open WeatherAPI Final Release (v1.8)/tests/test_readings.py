@@ -0,0 +1,57 @@
+import sqlite3
+from typing import List
+import pytest
+from conftest import T0, insert
+from readings import (MAX_TIMESTAMP, last_reading_id, latest_per_device, list_devices, list_partitions,
+                      load_sequences, partition_bounds, range_source, save_sequences)
+
+# 2026-01-31 23:59:59.999 and 2026-02-01 00:00:00 UTC
+END_OF_JANUARY: int = 1769903999999
+START_OF_FEBRUARY: int = 1769904000000
+
+def test_partition_bounds_per_month() -> None:
+    assert partition_bounds(END_OF_JANUARY, 'month') == ('readings_202601', 1767225600000, END_OF_JANUARY)
+    assert partition_bounds(START_OF_FEBRUARY, 'month')[0] == 'readings_202602'
+    # December rolls over into the next year
+    assert partition_bounds(1798761599999, 'month') == ('readings_202612', 1796083200000, 1798761599999)
+
+def test_partition_bounds_per_day() -> None:
+    assert partition_bounds(END_OF_JANUARY, 'day') == ('readings_20260131', END_OF_JANUARY - 86399999, END_OF_JANUARY)
+
+def test_partition_bounds_rejects_other_granularities() -> None:
+    with pytest.raises(ValueError):
+        partition_bounds(T0, 'week')
+
+def test_insert_across_partitions(conn: sqlite3.Connection) -> None:
+    assert insert(conn, [('a', END_OF_JANUARY, 40.0, 20.0, 100.0), ('a', START_OF_FEBRUARY, 41.0, 21.0, None)]) == 2
+    assert list_partitions(conn.cursor()) == ['readings_202601', 'readings_202602']
+    assert list_partitions(conn.cursor(), START_OF_FEBRUARY, MAX_TIMESTAMP) == ['readings_202602']
+    assert range_source(conn.cursor(), 0, END_OF_JANUARY) == 'readings_202601'
+    assert conn.execute('SELECT id, timestamp, light_level FROM readings ORDER BY id').fetchall() == [
+        (1, END_OF_JANUARY, 100.0), (2, START_OF_FEBRUARY, None),
+    ]
+
+def test_ids_increase_over_all_partitions(conn: sqlite3.Connection) -> None:
+    insert(conn, [('a', START_OF_FEBRUARY, 40.0, 20.0, 100.0)])
+    insert(conn, [('a', END_OF_JANUARY, 40.0, 20.0, 100.0), ('b', START_OF_FEBRUARY + 1, 40.0, 20.0, 100.0)])
+    ids: List[int] = [row[0] for row in conn.execute('SELECT id FROM readings ORDER BY id')]
+    assert ids == [1, 2, 3]
+    assert last_reading_id(conn.cursor()) == 3
+
+def test_devices_register_themselves(conn: sqlite3.Connection) -> None:
+    insert(conn, [('a', T0, 40.0, 20.0, 100.0), ('a', T0 - 5000, 41.0, 21.0, 100.0), ('b', T0 + 1, 50.0, 10.0, 0.0)])
+    devices = {device['device_id']: device for device in list_devices(conn.cursor())}
+    assert (devices['a']['first_seen'], devices['a']['last_seen']) == (T0 - 5000, T0)
+    assert devices['b']['last_seen'] == T0 + 1
+
+def test_latest_per_device(conn: sqlite3.Connection) -> None:
+    insert(conn, [('a', END_OF_JANUARY, 40.0, 20.0, 100.0), ('a', START_OF_FEBRUARY, 41.0, 21.0, 100.0),
+                  ('b', END_OF_JANUARY, 50.0, 10.0, 0.0)])
+    assert latest_per_device(conn.cursor(), ('device_id', 'timestamp', 'humidity')) == [
+        ('a', START_OF_FEBRUARY, 41.0), ('b', END_OF_JANUARY, 50.0),
+    ]
+
+def test_sequences_round_trip(conn: sqlite3.Connection) -> None:
+    insert(conn, [('a', T0, 40.0, 20.0, 100.0)])
+    save_sequences(conn.cursor(), {'a': (7, 42), 'pi': (3, 1)})
+    assert load_sequences(conn.cursor()) == {'a': (7, 42), 'pi': (3, 1)}